@@ -0,0 +1,448 @@
+"""SQLite index of the tracker's history, for the activity feed."""
+
+from __future__ import with_statement
+import os
+from sqlalchemy import Table, Column, Index, String, Integer
+from sqlalchemy.sql import select, and_
+
+from hopper.database import _engine, _connection, _dispose, _lock, \
+                            _issue_shas
+from hopper.utils import cut, to_json, from_json
+
+# Bump this whenever the table below changes. The index is dropped and
+# rebuilt from the history.
+SCHEMA_VERSION = 3
+
+# Paths whose schema has been checked in this process.
+_checked = set()
+
+# Starts each trailer line of a grouped commit's message, which records one
+# of its actions as JSON. (See ``_action_trailer`` and ``_actions``.)
+ACTION_TRAILER = 'Hopper-Action: '
+
+class Activity(object):
+    """
+    An index of the actions in the tracker's history: one row for each
+    action, with its commit, time, author, the issue and comment it
+    refers to, and the issue's title and a snippet of the content.
+
+    Why:
+
+    Building the feed from the commits means walking the history and
+    opening the issue or comment named in each message, on every page
+    view. Listing the members means walking all of it. Both get slower
+    as the tracker gets older. With the index, a page of the feed (for
+    everyone, or for one author) and the list of members are each a
+    single indexed query.
+
+    Updating:
+
+    The index is appended to, from the newest indexed commit up to HEAD,
+    before each query, so only the commits made since the last query are
+    read. If the newest indexed commit is no longer in the history (e.g.
+    after a reset), the index is rebuilt.
+
+    The title and snippet are read from the commit the action was 
+    recorded by, so they show the issue or comment as it was then, even if
+    it has since been edited or deleted.
+
+    Rows are numbered by ``position``, which increases from the oldest
+    action to the newest, and which serves as the continuation token for
+    paging. A grouped commit (see ``CommitGroup``) gets a row for each of
+    its actions.
+
+    Issues:
+
+    Each issue's history, the commits that changed anything in its
+    directory, is kept in the ``issue_history`` table, indexed on
+    ``(issue_id, position)``. It's found by diffing each new commit's
+    ``issues`` tree against its (first) parent's, skipping the sub-trees
+    that match, as the commit is indexed. Listing an issue's history is
+    then a single indexed query, rather than a walk of the whole log.
+
+    The index lives in its own database file next to the mirror
+    (``.hopper/cache/activity.db``), so rebuilding the mirror doesn't
+    throw it away.
+
+    :param tracker: a Tracker object.
+    """
+    def __init__(self, tracker):
+        parent = os.path.join(tracker.paths['admin'], 'cache')
+        path = os.path.realpath(os.path.join(parent, 'activity.db'))
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        if not os.path.exists(path):
+            # Deleted since we last saw it (or never seen).
+            _dispose(path)
+            _checked.discard(path)
+        engine, metadata = _engine(path, _define_tables)
+        self.tracker = tracker
+        self.path = path
+        self.activity = metadata.tables['activity']
+        self.issue_history = metadata.tables['issue_history']
+        self.metadata = metadata
+        with _lock:
+            if path not in _checked:
+                self._create_schema()
+                _checked.add(path)
+
+    @property
+    def conn(self):
+        """
+        This thread's connection to the index, shared like the mirror's (see
+        ``hopper.database._connection``).
+        """
+        return _connection(self.path, _define_tables)
+
+    def select(self, n=20, after=None, author=None):
+        """
+        Return the newest actions, newest first, as rows with the columns
+        of the ``activity`` table.
+
+        :param n: the number of actions to return.
+        :param after: a continuation token: the ``position`` of the last
+                      action of the previous page.
+        :param author: only return the actions of the author with this
+                       email address.
+        """
+        self.update()
+        a = self.activity
+        conditions = []
+        if after is not None:
+            conditions.append(a.c.position < int(after))
+        if author is not None:
+            conditions.append(a.c.author_email == author)
+        query = select([a], and_(*conditions) if conditions else None)
+        query = query.order_by(a.c.position.desc()).limit(n)
+        return self.conn.execute(query).fetchall()
+
+    def authors(self):
+        """
+        Return everyone with an action in the history, most recently
+        active first, as ``(name, email)`` tuples.
+        """
+        self.update()
+        rows = self.conn.execute("""SELECT author_name, author_email,
+                                           max(position) AS latest
+                                    FROM activity GROUP BY author_email
+                                    ORDER BY latest DESC""")
+        return [(name, email) for name, email, latest in rows]
+
+    def history(self, issue_id, n=None):
+        """
+        Return the commits that changed an issue, newest first, as rows 
+        with the columns of the ``issue_history`` table: the commit, its
+        time, author, and the action that changed the issue.
+
+        :param issue_id: the issue's SHA1 identifier.
+        :param n: the number of commits to return. Defaults to all.
+        """
+        self.update()
+        h = self.issue_history
+        query = select([h], h.c.issue_id == issue_id)
+        query = query.order_by(h.c.position.desc())
+        if n is not None:
+            query = query.limit(n)
+        return self.conn.execute(query).fetchall()
+
+    def update(self):
+        """
+        Index the commits made since the newest indexed commit, or the
+        whole history if it's not an ancestor of HEAD.
+        """
+        repo = self.tracker.repo
+        last = self._last_commit()
+        rebuild = last is not None and not repo.is_ancestor(last)
+        if rebuild:
+            last = None
+        commits = []
+        for commit in repo.walk():
+            if commit.id == last:
+                break
+            commits.append(commit)
+        if not commits and not rebuild:
+            return
+        resolve = _Resolver(repo)
+        rows = []
+        history_rows = []
+        for commit in reversed(commits):
+            commit_rows = [_row(commit, seq, message, author, resolve) for 
+                           seq, (message, author) in 
+                           enumerate(_actions(commit))]
+            rows.extend(commit_rows)
+            for issue_id in _changed_issues(repo, commit):
+                history_rows.append(_history_row(commit, issue_id, 
+                                                 commit_rows))
+        trans = self.conn.begin()
+        try:
+            if rebuild:
+                self.conn.execute(self.activity.delete())
+                self.conn.execute(self.issue_history.delete())
+            # (another process may have just indexed the same commits)
+            if rows:
+                ins = self.activity.insert().prefix_with('OR IGNORE')
+                self.conn.execute(ins, rows)
+            if history_rows:
+                ins = self.issue_history.insert().prefix_with('OR IGNORE')
+                self.conn.execute(ins, history_rows)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+
+    def _last_commit(self):
+        """Return the SHA of the newest indexed commit, or None."""
+        last = self.conn.execute("""SELECT commit_id FROM activity
+                                    ORDER BY position DESC
+                                    LIMIT 1""").scalar()
+        # (SQLite gives back unicode, which dulwich won't take)
+        return str(last) if last is not None else None
+
+    def _create_schema(self):
+        """
+        Create the tables if they're missing, dropping them first if they were
+        written with an older schema.
+        """
+        version = self.conn.execute('PRAGMA user_version').scalar()
+        if version != SCHEMA_VERSION:
+            self.metadata.drop_all()
+        self.metadata.create_all()
+        if version != SCHEMA_VERSION:
+            self.conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+
+class _Resolver(object):
+    """
+    Resolves the abbreviated issue and comment ids in commit messages to
+    their full ids and fields, as they were in a commit. Only the trees
+    along the way are read (see ``_match_entry``).
+
+    :param repo: a hopper.git.Repo object.
+    """
+    def __init__(self, repo):
+        self.repo = repo
+
+    def issue(self, commit, id):
+        """
+        Return the ``(id, fields, tree)`` of the issue with the abbreviated
+        id in the commit, where tree is the SHA of its directory, or None.
+        """
+        repo = self.repo
+        issues = repo._tree_entry(commit.tree, 'issues')[1]
+        match = _match_entry(repo, issues, id.lower())
+        if match is None:
+            # (sharded, see Tracker.get_issue_path)
+            mode, shard = repo._tree_entries(issues).get(id[:2].lower(), 
+                                                         (None, None))
+            match = _match_entry(repo, shard, id[2:].lower(), 38)
+            if match is None:
+                return None
+            match = (id[:2].lower() + match[0], match[1])
+        full_id, tree = match
+        mode, blob = repo._tree_entry(tree, 'issue')
+        if blob is None:
+            return None
+        return full_id, repo.read_json(blob), tree
+
+    def comment(self, commit, issue_id, id):
+        """
+        Return the ``(issue id, id, fields)`` of the comment with the 
+        abbreviated ids in the commit, or None.
+        """
+        issue = self.issue(commit, issue_id)
+        if issue is None:
+            return None
+        full_issue_id, fields, tree = issue
+        comments = self.repo._tree_entry(tree, 'comments')[1]
+        match = _match_entry(self.repo, comments, id.lower())
+        if match is None:
+            return None
+        return full_issue_id, match[0], self.repo.read_json(match[1])
+
+
+def _match_entry(repo, sha, prefix, length=40):
+    """
+    Return the ``(name, sha)`` of the only entry in a tree whose name is
+    **length** characters long and starts with the prefix, or None if 
+    there isn't exactly one.
+
+    :param repo: a hopper.git.Repo object.
+    :param sha: SHA of the tree, or None.
+    """
+    matches = [(name, entry_sha) for name, (mode, entry_sha) in 
+               repo._tree_entries(sha).iteritems() 
+               if len(name) == length and name.startswith(prefix)]
+    return matches[0] if len(matches) == 1 else None
+
+
+def _define_tables(metadata):
+    """Define the activity and issue history tables on the metadata."""
+    activity = Table('activity', metadata,
+            Column('position', Integer, primary_key=True),
+            Column('commit_id', String, nullable=False),
+            Column('seq', Integer, nullable=False),
+            Column('time', Integer),
+            Column('author_name', String),
+            Column('author_email', String),
+            Column('action', String),
+            Column('issue_id', String),
+            Column('comment_id', String),
+            Column('title', String),
+            Column('snippet', String),
+            )
+    Index('ix_activity_commit_id_seq', activity.c.commit_id,
+          activity.c.seq, unique=True)
+    # for each author's feed, and the members list.
+    Index('ix_activity_author_email_position', activity.c.author_email,
+          activity.c.position)
+    history = Table('issue_history', metadata,
+            Column('position', Integer, primary_key=True),
+            Column('issue_id', String, nullable=False),
+            Column('commit_id', String, nullable=False),
+            Column('time', Integer),
+            Column('author_name', String),
+            Column('author_email', String),
+            Column('action', String),
+            )
+    # for each issue's history.
+    Index('ix_issue_history_issue_id_position', history.c.issue_id,
+          history.c.position)
+    Index('ix_issue_history_issue_id_commit_id', history.c.issue_id,
+          history.c.commit_id, unique=True)
+
+
+def _actions(commit):
+    """
+    Return the actions recorded by a commit, oldest first, as
+    ``(message, author)`` tuples. That's just the commit's own message
+    and author, unless it's a grouped commit (see ``_group_message``), 
+    whose last paragraph is a trailer line for each action.
+    """
+    message = commit.message.strip()
+    paragraphs = message.split('\n\n')
+    if len(paragraphs) > 1:
+        actions = []
+        for line in paragraphs[-1].split('\n'):
+            if not line.startswith(ACTION_TRAILER):
+                break
+            try:
+                action = from_json(line[len(ACTION_TRAILER):])
+                actions.append((action['message'], action['author']))
+            except (ValueError, TypeError, KeyError):
+                break
+        else:
+            return actions
+    return [(message, commit.author)]
+
+
+def _action_trailer(message, author):
+    """Return the trailer line that records an action of a grouped commit."""
+    return ACTION_TRAILER + to_json({'message': message, 'author': author},
+                                    indent=None)
+
+
+def _row(commit, seq, message, author, resolve):
+    """
+    Return the column values for an action.
+
+    The issue or comment is found from the id at the end of the message,
+    which is then dropped from the action, e.g. ``Commented on issue
+    1a2b3c/4d5e6f`` becomes ``commented on issue`` and points to comment
+    ``4d5e6f`` of issue ``1a2b3c``.
+
+    :param commit: the dulwich Commit the action was recorded by.
+    :param seq: the action's index within the commit.
+    :param message: the action's message.
+    :param author: the action's author, as ``Name <email>``.
+    :param resolve: a ``_Resolver``.
+    """
+    name, email = _split_author(author)
+    row = {'commit_id': commit.id,
+           'seq': seq,
+           'time': commit.commit_time,
+           'author_name': name,
+           'author_email': email,
+           'action': message,
+           'issue_id': None,
+           'comment_id': None,
+           'title': None,
+           'snippet': None}
+    if not message:
+        return row
+    message = message[0].lower() + message[1:]
+    row['action'] = message
+    last13 = message[-13:]
+    last6 = message[-6:]
+    if len(last13) == 13 and last13[6] == '/' and \
+            _looks_hashy(last13[:6]) and _looks_hashy(last13[7:]):
+        comment = resolve.comment(commit, last13[:6], last13[7:])
+        if comment is not None:
+            issue_id, comment_id, fields = comment
+            row.update(action=message[:-13].strip(),
+                       issue_id=issue_id,
+                       comment_id=comment_id,
+                       snippet=cut(fields.get('content'), 190))
+    elif _looks_hashy(last6):
+        issue = resolve.issue(commit, last6)
+        if issue is not None:
+            issue_id, fields, tree = issue
+            row.update(action=message[:-6].strip(),
+                       issue_id=issue_id,
+                       title=fields.get('title'),
+                       snippet=cut(fields.get('content'), 190))
+    return row
+
+
+def _changed_issues(repo, commit):
+    """
+    Return the SHAs of the issues that a commit changed, compared to its
+    first parent. Only the sub-trees that differ are read.
+
+    :param repo: a hopper.git.Repo object.
+    :param commit: a dulwich Commit.
+    """
+    parent = repo.object(commit.parents[0]).tree if commit.parents else None
+    old = repo._tree_entry(parent, 'issues')
+    new = repo._tree_entry(commit.tree, 'issues')
+    return sorted(_issue_shas(c[0] for c in 
+                              repo._entry_changes(old, new, 'issues')))
+
+
+def _history_row(commit, issue_id, commit_rows):
+    """
+    Return the ``issue_history`` column values for a commit that changed
+    an issue. The action and author are taken from the commit's action 
+    that names the issue, if any (see ``_row``), or else from the commit.
+
+    :param commit: the dulwich Commit.
+    :param issue_id: the issue's SHA.
+    :param commit_rows: the commit's ``activity`` rows.
+    """
+    matches = [r for r in commit_rows if r['issue_id'] == issue_id]
+    if matches:
+        action = matches[-1]['action']
+        name = matches[-1]['author_name']
+        email = matches[-1]['author_email']
+    else:
+        action = commit.message.strip().split('\n')[0]
+        name, email = _split_author(commit.author)
+    return {'issue_id': issue_id,
+            'commit_id': commit.id,
+            'time': commit.commit_time,
+            'author_name': name,
+            'author_email': email,
+            'action': action}
+
+
+def _split_author(author):
+    """Return the name and email of a ``Name <email>`` author."""
+    if '<' in author:
+        split = author.index('<')
+        return author[:split].strip(), author[split + 1:].rstrip('>')
+    return author, ''
+
+
+def _looks_hashy(text):
+    """Return True if the text is a (short) hex string."""
+    return len(text) == 6 and all(ch in '0123456789abcdefABCDEF'
+                                  for ch in text)
@@ -2,6 +2,7 @@ import time
 import os
 import glob
 
+from hopper import journal
 from hopper.files import BaseFile, JSONFile
 from hopper.utils import to_json, get_hash
 from hopper.errors import BadReference, AmbiguousReference
@@ -49,13 +50,15 @@ class Comment(JSONFile):
         self.id = get_hash(to_json(self.fields))
         if not os.path.isdir(self.issue.paths['comments']):
             os.mkdir(self.issue.paths['comments'])
-        # replace the issue in the db
-        self.issue.tracker.db.insert(self.issue)
+        # add the comment to the db
+        self.issue.tracker.db.insert_comment(self)
         return self.to_file(self.issue.get_comment_path(self.id))
 
     def delete(self):
         """Delete the comment's disk representation."""
         os.remove(self.issue.get_comment_path(self.id))
+        journal.record(self.issue.get_comment_path(self.id))
+        self.issue.tracker.db.delete_comment(self)
 
     def _resolve_id(self, id):
         """Resolve partial ids and verify the comment exists."""
@@ -75,3 +78,37 @@ class Comment(JSONFile):
         # one match, return the match
         match_id = os.path.basename(matches[0])
         return match_id
+
+
+class CommentRecord(BaseFile):
+    """
+    A read-only comment, built from a row in the tracker's SQLite mirror.
+    See ``hopper.issue.IssueRecord``.
+
+    :param row: a row from the database's ``comments`` table.
+    """
+
+    def __init__(self, row):
+        self.fields = {
+              'author'   : {
+                  'name'  : row['author_name'],
+                  'email' : row['author_email'],
+                  'avatar': row['author_avatar']
+                  },
+              'content'   : row['content'],
+              'timestamp' : row['timestamp'],
+              'id'        : row['id'],
+              'event'     : row['event'],
+              'event_data': row['event_data'],
+              }
+        self.issue_id = row['issue_id']
+        super(BaseFile, self).__init__()
+
+    def __eq__(self, other):
+        return True if self.id == other.id else False
+
+    def __ne__(self, other):
+        return True if self.id != other.id else False
+
+    def __repr__(self):
+        return '<CommentRecord %s>' % self.id[:6]
@@ -126,11 +126,54 @@ class TrackerConfig(ConfigFile):
                         # For Github post-receive hooks.
                         'github_repo_url' : None,
                         'github_repo_name': None
+                        },
+                'database': {
+                        # Processes to parse issues with when replicating;
+                        # None means one per CPU.
+                        'workers': None
+                        },
+                'commit': {
+                        # Web writes within this many ms share a commit;
+                        # 0 turns it off. (See Tracker.autocommit.)
+                        'group_window': 0
+                        },
+                'gc': {
+                        # Pack the repo's loose objects after a commit 
+                        # once there are about this many; 0 turns it off.
+                        # (See Repo.pack.)
+                        'auto_pack': 0
+                        },
+                'git': {
+                        # Read objects through `git cat-file --batch` when
+                        # git is installed. (See Repo._object.)
+                        'cat_file': True
+                        },
+                'layout': {
+                        # Keep issues in issues/<ab>/<cdef...> rather than
+                        # issues/<abcdef...>. (See Tracker.set_layout.)
+                        'sharded': False
                         }
                 }
+        self.types = {
+                'database': {
+                    'workers': int
+                    },
+                'commit': {
+                    'group_window': int
+                    },
+                'gc': {
+                    'auto_pack': int
+                    },
+                'git': {
+                    'cat_file': bool
+                    },
+                'layout': {
+                    'sharded': bool
+                    }
+                }
         self.path = tracker.paths['config']
         if self.path is not None and os.path.exists(self.path):
-            self.from_file(self.path)
+            self.from_file(self.path, self.types)
         super(BaseFile, self).__init__()
 
     def save(self):
@@ -2,8 +2,47 @@
 
 from __future__ import with_statement
 import os
-from sqlalchemy import create_engine, Table, Column, String, Float
-from sqlalchemy.schema import MetaData
+import stat
+import threading
+import multiprocessing
+from sqlalchemy import create_engine, event, Table, Column, Index, String, \
+                       Float, Boolean, Integer
+from sqlalchemy.schema import MetaData, CreateTable
+from sqlalchemy.pool import QueuePool, NullPool
+from sqlalchemy.exc import OperationalError
+
+from hopper.files import lock
+from hopper.utils import to_json, from_json
+
+# Bump this whenever the tables below change. A database written with a
+# different version is dropped and replicated from scratch; it's only a
+# mirror, after all.
+SCHEMA_VERSION = 6
+
+# Trackers with fewer issues are replicated in a single process.
+PARALLEL_THRESHOLD = 1000
+
+# Set on every new connection. WAL lets readers carry on while a writer
+# (e.g. Issue.save) holds the lock, and NORMAL sync is safe in WAL mode.
+PRAGMAS = ['PRAGMA journal_mode = WAL',
+           'PRAGMA synchronous = NORMAL',
+           'PRAGMA busy_timeout = 5000',
+           'PRAGMA mmap_size = 268435456',
+           'PRAGMA cache_size = -16000',
+           'PRAGMA temp_store = MEMORY']
+
+# Engines and their tables, keyed by database path, are shared by every
+# Database in the process. See ``_engine``.
+_engines = {}
+# Whether the search index could be created, keyed by database path. Also
+# marks the paths whose schema has been checked.
+_has_fts = {}
+# Bumped when the file at a path is removed, so open connections know to
+# reconnect.
+_generations = {}
+# Each thread's connections, keyed by database path. (See ``_connection``.)
+_local = threading.local()
+_lock = threading.RLock()
 
 class Database(object):
     """
@@ -38,40 +77,84 @@ class Database(object):
     db modification. Essentially, we're assuming that everything up to that 
     commit is synced.
 
-    Before inserting, if ``LAST_UPDATE != HEAD``, we need to reindex. Even for 
-    25000 issues, this should take less than a second. At any rate, this is 
-    only an issue after the user does something to change the HEAD (e.g. a pull
-    or reset). If the commits are indeed the same, we just apply changes. This 
-    just means an ``INSERT OR REPLACE`` or ``DELETE`` for each change.
+    Before inserting, if ``LAST_UPDATE != HEAD``, we need to catch up. As long
+    as ``LAST_UPDATE`` is an ancestor of HEAD (e.g. after a pull), we diff 
+    its tree against HEAD's and only re-read the issues that changed, so the 
+    cost is proportional to the new commits rather than the tracker. If it 
+    isn't (e.g. after a reset), we do a full replication. If the commits are 
+    the same, we just apply changes from the working tree. This just means an
+    ``INSERT OR REPLACE`` or ``DELETE`` for each change. A full replication
+    builds a new file and copies it in (see ``_rebuild``).
+
+    Comments:
+
+    Comments are mirrored in the ``comments`` table, which is indexed on 
+    ``(issue_id, timestamp)`` so an issue's comments can be listed without
+    reading any files. Each comment's row is written when it's saved.
+
+    Labels:
+
+    Each of an issue's labels gets a row in the ``issue_labels`` table, which
+    is indexed on ``(label, issue_id)``. Filtering on one or more labels is
+    then an index lookup rather than a ``LIKE`` scan over the ``labels`` 
+    column (which holds the JSON list, for building records).
+
+    Counting:
+
+    The ``counters`` table holds the number of issues per status, label and
+    author, keyed by ``(kind, key)``. Triggers on the ``issues`` and 
+    ``issue_labels`` tables keep it up to date within the same transaction
+    as each insert or delete, so counts never need a scan.
+
+    Searching:
+
+    Next to the ``issues`` table we keep ``issues_fts``, an FTS5 index over
+    the title, content and comments of each issue. Its rowid is derived from
+    the issue id (see ``_fts_rowid``), so a row can be replaced or deleted 
+    without scanning the index. If the SQLite build lacks FTS5, ``has_fts`` 
+    is False and searches fall back to ``LIKE``.
+
+    Connecting:
+
+    Opening a Database is cheap. The engine for each database file is
+    created once per process (see ``_engine``) and hands out pooled 
+    connections, set up for WAL journaling so readers aren't blocked by a 
+    writer. Each thread checks out one connection per file, which every 
+    Database in the thread shares (see ``_connection``), so a request that
+    opens several never holds more than one. The schema is checked the 
+    first time the file is opened.
     """
     def __init__(self, tracker, check=True):
         parent = os.path.join(tracker.paths['admin'], 'cache')
-        path = os.path.join(parent, 'tracker.db')
-        db = create_engine('sqlite:///%s' % path)
-        metadata = MetaData(db)
-        issues = Table('issues', metadata,
-                Column('id', String, primary_key=True),
-                Column('title', String),
-                Column('status', String),
-                Column('labels', String),
-                Column('content', String),
-                Column('comments', String),
-                Column('created', Float),
-                Column('updated', Float),
-                Column('author_name', String),
-                Column('author_email', String),
-                Column('author_avatar', String),
-                )
+        path = os.path.realpath(os.path.join(parent, 'tracker.db'))
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        elif not os.path.isdir(parent):
+            raise OSError('Parent path exists, but is not a directory.')
         if not os.path.exists(path):
-            if not os.path.exists(parent):
-                os.mkdir(parent)
-            elif not os.path.isdir(parent):
-                raise OSError('Parent path exists, but is not a directory.')
-            issues.create()
+            # Deleted since we last saw it (or never seen).
+            _dispose(path)
+        engine, metadata = _engine(path)
         self.tracker = tracker
-        self.issues = issues
-        self.conn = db.connect()
+        self.path = path
+        self.issues = metadata.tables['issues']
+        self.comments = metadata.tables['comments']
+        self.labels = metadata.tables['issue_labels']
+        self.counters = metadata.tables['counters']
+        self.metadata = metadata
         self.check = check
+        with _lock:
+            if path not in _has_fts:
+                _has_fts[path] = self._create_schema()
+        self.has_fts = _has_fts[path]
+
+    @property
+    def conn(self):
+        """
+        This thread's connection to the database, shared with every other 
+        Database in the thread (see ``_connection``).
+        """
+        return _connection(self.path)
 
     def select(self, **kwargs):
         self._integrity_check()
@@ -81,59 +164,179 @@ class Database(object):
         """
         Insert an Issue object into the database.
 
-        NOTE that the actual SQL statement is an ``INSERT OR REPLACE``.
+        NOTE that an existing row is deleted and re-inserted (rather than
+        using ``INSERT OR REPLACE``) so the counter triggers see both.
+
+        Only the issue itself is written. Its comments are already in the 
+        ``comments`` table; each one is inserted when it's saved.
 
         :param issue: a single Issue object
         """
-        ins = self.issues.insert().prefix_with('OR REPLACE')
-        comments = issue.comments()
-        # comments just need to be searchable, we're not going to be 
-        # retrieving them from this table.
-        comment_data = ''.join(c.content for c in comments if c.content 
-                               is not None)
-        ins.execute(id=issue.id,
-                    title=issue.title,
-                    status=issue.status,
-                    labels=','.join(issue.labels),
-                    content=issue.content,
-                    comments=comment_data,
-                    created=issue.created,
-                    updated=issue.updated,
-                    author_name=issue.author['name'],
-                    author_email=issue.author['email'],
-                    author_avatar=issue.author['avatar']
-                    )
+        self._write([self._row(issue)])
 
     def insert_many(self, issues):
         """
-        Insert a list of Issue objects.
+        Insert a list of Issue objects, along with their comments, which are
+        read from the flat-file database and replace any already stored.
 
         If the number of issues is substantial, ``insert_many_from_shas``
         will perform better.
 
         :param issues: a list of Issue objects.
         """
-        ins = self.issues.insert().prefix_with('OR REPLACE')
-        issue_dicts = []
+        comment_rows = []
         for i in issues:
-            comments = i.comments()
-            comment_data = ''.join(c.content for c in comments if c.content
-                                   is not None)
-            issue_dicts.append({
-                                'id': i.id,
-                                'title': i.title,
-                                'status': i.status,
-                                'labels': ','.join(i.labels),
-                                'content': i.content,
-                                'comments': comment_data,
-                                'created': i.created,
-                                'updated': i.updated,
-                                'author_name': i.author['name'],
-                                'author_email': i.author['email'],
-                                'author_avatar': i.author['avatar']
-                               })
-        if issue_dicts:
-            ins.execute(issue_dicts)
+            comment_rows.extend(self._comment_row(c) for c in i.comments())
+        self._write([self._row(i) for i in issues], comment_rows)
+
+    def insert_comment(self, comment):
+        """
+        Insert a Comment object into the database, and add its content to
+        its issue's entry in the search index.
+
+        :param comment: a single Comment object.
+        """
+        trans = self.conn.begin()
+        try:
+            ins = self.comments.insert().prefix_with('OR REPLACE')
+            self.conn.execute(ins, self._comment_row(comment))
+            self._index_comments(comment.issue.id)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+
+    def delete(self, id):
+        """
+        Delete an issue and its comments from the database.
+
+        :param id: the issue's SHA1 identifier.
+        """
+        trans = self.conn.begin()
+        try:
+            self.conn.execute(self.issues.delete().where(
+                self.issues.c.id == id))
+            self.conn.execute(self.comments.delete().where(
+                self.comments.c.issue_id == id))
+            self.conn.execute(self.labels.delete().where(
+                self.labels.c.issue_id == id))
+            if self.has_fts:
+                self.conn.execute('DELETE FROM issues_fts WHERE rowid = ?',
+                                  (_fts_rowid(id),))
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+
+    def delete_comment(self, comment):
+        """
+        Delete a comment from the database.
+
+        :param comment: a single Comment object.
+        """
+        trans = self.conn.begin()
+        try:
+            self.conn.execute(self.comments.delete().where(
+                self.comments.c.id == comment.id))
+            self._index_comments(comment.issue.id)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+
+    def _create_schema(self):
+        """
+        Create the tables if they're missing. If the database was written
+        with an older schema, drop everything first and remove the
+        ``LAST_UPDATE`` marker so the next integrity check replicates.
+
+        This runs once per database file per process.
+
+        :return: True if the search index could be created.
+        """
+        version = self.conn.execute('PRAGMA user_version').scalar()
+        if version != SCHEMA_VERSION:
+            self.conn.execute('DROP TABLE IF EXISTS issues_fts')
+            self.metadata.drop_all()
+            marker = os.path.join(self.tracker.paths['admin'], 'cache', 
+                                  'LAST_UPDATE')
+            if os.path.exists(marker):
+                os.remove(marker)
+        self.metadata.create_all()
+        for trigger in _COUNTER_TRIGGERS:
+            self.conn.execute(trigger)
+        try:
+            self.conn.execute(_FTS_TABLE)
+            has_fts = True
+        except OperationalError:
+            # SQLite was built without FTS5.
+            has_fts = False
+        if version != SCHEMA_VERSION:
+            self.conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        return has_fts
+
+    def _row(self, issue):
+        """Return the dictionary of column values for an Issue object."""
+        return _issue_row(issue.id, issue.fields)
+
+    def _comment_row(self, comment):
+        """Return the dictionary of column values for a Comment object."""
+        return _comment_row(comment.issue.id, comment.id, comment.fields)
+
+    def _write(self, rows, comment_rows=None):
+        """
+        Insert or replace rows in the ``issues`` table and the search index
+        within a single transaction.
+
+        :param rows: a list of dictionaries, as returned by ``_row``.
+        :param comment_rows: if given, a list of dictionaries, as returned 
+                             by ``_comment_row``, that replace all the 
+                             stored comments of the issues in **rows**.
+        """
+        if not rows:
+            return
+        trans = self.conn.begin()
+        try:
+            # (REPLACE's implicit delete wouldn't fire the counter triggers)
+            ids = [(r['id'],) for r in rows]
+            self.conn.execute('DELETE FROM issues WHERE id = ?', ids)
+            self.conn.execute(self.issues.insert(), rows)
+            self.conn.execute('DELETE FROM issue_labels WHERE issue_id = ?',
+                              ids)
+            label_rows = [{'issue_id': r['id'], 'label': l} for r in rows
+                          for l in _normalize_labels(from_json(r['labels']))]
+            if label_rows:
+                self.conn.execute(self.labels.insert(), label_rows)
+            if comment_rows is not None:
+                self.conn.execute('DELETE FROM comments WHERE issue_id = ?',
+                                  [(r['id'],) for r in rows])
+                if comment_rows:
+                    self.conn.execute(self.comments.insert(), comment_rows)
+            if self.has_fts:
+                if comment_rows is not None:
+                    text = _comment_texts(comment_rows)
+                else:
+                    text = dict((r['id'], self._comment_text(r['id'])) 
+                                for r in rows)
+                self.conn.execute(_FTS_INSERT, _fts_rows(rows, text))
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+
+    def _comment_text(self, issue_id):
+        """Return the content of an issue's stored comments, joined."""
+        return self.conn.execute("""SELECT group_concat(content, ' ') 
+                                    FROM comments WHERE issue_id = ?""",
+                                 (issue_id,)).scalar()
+
+    def _index_comments(self, issue_id):
+        """Refresh the comments column of an issue's search index entry."""
+        if self.has_fts:
+            self.conn.execute('UPDATE issues_fts SET comments = ? '
+                              'WHERE rowid = ?', 
+                              (self._comment_text(issue_id), 
+                               _fts_rowid(issue_id)))
 
     def _insert_many_from_shas(self, shas, n=50):
         """
@@ -149,23 +352,129 @@ class Database(object):
         :param n: group size
         """
         # TODO: n should probably be calculated based on len(shas)
+        for rows, comment_rows in self._load(shas, n):
+            self._write(rows, comment_rows)
+
+    def _load(self, shas, n=50):
+        """
+        Read issues and their comments from the flat-file database, given a
+        list of SHA identifiers, in groups of n.
+
+        Parsing the JSON is CPU-bound, so for large trackers the groups are
+        farmed out to a pool of worker processes (see ``_workers``). Their
+        rows are yielded as they come back, in no particular order, to the
+        caller, which does all the writing.
+
+        :param shas: a list of SHA identifiers as strings.
+        :param n: group size
+        :return: a generator of ``(rows, comment_rows)`` tuples, as taken by
+                 ``_write``.
+        """
+        path = self.tracker.get_issue_path
+        chunks = [[(sha, os.path.dirname(path(sha))) for sha in shas[i:i + n]]
+                  for i in xrange(0, len(shas), n)]
+        workers = self._workers(len(shas))
+        if workers < 2:
+            for chunk in chunks:
+                yield _read_rows(chunk)
+            return
+        pool = multiprocessing.Pool(workers)
+        try:
+            for rows in pool.imap_unordered(_read_rows, chunks):
+                yield rows
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def _load_commit(self, ref, shas=None, n=50):
+        """
+        Read issues and their comments from the git objects of a commit,
+        rather than from the working tree, in groups of n. This works for
+        bare repositories and for any commit.
+
+        The ``issues`` sub-tree is walked and the issue and comment blobs 
+        are read straight from the object store. Blobs are parsed once and 
+        cached by SHA (see ``Repo.read_json``), so content that's in many 
+        commits (which is most of it) isn't parsed again on the next build.
+
+        :param ref: a branch, tag, or commit SHA.
+        :param shas: the SHAs of the issues to read. Defaults to all the 
+                     issues in the commit; any that aren't are skipped.
+        :param n: group size
+        :return: a generator of ``(rows, comment_rows)`` tuples, as taken by
+                 ``_write``.
+        """
+        repo = self.tracker.repo
+        tree = repo.tree(repo.object(repo._resolve_ref(ref)).tree)
+        issues = repo._obj_from_tree(tree, 'issues')
+        entries = _issue_entries(repo, issues.id) if issues else {}
+        if shas is None:
+            shas = sorted(sha for sha in entries if len(sha) == 40)
+        else:
+            shas = [sha for sha in shas if sha in entries]
+
         for i in xrange(0, len(shas), n):
-            edge = i + n if i + n < len(shas) else len(shas)
-            issues = [self.tracker.issue(shas[j]) for j in range(i, edge)]
-            self.insert_many(issues)
+            rows = []
+            comment_rows = []
+            for sha in shas[i:i + n]:
+                files = repo._tree_entries(entries[sha][1])
+                if 'issue' not in files:
+                    continue
+                fields = repo.read_json(files['issue'][1])
+                rows.append(_issue_row(sha, fields))
+                if 'comments' not in files:
+                    continue
+                comments = repo._tree_entries(files['comments'][1])
+                for id, (mode, blob) in sorted(comments.items()):
+                    if len(id) == 40:
+                        fields = repo.read_json(blob)
+                        comment_rows.append(_comment_row(sha, id, fields))
+            yield rows, comment_rows
+
+    def _workers(self, n):
+        """
+        Return the number of processes to parse n issues with. 
+
+        This is the ``workers`` setting in the ``database`` section of the
+        tracker config, defaulting to the number of CPUs. Trackers with 
+        fewer than ``PARALLEL_THRESHOLD`` issues are always parsed in this
+        process, as starting the pool would cost more than it saves.
+        """
+        if n < PARALLEL_THRESHOLD:
+            return 1
+        workers = self.tracker.config.database.get('workers')
+        if workers is None:
+            try:
+                workers = multiprocessing.cpu_count()
+            except NotImplementedError:
+                workers = 1
+        return workers
 
-    def _set_update(self):
+    def _set_update(self, commit=None):
+        """
+        Write the ``LAST_UPDATE`` marker.
+
+        :param commit: the SHA of the commit we're synced with. Defaults 
+                       to HEAD.
+        """
+        if commit is None:
+            commit = self.tracker.repo.head().id
         path = os.path.join(self.tracker.paths['admin'], 'cache', 'LAST_UPDATE')
         with open(path, 'w') as fp:
-            fp.write(self.tracker.repo.head().id)
+            fp.write(commit)
 
     def _integrity_check(self):
         """
         Check the database for consistency with the JSON database.
 
         Compares the repo HEAD with the LAST_UPDATE file, and checks the working
-        tree. If the commits differ, we do a full replication. If the commits are
-        the same, we apply any changes in the working tree.
+        tree. If the commits differ, we sync the issues that changed between
+        them, or do a full replication if LAST_UPDATE is not reachable from
+        HEAD. If the commits are the same, we apply any changes in the working
+        tree.
 
         Speed is better than accuracy here, so it doesn't provide guarantees.
         If the database has been manually changed, or the Git repository has been
@@ -182,36 +491,520 @@ class Database(object):
             return
 
         # Get some info
-        head = self.tracker.repo.head().id
+        repo = self.tracker.repo
+        head = repo.head().id
         last_update = open(path, 'r').read()
-        dirty = self.tracker.repo.is_dirty()
 
-        # Commits match, but repo is dirty:
-        if last_update == head and dirty:
-            self._apply_working_tree()
-        # (If commits match and repo is clean, nothing happens.)
+        # Commits match, but issues may have changed in the working tree:
+        # (only issues/ is checked, as .hopper/cache is always dirty)
+        if last_update == head:
+            if not repo.is_bare():
+                self._apply_working_tree()
 
-        # Commits don't match:
-        elif last_update != head:
+        # Commits don't match, but we can catch up from LAST_UPDATE:
+        elif repo.is_ancestor(last_update, head):
+            self._sync(last_update)
+
+        # LAST_UPDATE is gone or was reset away from:
+        else:
             self._replicate()
 
-    def _replicate(self):
-        """Do a full replication of the JSON database into this one."""
-        shas = self.tracker._get_issue_shas()
-        self._insert_many_from_shas(shas)
+    def _replicate(self, ref=None):
+        """
+        Do a full replication of the JSON database into this one.
+
+        The mirror is rebuilt from scratch into a temporary file next to it
+        (see ``_rebuild``), which is then copied into ``tracker.db`` in a
+        single transaction (see ``_swap_in``). Until that commits, readers
+        keep seeing the old mirror, so they never see a half-populated 
+        table.
+
+        :param ref: if given, replicate the issues as they are in this 
+                    commit (see ``_load_commit``), rather than in the 
+                    working tree. Bare repositories default to HEAD.
+        """
+        repo = self.tracker.repo
+        if ref is None and repo.is_bare():
+            ref = 'HEAD'
+        tmp = '%s.%d.rebuild' % (self.path, os.getpid())
+        if ref is None:
+            self._rebuild(tmp, self._load(self.tracker._get_issue_shas()))
+            commit = None
+        else:
+            commit = repo._resolve_ref(ref)
+            self._rebuild(tmp, self._load_commit(commit))
+        try:
+            self._swap_in(tmp)
+        finally:
+            os.remove(tmp)
+        self._set_update(commit)
+
+    def _swap_in(self, path):
+        """
+        Replace the contents of the mirror with those of a database built 
+        by ``_rebuild``, in one transaction.
+
+        The file itself is never replaced: renaming over a database that 
+        other processes (the CLI, other web workers) have open would leave
+        them on the old, unlinked file, and could replay their WAL onto 
+        the new one. Instead, the new database is attached and its rows are
+        copied in. The counters are emptied first and rebuilt by the 
+        triggers as the rows go in. (Everything in the transaction is DML;
+        pysqlite would commit halfway through before any DDL.)
+
+        :param path: the path to the rebuilt database.
+        """
+        conn = self.conn
+        conn.execute('ATTACH DATABASE ? AS rebuild', (path,))
+        try:
+            trans = conn.begin()
+            try:
+                conn.execute('DELETE FROM main.counters')
+                for table in self.metadata.sorted_tables:
+                    if table.name == 'counters':
+                        continue
+                    conn.execute('DELETE FROM main.%s' % table.name)
+                    conn.execute('INSERT INTO main.%s SELECT * FROM '
+                                 'rebuild.%s' % (table.name, table.name))
+                if self.has_fts:
+                    conn.execute('DELETE FROM main.issues_fts')
+                    conn.execute("""INSERT INTO main.issues_fts
+                                        (rowid, id, title, content, comments)
+                                    SELECT rowid, id, title, content, comments
+                                    FROM rebuild.issues_fts""")
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+        finally:
+            conn.execute('DETACH DATABASE rebuild')
+
+    def _rebuild(self, path, chunks):
+        """
+        Load the given issues into the tables of a new database file, to be
+        copied into the mirror by ``_swap_in``.
+
+        Nobody else can see the file, so it's written without a journal or 
+        fsyncs, and all the rows are loaded in a single transaction. It's 
+        only read through once, so it gets no indexes or counters.
+
+        :param path: the path to the new database. Removed first, if it 
+                     exists, and also on failure.
+        :param chunks: an iterable of ``(rows, comment_rows)`` tuples, as 
+                       yielded by ``_load`` or ``_load_commit``.
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        engine = create_engine('sqlite:///%s' % path, poolclass=NullPool)
+        metadata = MetaData(engine)
+        _define_tables(metadata)
+        tables = metadata.tables
+        conn = engine.connect()
+        try:
+            conn.execute('PRAGMA journal_mode = OFF')
+            conn.execute('PRAGMA synchronous = OFF')
+            for table in metadata.sorted_tables:
+                conn.execute(CreateTable(table))
+            if self.has_fts:
+                conn.execute(_FTS_TABLE)
+            trans = conn.begin()
+            try:
+                for rows, comment_rows in chunks:
+                    if not rows:
+                        continue
+                    conn.execute(tables['issues'].insert(), rows)
+                    label_rows = [{'issue_id': r['id'], 'label': l} 
+                                  for r in rows for l in 
+                                  _normalize_labels(from_json(r['labels']))]
+                    if label_rows:
+                        conn.execute(tables['issue_labels'].insert(), 
+                                     label_rows)
+                    if comment_rows:
+                        conn.execute(tables['comments'].insert(), 
+                                     comment_rows)
+                    if self.has_fts:
+                        conn.execute(_FTS_INSERT, _fts_rows(rows, 
+                                     _comment_texts(comment_rows)))
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+        except:
+            conn.close()
+            engine.dispose()
+            os.remove(path)
+            raise
+        conn.close()
+        engine.dispose()
+
+    def _sync(self, last_update):
+        """
+        Apply the changes between the LAST_UPDATE commit and HEAD, plus any
+        in the working tree.
+
+        The two commits' trees are diffed, skipping any sub-trees whose SHAs
+        match, so only the ``issues/<sha>`` entries that actually changed are
+        visited. Those issues are then re-read from the working tree (which
+        is what we mirror) or deleted. Bare repositories have no working 
+        tree, so their issues are read from HEAD's objects instead.
+
+        :param last_update: SHA of the commit the database was synced with.
+        """
+        repo = self.tracker.repo
+        shas = _issue_shas(c[0] for c in 
+                           repo.changes(last_update, repo.head().id, 
+                                        'issues'))
+        if repo.is_bare():
+            self._apply_shas(shas, repo.head().id)
+        else:
+            shas.update(self._working_tree_shas())
+            self._apply_shas(shas)
         self._set_update()
 
     def _apply_working_tree(self):
         """Apply changes from the working to the database."""
+        self._apply_shas(self._working_tree_shas())
+
+    def apply_paths(self, paths):
+        """
+        Re-read (or delete) the issues that the changed files belong to, 
+        e.g. the paths written by ``Repo.checkout``. Paths outside of 
+        ``issues`` are ignored.
+
+        :param paths: paths relative to the tracker root.
+        """
+        self._apply_shas(_issue_shas(paths))
+
+    def _apply_shas(self, shas, commit=None):
+        """
+        Insert or replace the given issues if they exist in the working tree,
+        or delete them if they don't.
+
+        :param shas: an iterable of issue SHA1 identifiers.
+        :param commit: if given, look for the issues in this commit instead
+                       of the working tree.
+        """
+        if commit is not None:
+            found = set()
+            for rows, comment_rows in self._load_commit(commit, list(shas)):
+                self._write(rows, comment_rows)
+                found.update(r['id'] for r in rows)
+            for sha in set(shas) - found:
+                self.delete(sha)
+            return
+        for sha in shas:
+            if os.path.exists(self.tracker.get_issue_path(sha)):
+                # insert or replace the row and its comments
+                self.insert_many([self.tracker.issue(sha)])
+            else:
+                # delete row
+                self.delete(sha)
+
+    def _working_tree_shas(self):
+        """Return the set of issues with changes in the working tree."""
         # get modified files within issues
         new, modified, deleted = self.tracker.repo.status('issues')
-        for path in new + modified:
-            # insert or replace row
-            sha = path.split(os.sep)[1]
-            issue = self.tracker.issue(sha)
-            self.insert(issue)
-        for path in deleted:
-            # delete row
-            sha = path.split(os.sep)[1:]
-            query = self.issues.delete().where(id=sha)
-            query.execute()
+        return _issue_shas(new + modified + deleted)
+
+
+def _issue_shas(paths):
+    """
+    Return the set of the issues that the paths (relative to the tracker
+    root) are within, e.g. ``issues/<sha>/comments/<sha>``.
+    """
+    shas = set()
+    for path in paths:
+        parts = path.split(os.sep)
+        if parts[0] != 'issues':
+            continue
+        if len(parts) > 2 and len(parts[1]) == 40:
+            shas.add(parts[1])
+        elif len(parts) > 3 and len(parts[1]) == 2 and len(parts[2]) == 38:
+            # (sharded, see Tracker.get_issue_path)
+            shas.add(parts[1] + parts[2])
+    return shas
+
+
+def _issue_entries(repo, sha):
+    """
+    Return a dictionary that maps the SHA of each issue in an ``issues``
+    tree to its directory's ``(mode, sha)`` entry, in either layout (see
+    ``Tracker.get_issue_path``).
+
+    :param repo: a hopper.git.Repo object.
+    :param sha: SHA of the ``issues`` tree.
+    """
+    entries = {}
+    for name, (mode, entry_sha) in repo._tree_entries(sha).iteritems():
+        if len(name) == 40:
+            entries[name] = (mode, entry_sha)
+        elif len(name) == 2 and stat.S_ISDIR(mode):
+            for rest, entry in repo._tree_entries(entry_sha).iteritems():
+                if len(rest) == 38:
+                    entries[name + rest] = entry
+    return entries
+
+
+def _engine(path, define=None):
+    """
+    Return the ``(engine, metadata)`` tuple for the SQLite database at the
+    path, creating them the first time the path is seen in this process.
+
+    Connections are pooled, so opening a Database doesn't open a new
+    connection, and each one is set up with ``PRAGMAS``.
+
+    :param define: the function that defines the tables on the metadata.
+                   Defaults to ``_define_tables`` (the mirror's).
+    """
+    with _lock:
+        if path not in _engines:
+            engine = create_engine('sqlite:///%s' % path,
+                                   poolclass=QueuePool,
+                                   connect_args={'check_same_thread': False})
+            event.listen(engine, 'connect', _set_pragmas)
+            metadata = MetaData(engine)
+            (define or _define_tables)(metadata)
+            _engines[path] = (engine, metadata)
+        return _engines[path]
+
+
+def _connection(path, define=None):
+    """
+    Return the calling thread's connection to the database at the path,
+    checking one out of the engine's pool the first time, or again if the
+    file has been removed since (see ``_dispose``).
+
+    :param define: passed to ``_engine``.
+    """
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+    generation = _generations.get(path, 0)
+    conn, conn_generation = conns.get(path, (None, None))
+    if conn is None or conn_generation != generation:
+        if conn is not None:
+            conn.close()
+        conn = _engine(path, define)[0].connect()
+        conns[path] = (conn, generation)
+    return conn
+
+
+def _dispose(path):
+    """
+    Close the pooled connections to the database at the path and forget its
+    engine, e.g. after the file has been removed or replaced.
+    """
+    with _lock:
+        if path in _engines:
+            _engines.pop(path)[0].dispose()
+            _generations[path] = _generations.get(path, 0) + 1
+        _has_fts.pop(path, None)
+
+
+def _set_pragmas(dbapi_conn, connection_record):
+    """Set ``PRAGMAS`` on a new DBAPI connection."""
+    cursor = dbapi_conn.cursor()
+    for pragma in PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def _define_tables(metadata):
+    """Define the mirror's tables on the metadata."""
+    issues = Table('issues', metadata,
+            Column('id', String, primary_key=True),
+            Column('title', String),
+            Column('status', String),
+            Column('labels', String),
+            Column('content', String),
+            Column('created', Float),
+            Column('updated', Float),
+            Column('author_name', String),
+            Column('author_email', String),
+            Column('author_avatar', String),
+            )
+    # for keyset pagination (see Query.select) within a status.
+    Index('ix_issues_status_updated_id', issues.c.status, 
+          issues.c.updated, issues.c.id)
+    Index('ix_issues_status_created_id', issues.c.status, 
+          issues.c.created, issues.c.id)
+    comments = Table('comments', metadata,
+            Column('id', String, primary_key=True),
+            Column('issue_id', String, nullable=False),
+            Column('timestamp', Float),
+            Column('content', String),
+            Column('event', Boolean),
+            Column('event_data', String),
+            Column('author_name', String),
+            Column('author_email', String),
+            Column('author_avatar', String),
+            )
+    Index('ix_comments_issue_id_timestamp', comments.c.issue_id, 
+          comments.c.timestamp)
+    labels = Table('issue_labels', metadata,
+            Column('issue_id', String, primary_key=True),
+            Column('label', String, primary_key=True),
+            )
+    Index('ix_issue_labels_label_issue_id', labels.c.label, 
+          labels.c.issue_id)
+    counters = Table('counters', metadata,
+            Column('kind', String, primary_key=True),
+            Column('key', String, primary_key=True),
+            Column('n', Integer, nullable=False, default=0),
+            )
+
+
+# (table, kind, counted column) for the ``counters`` table.
+_COUNTED = [('issues', 'status', 'status'),
+            ('issues', 'author', 'author_name'),
+            ('issue_labels', 'label', 'label')]
+
+
+def _counter_triggers():
+    """
+    Return the statements that create the triggers which maintain the
+    ``counters`` table.
+    """
+    triggers = []
+    for table, kind, column in _COUNTED:
+        key = "coalesce(NEW.%s, '')" % column
+        triggers.append("""
+            CREATE TRIGGER IF NOT EXISTS %(table)s_%(kind)s_insert 
+            AFTER INSERT ON %(table)s BEGIN
+                INSERT OR IGNORE INTO counters (kind, key, n) 
+                    VALUES ('%(kind)s', %(key)s, 0);
+                UPDATE counters SET n = n + 1 
+                    WHERE kind = '%(kind)s' AND key = %(key)s;
+            END""" % {'table': table, 'kind': kind, 'key': key})
+        triggers.append("""
+            CREATE TRIGGER IF NOT EXISTS %(table)s_%(kind)s_delete 
+            AFTER DELETE ON %(table)s BEGIN
+                UPDATE counters SET n = n - 1 
+                    WHERE kind = '%(kind)s' AND key = %(key)s;
+            END""" % {'table': table, 'kind': kind, 
+                      'key': key.replace('NEW.', 'OLD.')})
+    return triggers
+
+_COUNTER_TRIGGERS = _counter_triggers()
+
+
+def _issue_row(id, fields):
+    """
+    Return the dictionary of column values for an issue.
+
+    :param id: the issue's SHA.
+    :param fields: the issue's fields, as read from its JSON file.
+    """
+    author = fields.get('author') or {}
+    return {'id': id,
+            'title': fields.get('title'),
+            'status': fields.get('status', 'open'),
+            'labels': to_json(fields.get('labels') or [], indent=None),
+            'content': fields.get('content'),
+            'created': fields.get('created'),
+            'updated': fields.get('updated'),
+            'author_name': author.get('name'),
+            'author_email': author.get('email'),
+            'author_avatar': author.get('avatar')
+            }
+
+
+def _comment_row(issue_id, id, fields):
+    """
+    Return the dictionary of column values for a comment.
+
+    :param issue_id: the SHA of the issue commented on.
+    :param id: the comment's SHA.
+    :param fields: the comment's fields, as read from its JSON file.
+    """
+    author = fields.get('author') or {}
+    return {'id': id,
+            'issue_id': issue_id,
+            'timestamp': fields.get('timestamp'),
+            'content': fields.get('content'),
+            'event': bool(fields.get('event')),
+            'event_data': fields.get('event_data'),
+            'author_name': author.get('name'),
+            'author_email': author.get('email'),
+            'author_avatar': author.get('avatar')
+            }
+
+
+def _read_rows(issues):
+    """
+    Read and parse the files of some issues and their comments. This is 
+    run by ``Database._load``, possibly in a worker process, so it only
+    deals in paths and plain data.
+
+    :param issues: a list of ``(sha, path)`` tuples, where path is the 
+                   issue's directory.
+    :return: a ``(rows, comment_rows)`` tuple.
+    """
+    rows = []
+    comment_rows = []
+    for sha, path in issues:
+        with lock(os.path.join(path, 'issue'), 'r') as fp:
+            rows.append(_issue_row(sha, from_json(fp.read())))
+        comments = os.path.join(path, 'comments')
+        if not os.path.isdir(comments):
+            continue
+        for id in os.listdir(comments):
+            if len(id) != 40:
+                continue
+            with lock(os.path.join(comments, id), 'r') as fp:
+                comment_rows.append(_comment_row(sha, id, from_json(fp.read())))
+    return rows, comment_rows
+
+
+_FTS_TABLE = """CREATE VIRTUAL TABLE IF NOT EXISTS issues_fts
+                USING fts5(id UNINDEXED, title, content, comments)"""
+
+_FTS_INSERT = """INSERT OR REPLACE INTO issues_fts
+                     (rowid, id, title, content, comments)
+                 VALUES (?, ?, ?, ?, ?)"""
+
+
+def _fts_rows(rows, text):
+    """
+    Return the parameters of ``_FTS_INSERT`` for each issue row.
+
+    :param rows: a list of dictionaries, as returned by ``Database._row``.
+    :param text: a dictionary of issue id to comment text.
+    """
+    return [(_fts_rowid(r['id']), r['id'], r['title'], r['content'], 
+             text.get(r['id'])) for r in rows]
+
+
+def _comment_texts(comment_rows):
+    """
+    Return a dictionary of issue id to the text of its comments, joined in
+    the order they were made.
+
+    :param comment_rows: a list of dictionaries, as returned by 
+                         ``Database._comment_row``.
+    """
+    text = {}
+    for c in sorted(comment_rows, key=lambda c: c['timestamp']):
+        if c['content'] is not None:
+            text.setdefault(c['issue_id'], []).append(c['content'])
+    return dict((k, ' '.join(v)) for k, v in text.items())
+
+
+def _normalize_labels(labels):
+    """
+    Return the unique, non-empty labels in the list, stripped of 
+    surrounding whitespace.
+    """
+    labels = set(l.strip() for l in labels if l is not None)
+    labels.discard('')
+    return sorted(labels)
+
+
+def _fts_rowid(id):
+    """
+    Map an issue id to a stable rowid in the search index.
+
+    The first 15 hex digits of the SHA1 fit in a signed 64-bit integer and
+    are, for our purposes, just as unique.
+    """
+    return int(id[:15], 16)
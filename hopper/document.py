@@ -1,6 +1,7 @@
 from __future__ import with_statement
 import os
 
+from hopper import journal
 from hopper.files import lock
 from hopper.utils import markdown_to_html, rst_to_html
 
@@ -54,3 +55,4 @@ class Document(object):
         """
         with lock(self.path, 'w') as fp:
             fp.write(text)
+        journal.record(self.path)
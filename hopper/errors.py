@@ -9,3 +9,7 @@ class AmbiguousReference(Exception):
 class MailConfigError(Exception):
     """Not configured to send email."""
     pass
+
+class BadCursor(Exception):
+    """The pagination cursor is malformed or doesn't match the query."""
+    pass
@@ -8,6 +8,7 @@ import os
 import time
 from configobj import ConfigObj
 
+from hopper import journal
 from hopper.utils import from_json, to_json
 
 class BaseFile(object):
@@ -84,6 +85,7 @@ class JSONFile(BaseFile):
             raise TypeError('self.fields must be a dict')
         with lock(f, 'w') as fp:
             fp.write(to_json(self.fields, indent=4))
+        journal.record(f)
         return True
 
 
@@ -171,6 +173,7 @@ class ConfigFile(BaseFile):
         for k in self.fields.keys():
             config[k] = self.fields[k]
         config.write()
+        journal.record(f)
 
 
 class LockedFile(file):
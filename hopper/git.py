@@ -2,13 +2,21 @@
 
 from __future__ import with_statement
 import os
-import subprocess # only used for Repo.cmd()
+import stat
+import time
+import heapq
+import threading
+import itertools
+import atexit
+import subprocess # only used for Repo.cmd() and CatFile
 import difflib
 
 from dulwich.repo import Repo as DulwichRepo
-from dulwich.objects import Blob, Commit, Tree
+from dulwich.objects import Blob, Commit, Tree, ShaFile, object_class
 from dulwich.errors import NotTreeError, NotBlobError
 
+from hopper.utils import to_json, from_json, LRUCache
+
 class Repo(object):
     """
     An abstraction layer on top of dulwich.repo.Repo for higher-level
@@ -29,9 +37,13 @@ class Repo(object):
     Should be considered a work-in-progress.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, cat_file=False):
         self.repo = DulwichRepo(path) # The inner Dulwich Repo object.
         self.root = path
+        # (see _object)
+        self.cat_file = None
+        if cat_file and git_available():
+            self.cat_file = _cat_file(self.repo._controldir)
 
     @classmethod
     def init(cls, path, mkdir=False, bare=False):
@@ -139,6 +151,7 @@ class Repo(object):
                     not self._file_in_tree(f)]
         else:
             adds = [f for f in adds if self._file_is_modified(f)]
+        self.stat_cache().save()
 
         # don't waste time with stage if empty list.
         if adds:
@@ -146,6 +159,55 @@ class Repo(object):
 
         return adds
 
+    def read_json(self, sha):
+        """
+        Return the parsed JSON content of a blob, e.g. an issue or comment
+        as it was in some commit.
+
+        Blobs never change, so each is parsed once and kept in an LRU cache
+        of the last ``JSON_CACHE_SIZE`` blobs, by SHA. Content that's the 
+        same in many commits is the same blob, so it's shared for free. The
+        result is shared too, so don't modify it.
+
+        :param sha: SHA of the blob.
+        """
+        data = _json_cache.get(sha)
+        if data is None:
+            data = from_json(self._object(sha).data)
+            _json_cache.set(sha, data)
+        return data
+
+    def stage(self, paths):
+        """
+        Stage exactly the given paths, without walking the working tree or
+        comparing files with HEAD (unlike ``add``). Files are added, and 
+        anything staged at (or under) a path that no longer exists is 
+        removed. Directories are added recursively.
+
+        :param paths: paths relative to the repository root.
+        :return: a tuple of two lists: the paths added and removed.
+        """
+        adds = []
+        removes = []
+        index = self.repo.open_index()
+        for path in paths:
+            full_path = os.path.join(self.root, path)
+            if os.path.isfile(full_path):
+                adds.append(path)
+            elif os.path.isdir(full_path):
+                adds.extend(_walk(full_path, self.root))
+            else:
+                prefix = path + os.sep
+                removes.extend(p for p in index 
+                               if p == path or p.startswith(prefix))
+        if removes:
+            for path in removes:
+                del index[path]
+            index.write()
+        if adds:
+            self.repo.stage(adds)
+        return adds, removes
+
     def branch(self, name=None, ref=None):
         """
         Create a new branch or display the current one. Equivalent to 
@@ -181,12 +243,14 @@ class Repo(object):
     def checkout(self, ref, path=None):
         """
         Checkout the entire tree (or a subset) of a commit given a branch, 
-        tag, or commit SHA.
+        tag, or commit SHA. HEAD isn't moved.
 
-        This is a fairly naive implementation. It will just write the blob data
-        recursively from the tree pointed at by the given reference, 
-        overwriting the working tree as necessary. It doesn't do deletions or 
-        renames.
+        Only the files that need it are touched: the target tree is diffed
+        against HEAD's (skipping identical sub-trees), and the working 
+        tree's own changes are found through the stat cache. Files that 
+        differ from the target are written, creating directories as 
+        needed, and files that aren't in it are removed (along with any 
+        directories left empty). Untracked files are left alone.
 
         If you wanted to checkout 'HEAD':
           >>> repo.checkout(repo.head())
@@ -200,26 +264,75 @@ class Repo(object):
         :param ref: branch, tag, or commit
         :param path: checkout only file or directory at path, should be
                      relative to the repo's root. 
-        :raises KeyError: if bad reference.
+        :raises KeyError: if bad reference, or the path isn't in its tree.
+        :return: the paths, relative to the repo's root, of the files that
+                 were written or removed.
         """
         sha = self._resolve_ref(ref)
-        obj = self.repo[sha]
-        tree = self.repo[obj.tree]
-
-        if tree is None:
-            raise KeyError('Bad reference: %s' % ref)
-        if path is None:
-            path = self.root
+        target = self._object(sha).tree
+        try:
+            base = self.head().tree
+        except NoHeadSet:
+            base = None
 
+        prefix = None
+        if path is not None:
+            prefix = os.path.relpath(os.path.join(self.root, path), self.root)
+            if prefix == os.curdir:
+                prefix = None
+        mode, target_sha = self._tree_entry(target, prefix)
+        if target_sha is None:
+            raise KeyError('Bad path: %s' % path)
+        wt_path = os.path.join(self.root, prefix) if prefix else self.root
+
+        # path -> SHA of the blob to write, or None to remove the file.
+        changes = {}
+        if not _is_tree(mode):
+            changes[prefix] = target_sha
         else:
-            # check if path and self.root are same
-            if not os.path.samefile(path, self.root):
-                # if not, we need the path's tree 
-                # (a sub-tree of the commit tree)
-                tree = self._obj_from_tree(tree, path)
-        
-        # write the tree
-        self._write_tree_to_wt(tree, path)
+            if os.path.isdir(wt_path):
+                base_mode, base_sha = self._tree_entry(base, prefix)
+                if not _is_tree(base_mode):
+                    base_sha = None
+            else:
+                # (nothing's there, so write it all)
+                base_sha = None
+            for fpath, old_sha, new_sha in self._tree_changes(
+                    base_sha, target_sha, prefix):
+                changes[fpath] = new_sha
+            # then undo any changes to the working tree.
+            for fpath, status in self._changes(wt_path):
+                if fpath in changes:
+                    continue
+                entry_mode, entry_sha = self._tree_entry(target, fpath)
+                if entry_sha is not None and not _is_tree(entry_mode):
+                    changes[fpath] = entry_sha
+                elif status != FILE_IS_NEW:
+                    changes[fpath] = None
+
+        cache = self.stat_cache()
+        touched = []
+        # removals first, in case a directory becomes a file.
+        for fpath, blob in sorted(changes.iteritems(), 
+                                  key=lambda c: (c[1] is not None, c[0])):
+            full_path = os.path.join(self.root, fpath)
+            if blob is None:
+                if os.path.isfile(full_path) or os.path.islink(full_path):
+                    os.remove(full_path)
+                    _remove_empty_dirs(os.path.dirname(full_path), self.root)
+                    touched.append(fpath)
+                continue
+            if os.path.isfile(full_path) and \
+                    cache.sha(self.root, fpath) == blob:
+                continue
+            parent = os.path.dirname(full_path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            with open(full_path, 'wb') as fp:
+                fp.write(self._object(blob).data)
+            touched.append(fpath)
+        cache.save()
+        return touched
 
     def cmd(self, cmd):
         """
@@ -283,7 +396,173 @@ class Repo(object):
         # return the Commit object (instead of the id, which is less useful).
         return self.repo[commit_id]
 
-    def commits(self, ref=None, n=10):
+    def commit_changes(self, changes, message, committer, author=None):
+        """
+        Commit a set of changes straight to HEAD, without going through the
+        index. Only the trees along the changed paths are rebuilt (starting
+        from HEAD's tree), so the cost depends on the number and depth of 
+        the changes rather than the size of the repository.
+
+        HEAD is advanced with a compare-and-swap. If another commit lands 
+        in the meantime, the changes are re-applied on top of it, up to 
+        ``COMMIT_RETRIES`` times before giving up with ``RefChanged``.
+
+        Once HEAD is advanced, the index entries for the changed paths are
+        updated to match the commit (see ``_update_index``), so ``git 
+        status`` in the repository stays clean.
+
+        :param changes: a dictionary (or list of tuples) that maps each 
+                        path, relative to the repository root, to the new
+                        content of the file, or to None to delete the file
+                        (or directory) at the path.
+        :param message: the commit message.
+        :param committer: the committer, e.g. ``'Name <email>'``.
+        :param author: the author, defaults to the committer.
+        :return: the Commit object.
+        """
+        if type(changes) is not dict:
+            changes = dict(changes)
+        # nest the changes by directory, e.g. {'a': {'b': 'content'}}
+        nested = {}
+        for path, content in changes.iteritems():
+            parts = path.strip(os.sep).split(os.sep)
+            level = nested
+            for part in parts[:-1]:
+                if type(level.get(part)) is not dict:
+                    level[part] = {}
+                level = level[part]
+            level[parts[-1]] = content
+
+        for attempt in range(COMMIT_RETRIES):
+            try:
+                parent = self.head()
+            except NoHeadSet:
+                parent = None
+            tree = self._update_tree(parent.tree if parent else None, 
+                                     nested)
+            if tree is None:
+                # (git has no empty trees, except at the root)
+                tree = Tree()
+                self.repo.object_store.add_object(tree)
+                tree = tree.id
+            commit = Commit()
+            commit.tree = tree
+            commit.parents = [parent.id] if parent else []
+            commit.committer = committer
+            commit.author = author or committer
+            commit.commit_time = commit.author_time = int(time.time())
+            commit.commit_timezone = commit.author_timezone = 0
+            commit.encoding = 'UTF-8'
+            commit.message = message
+            self.repo.object_store.add_object(commit)
+            if parent:
+                done = self.repo.refs.set_if_equals('HEAD', parent.id, 
+                                                    commit.id)
+            else:
+                done = self.repo.refs.add_if_new('HEAD', commit.id)
+            if done:
+                self._update_index(changes)
+                return commit
+        raise RefChanged('HEAD kept changing while committing')
+
+    def _update_index(self, changes):
+        """
+        Make the index match a commit made by ``commit_changes``, for the
+        changed paths only. Each file's entry gets the committed blob and
+        the stat of the file on disk, as long as the file's size matches
+        (otherwise the stat is zeroed, so git re-reads the file). Deleted
+        paths, and anything staged under them, are removed.
+
+        :param changes: the dictionary passed to ``commit_changes``.
+        """
+        index = self.repo.open_index()
+        for path, content in changes.iteritems():
+            path = path.strip(os.sep)
+            if content is None:
+                prefix = path + os.sep
+                for p in [p for p in index 
+                          if p == path or p.startswith(prefix)]:
+                    del index[p]
+                continue
+            sha = Blob.from_string(content).id
+            try:
+                st = os.lstat(os.path.join(self.root, path))
+            except OSError:
+                st = None
+            if st is not None and st.st_size == len(content):
+                index[path] = (st.st_ctime, st.st_mtime, st.st_dev, 
+                               st.st_ino, FILE_MODE, st.st_uid, st.st_gid,
+                               st.st_size, sha, 0)
+            else:
+                index[path] = (0, 0, 0, 0, FILE_MODE, 0, 0, 0, sha, 0)
+        index.write()
+
+    def changes(self, a, b=None, path=None):
+        """
+        Lazily yield a ``(path, status, old_sha, new_sha)`` tuple for each
+        file that differs between commits a and b, or between commit a and
+        the working tree. The status is ``FILE_IS_NEW``, 
+        ``FILE_IS_MODIFIED`` or ``FILE_IS_DELETED``, and the SHA of the 
+        missing side of a new or deleted file is None.
+
+        Between commits, the trees are walked side by side, and sub-trees 
+        whose SHAs match are skipped without being read, so the cost 
+        depends on the size of the change rather than the size of the 
+        trees. Against the working tree, only the files that differ 
+        between commit a and HEAD, or between HEAD and the working tree 
+        (found through the stat cache), are compared. Working tree SHAs 
+        may not be in the object store; ``patch`` reads those files 
+        instead.
+
+        :param a: a commit identifier.
+        :param b: a commit identifier. Defaults to the working tree.
+        :param path: a path to a file or directory to diff, relative
+                     to the repo root. Defaults to the entire tree.
+        """
+        prefix = None
+        if path is not None:
+            prefix = os.path.relpath(os.path.join(self.root, path), self.root)
+            if prefix == os.curdir:
+                prefix = None
+        old_tree = self._object(self._resolve_ref(a)).tree
+        old = self._tree_entry(old_tree, prefix)
+        if b is not None:
+            new = self._tree_entry(self._object(self._resolve_ref(b)).tree, 
+                                   prefix)
+            for change in self._entry_changes(old, new, prefix):
+                yield change
+            return
+
+        try:
+            head = self._tree_entry(self.head().tree, prefix)
+        except NoHeadSet:
+            head = (None, None)
+        wt_path = os.path.join(self.root, prefix) if prefix else self.root
+        # the paths that commit a and HEAD disagree on,
+        paths = set(c[0] for c in self._entry_changes(old, head, prefix))
+        # and the ones HEAD and the working tree do.
+        if os.path.exists(wt_path):
+            paths.update(fpath for fpath, status in self._changes(wt_path))
+        else:
+            paths.update(c[0] for c in self._entry_changes(head, (None, None),
+                                                           prefix))
+        cache = self.stat_cache()
+        try:
+            for fpath in sorted(paths):
+                mode, old_sha = self._tree_entry(old_tree, fpath)
+                if _is_tree(mode):
+                    old_sha = None
+                full_path = os.path.join(self.root, fpath)
+                new_sha = None
+                if os.path.isfile(full_path):
+                    new_sha = cache.sha(self.root, fpath)
+                if old_sha != new_sha:
+                    yield fpath, _change_status(old_sha, new_sha), \
+                            old_sha, new_sha
+        finally:
+            cache.save()
+
+    def commits(self, ref=None, n=10, after=None):
         """
         Return up to n-commits down from a ref (branch, tag, commit),
         or if no ref given, down from the HEAD.
@@ -291,10 +570,13 @@ class Repo(object):
         If you just want a single commit, it may be cleaner to use the
         ``object`` method.
 
+        Only the commits returned are read (see ``walk``).
+
         :param ref: a branch, tag (not yet), or commit SHA to use 
                           as a start point.
         :param n: the maximum number of commits to return. If fewer 
                   matching commits exist, only they will be returned.
+        :param after: a continuation token, see ``walk``.
 
         :return: a list of ``dulwich.objects.Commit`` objects.
 
@@ -310,23 +592,23 @@ class Repo(object):
           [<Commit 6336f47615da32d520a8d52223b9817ee50ca728>]
         """
 
-        start_point = self.head().id
-        if ref is not None:
-            start_point = self._resolve_ref(ref)
-        return self.repo.revision_history(start_point)[:n]
+        return list(itertools.islice(self.walk(ref, after), n))
 
     def diff(self, a, b=None, path=None):
         """
-        Return a diff of commits a and b.
+        Return a diff of commits a and b. A single file gets a context 
+        diff (see ``_diff_file``); otherwise each changed file gets a 
+        unified diff (see ``changes`` and ``patch``).
 
         :param a: a commit identifier.
-        :param b: a commit identifier. Defaults to HEAD.
+        :param b: a commit identifier. Defaults to the working tree.
         :param path: a path to a file or directory to diff, relative
                      to the repo root. Defaults to the entire tree.
         """
-        if not os.path.isfile(os.path.join(self.root, path)):
-            raise NotImplementedError('Specify a file path for now')
-        return self._diff_file(path, a, b)
+        if path is not None and \
+                os.path.isfile(os.path.join(self.root, path)):
+            return self._diff_file(path, a, b)
+        return '\n'.join(self.patch(c) for c in self.changes(a, b, path))
 
     def head(self):
         """Return the HEAD commit or raise an error."""
@@ -338,20 +620,131 @@ class Repo(object):
             # The HEAD will be missing before the repo is committed to.
             raise NoHeadSet
 
+    def is_ancestor(self, ancestor, ref=None):
+        """
+        Return True if the commit **ancestor** is reachable from **ref**.
+
+        The walk doesn't descend below the ancestor's commit time, so it
+        only has to read the commits made since then, not the whole history.
+
+        :param ancestor: a commit SHA.
+        :param ref: a branch, tag, or commit SHA. Defaults to HEAD.
+        """
+        try:
+            target = self._object(ancestor)
+        except KeyError:
+            return False
+        if type(target) is not Commit:
+            return False
+        start = self.head().id if ref is None else self._resolve_ref(ref)
+        pending = [start]
+        seen = set()
+        while pending:
+            sha = pending.pop()
+            if sha == target.id:
+                return True
+            if sha in seen:
+                continue
+            seen.add(sha)
+            commit = self._object(sha)
+            # (parents are never newer than their children, barring clock 
+            # skew)
+            if commit.commit_time >= target.commit_time:
+                pending.extend(commit.parents)
+        return False
+
     def is_dirty(self):
         """Return True if there are uncommitted changes to the repository."""
-        new, modified, deleted = self.status()
-        if new or modified or deleted:
+        for change in self._changes(self.root):
             return True
         return False
 
+    def is_bare(self):
+        """Return True if the repository has no working tree."""
+        return self.repo.bare
+
+    def loose_objects(self, estimate=False):
+        """
+        Return the number of loose (unpacked) objects.
+
+        :param estimate: if True, only count the objects in one of the 256
+                         fan-out directories and multiply, like ``git gc 
+                         --auto``. That's close enough for deciding when to
+                         pack, and doesn't list every directory.
+        """
+        root = self.repo.object_store.path
+        if estimate:
+            directory = os.path.join(root, '17')
+            if not os.path.isdir(directory):
+                return 0
+            return 256 * len([f for f in os.listdir(directory) 
+                              if len(f) == 38])
+        return len(list(self.repo.object_store._iter_loose_objects()))
+
     def object(self, sha):
         """
         Retrieve an object from the repository.
 
         :param sha: the 40-byte hex-rep of the object's SHA1 identifier.
         """
-        return self.repo[sha]
+        return self._object(sha)
+
+    def pack(self, all=False, prune=True):
+        """
+        Pack the loose objects into a new packfile (with its index), like
+        ``git repack``. Every commit writes a handful of loose objects, one
+        file each, which makes lookups and backups slower as they pile up.
+
+        :param all: if True, pack every object, including those already
+                    packed, into a single packfile, and remove the old 
+                    packs, like ``git repack -a -d``. All the objects are
+                    held in memory while the pack is written.
+        :param prune: remove the loose objects once they're packed.
+        :return: the number of objects packed.
+        """
+        store = self.repo.object_store
+        loose = list(store._iter_loose_objects())
+        old_packs = list(store.packs) if all else []
+        objects = {}
+        for pack in old_packs:
+            for obj in pack.iterobjects():
+                objects[obj.id] = obj
+        for sha in loose:
+            obj = store._get_loose_object(sha)
+            if obj is not None:
+                objects[sha] = obj
+        if not objects:
+            return 0
+        store.add_objects([(obj, None) for obj in objects.itervalues()])
+        if old_packs:
+            for pack in old_packs:
+                pack.close()
+                os.remove(pack._data_path)
+                os.remove(pack._idx_path)
+            # (so the pack list is re-read)
+            self.repo = DulwichRepo(self.repo.path)
+            store = self.repo.object_store
+        if prune:
+            for sha in loose:
+                # (only ever remove what's safely in a pack)
+                if store.contains_packed(sha):
+                    _remove_loose(store._get_shafile_path(sha))
+        return len(objects)
+
+    def patch(self, change, n=3):
+        """
+        Return a unified diff of a change, as yielded by ``changes``.
+
+        :param change: a ``(path, status, old_sha, new_sha)`` tuple.
+        :param n: the number of lines of context.
+        """
+        path, status, old_sha, new_sha = change
+        old = self._blob_data(old_sha, path).splitlines()
+        new = self._blob_data(new_sha, path).splitlines()
+        old_name = 'a/%s' % path if old_sha else '/dev/null'
+        new_name = 'b/%s' % path if new_sha else '/dev/null'
+        return '\n'.join(difflib.unified_diff(old, new, old_name, new_name, 
+                                              n=n, lineterm=''))
 
     def status(self, from_path=None):
         """
@@ -377,31 +770,13 @@ class Repo(object):
         changes['new'] = []
         changes['modified'] = []
         changes['deleted'] = []
-        
-        # path is a file
-        if os.path.isfile(path):
-            status = self._file_status(path)
+        for fpath, status in self._changes(path):
             if status == FILE_IS_NEW:
-                changes['new'].append(path)
+                changes['new'].append(fpath)
             elif status == FILE_IS_MODIFIED:
-                changes['modified'].append(path)
+                changes['modified'].append(fpath)
             elif status == FILE_IS_DELETED:
-                changes['deleted'].append(path)
-
-        # path is a directory
-        elif os.path.isdir(path):
-            for directory, dirnames, filenames in os.walk(path):
-                if '.git' in dirnames:
-                    dirnames.remove('.git')
-                for f in filenames:
-                    fpath = os.path.relpath(os.path.join(directory, f), self.root)
-                    status = self._file_status(fpath)
-                    if status == FILE_IS_NEW:
-                        changes['new'].append(fpath)
-                    elif status == FILE_IS_MODIFIED:
-                        changes['modified'].append(fpath)
-                    elif status == FILE_IS_DELETED:
-                        changes['deleted'].append(fpath)
+                changes['deleted'].append(fpath)
 
         return changes['new'], changes['modified'], changes['deleted']
 
@@ -432,12 +807,58 @@ class Repo(object):
         if sha is None:
             obj = self.repo[self.head().tree]
         else:
-            obj = self.repo[sha]
+            obj = self._object(sha)
         if type(obj) is Tree:
             return obj
         else:
             raise NotTreeError('Object is not a Tree')
 
+    def walk(self, ref=None, after=None):
+        """
+        Lazily yield the commits down from a ref (or HEAD), newest first.
+        Commits are read as they're yielded, so stopping after the first 
+        few doesn't walk the rest of the history.
+
+        :param ref: a branch, tag, or commit SHA to start from. 
+        :param after: a continuation token: the SHA of the last commit of 
+                      a previous walk. The walk resumes below it, from its
+                      parents, instead of starting over from **ref**. (For
+                      a linear history, like a tracker's, that's exactly 
+                      where the previous walk left off.)
+        :raises KeyError: (on the first step) if **after** isn't a commit.
+        """
+        if after is not None:
+            try:
+                after_commit = self._object(str(after))
+            except (KeyError, ValueError, TypeError):
+                after_commit = None
+            if type(after_commit) is not Commit:
+                raise KeyError('No such commit: %s' % after)
+            start = after_commit.parents
+        elif ref is not None:
+            start = [self._resolve_ref(ref)]
+        else:
+            try:
+                start = [self.head().id]
+            except NoHeadSet:
+                start = []
+        # a max-heap on commit time, like git log's default order.
+        pending = []
+        seen = set()
+        for sha in start:
+            seen.add(sha)
+            commit = self._object(sha)
+            heapq.heappush(pending, (-commit.commit_time, sha, commit))
+        while pending:
+            ctime, sha, commit = heapq.heappop(pending)
+            yield commit
+            for parent in commit.parents:
+                if parent not in seen:
+                    seen.add(parent)
+                    parent_commit = self._object(parent)
+                    heapq.heappush(pending, (-parent_commit.commit_time,
+                                             parent, parent_commit))
+
     def _file_status(self, path, ref=None):
         """
         Checks the status of a file in the working tree relative to a
@@ -456,7 +877,8 @@ class Repo(object):
         """
         full_path = os.path.join(self.root, path)
         in_work_tree = os.path.exists(full_path)
-        in_tree = self._file_in_tree(path)
+        blob = self._blob_sha(path)
+        in_tree = blob is not None
 
         # new
         if not in_tree and in_work_tree:
@@ -465,7 +887,8 @@ class Repo(object):
         elif in_tree and not in_work_tree:
             return FILE_IS_DELETED
         # modified
-        elif in_tree and in_work_tree and self._file_is_modified(path):
+        elif in_tree and in_work_tree and \
+                self.stat_cache().sha(self.root, path) != blob:
             return FILE_IS_MODIFIED
         # unchanged
         elif in_tree and in_work_tree:
@@ -488,26 +911,12 @@ class Repo(object):
         It assumes that the given path does exist. Just expect an OSError
         if it doesn't.
         """
-        # handle no head scenario when this gets called before first commit
-        try:
-            self.head()
-        except NoHeadSet:
-            return False
-
-        # get the tree
-        tree = self.repo[self.head().tree]
-        # get the blob from the tree
-        blob1 = self._obj_from_tree(tree, path)
-        if type(blob1) is not Blob:
+        blob = self._blob_sha(path)
+        if blob is None:
             return False
-
-        # make a second blob from the current file
-        with open(os.path.join(self.root, path), 'r') as fp:
-            blob2 = Blob.from_string(fp.read())
-        # are the two blobs equivalent? 
-        # if their contents are the same they should be...
-        # calls dulwich.objects.ShaFile.__eq__, which just compares SHAs
-        return blob1 != blob2
+        # the stat cache knows the file's SHA, unless it's changed since it
+        # was last hashed.
+        return self.stat_cache().sha(self.root, path) != blob
 
     def _file_in_tree(self, path, ref=None):
         """
@@ -517,17 +926,153 @@ class Repo(object):
         :param path: path to the file relative to the repository root.
         :param ref: optional ref to compare the WT with, default is HEAD.
         """
+        return self._blob_sha(path) is not None
+
+    def _object(self, sha):
+        """
+        Read an object from the repository, given its SHA.
+
+        If the Repo was created with **cat_file** and git is installed, 
+        objects are read through a long-lived ``git cat-file --batch`` 
+        process (see ``CatFile``), which is much faster than dulwich's 
+        pure-python decompression for bulk reads like history walks and 
+        mirror builds. If the process fails, we fall back to dulwich for 
+        good.
+
+        :param sha: the object's SHA.
+        :raises KeyError: if there's no such object.
+        """
+        # (anything but a hex SHA, e.g. a binary one, is left to dulwich)
+        if self.cat_file is not None and len(sha) == 40:
+            try:
+                found = self.cat_file.read(sha)
+            except (OSError, IOError):
+                self.cat_file = None
+            else:
+                if found is None:
+                    raise KeyError(sha)
+                type_name, data = found
+                type_num = object_class(type_name).type_num
+                return ShaFile.from_raw_string(type_num, data, sha)
+        return self.repo[sha]
+
+    def _blob_data(self, sha, path):
+        """
+        Return the data of a blob, read from the working tree file at the
+        path if it isn't in the object store, or '' if sha is None.
+        """
+        if sha is None:
+            return ''
+        try:
+            return self._object(sha).data
+        except KeyError:
+            with open(os.path.join(self.root, path), 'rb') as fp:
+                return fp.read()
+
+    def _blob_sha(self, path):
+        """
+        Return the SHA of the blob at the path in the HEAD commit's tree, or
+        None if there isn't one (or no HEAD).
+
+        :param path: path to the file relative to the repository root.
+        """
         # handle no head scenario when this gets called before first commit
         try:
-            self.head()
+            head = self.head()
         except NoHeadSet:
-            return False
+            return None
+        mode, sha = self._tree_entry(head.tree, path)
+        if _is_tree(mode):
+            return None
+        return sha
 
-        # get the tree
-        tree = self.repo[self.head().tree]
-        if self._obj_from_tree(tree, path) is not None:
-            return True
-        return False
+    def _changes(self, path):
+        """
+        Walk the working tree from the path, yielding a ``(path, status)`` 
+        tuple for each file that's new, modified or deleted relative to 
+        HEAD. See ``_file_status`` for the statuses.
+
+        Files are compared through the stat cache, so only the ones that 
+        were touched since they were last hashed are read.
+
+        :param path: an absolute path to a file or directory.
+        """
+        try:
+            head_tree = self.head().tree
+        except NoHeadSet:
+            head_tree = None
+        cache = self.stat_cache()
+        if os.path.isfile(path):
+            paths = [os.path.relpath(path, self.root)]
+            # (a single file only needs the trees along its path)
+            head = {paths[0]: self._tree_entry(head_tree, paths[0])}
+        else:
+            paths = _walk(path, self.root)
+            head = self._tree_paths(head_tree) if head_tree else {}
+        seen = set()
+        try:
+            for fpath in paths:
+                seen.add(fpath)
+                mode, sha = head.get(fpath, (None, None))
+                if mode is None or _is_tree(mode):
+                    yield fpath, FILE_IS_NEW
+                elif cache.sha(self.root, fpath) != sha:
+                    yield fpath, FILE_IS_MODIFIED
+        finally:
+            cache.save()
+        if not os.path.isdir(path):
+            return
+        # anything in HEAD's tree under the path that we didn't see is gone.
+        prefix = os.path.relpath(path, self.root) + os.sep
+        if prefix == os.curdir + os.sep:
+            prefix = ''
+        for fpath, (mode, sha) in sorted(head.iteritems()):
+            if fpath.startswith(prefix) and fpath not in seen and \
+                    not _is_tree(mode):
+                yield fpath, FILE_IS_DELETED
+
+    def _tree_paths(self, sha):
+        """
+        Return a dictionary that maps the path of every entry within a tree 
+        (recursively) to a ``(mode, sha)`` tuple.
+
+        Trees never change, so the dictionary is built once per tree SHA 
+        and kept in an LRU cache of the last ``TREE_CACHE_SIZE`` trees. It's
+        shared, so don't modify it.
+
+        :param sha: SHA of the tree.
+        """
+        paths = _tree_path_cache.get(sha)
+        if paths is None:
+            paths = {}
+            self._flatten_tree(sha, paths)
+            _tree_path_cache.set(sha, paths)
+        return paths
+
+    def _flatten_tree(self, sha, paths, path=None):
+        """
+        Walk a tree recursively, adding the ``(mode, sha)`` tuple of each 
+        entry to the dictionary by its path. (See ``_tree_paths``.)
+        """
+        for name, (mode, entry_sha) in self._tree_entries(sha).iteritems():
+            entry_path = os.path.join(path, name) if path else name
+            paths[entry_path] = (mode, entry_sha)
+            if _is_tree(mode):
+                self._flatten_tree(entry_sha, paths, entry_path)
+
+    def stat_cache(self):
+        """
+        Return the repository's ``StatCache``, which is kept in the git
+        directory and shared by every ``Repo`` in the process.
+        """
+        path = os.path.join(self.repo._controldir, 'hopper-stat-cache')
+        with _stat_caches_lock:
+            if path not in _stat_caches:
+                _stat_caches[path] = StatCache(path)
+        cache = _stat_caches[path]
+        # (another process may have saved it since)
+        cache.load()
+        return cache
 
     def _apply_to_tree(self, tree, f, path=None):
         """
@@ -549,8 +1094,8 @@ class Repo(object):
 
     def _obj_from_tree(self, tree, path):
         """
-        Walk a tree recursively to retrieve and return a blob or sub-tree 
-        from the given path, or return None if one does not exist.
+        Retrieve and return a blob or sub-tree from the given path within a
+        tree, or return None if one does not exist.
 
         :param tree: a dulwich.objects.Tree object.
         :param path: path relative to the repository root. 
@@ -563,31 +1108,149 @@ class Repo(object):
         """
         if type(tree) is not Tree:
             raise NotTreeError('Object is not a tree')
-        # remove trailing slashes from path (so basename doesn't return '')
-        if path[-1] == os.sep:
-            path = path[:-1]
+        # remove trailing slashes from path
+        path = path.rstrip(os.sep)
+        if not path:
+            return None
+        # (only the trees along the path are read)
+        mode, sha = self._tree_entry(tree.id, path)
+        if sha is None:
+            return None
+        return self.repo[sha]
 
-        # we need the head of the path, which is either the file itself or a
-        # directory.
-        head = path.split(os.sep)[0]
-        if len(head) > 1:
-            # clip head from path for recursion
-            new_path = os.sep.join(path.split(os.sep)[1:])
+    def _tree_changes(self, old, new, path=None):
+        """
+        Walk two trees side by side and yield a ``(path, old_sha, new_sha)``
+        tuple for each blob that differs between them. Sub-trees with
+        matching SHAs are skipped without being read, so the cost is 
+        proportional to the size of the change, not the size of the trees.
+
+        :param old: SHA of the old tree, or None if there isn't one (e.g.
+                    the directory was added).
+        :param new: SHA of the new tree, or None (e.g. it was deleted).
+        :param path: path of the trees relative to the repository root, 
+                     used to prefix the yielded paths.
+
+        The SHA of the missing side of an added or deleted blob is None.
+        """
+        if old == new:
+            return
+        old_entries = self._tree_entries(old)
+        new_entries = self._tree_entries(new)
+        for name in sorted(set(old_entries) | set(new_entries)):
+            old_mode, old_sha = old_entries.get(name, (None, None))
+            new_mode, new_sha = new_entries.get(name, (None, None))
+            if old_sha == new_sha:
+                continue
+            entry_path = os.path.join(path, name) if path else name
+            # recurse into either side that is a tree.
+            old_tree = old_sha if _is_tree(old_mode) else None
+            new_tree = new_sha if _is_tree(new_mode) else None
+            if old_tree or new_tree:
+                for change in self._tree_changes(old_tree, new_tree, 
+                                                 entry_path):
+                    yield change
+            # and yield either side that is a blob.
+            old_blob = old_sha if old_mode and not old_tree else None
+            new_blob = new_sha if new_mode and not new_tree else None
+            if old_blob or new_blob:
+                yield entry_path, old_blob, new_blob
+
+    def _entry_changes(self, old, new, path):
+        """
+        Yield a ``(path, status, old_sha, new_sha)`` tuple for each blob 
+        that differs between two tree entries, which may be trees, blobs 
+        or missing. (See ``changes``.)
+
+        :param old: the old entry's ``(mode, sha)`` tuple.
+        :param new: the new entry's ``(mode, sha)`` tuple.
+        :param path: the entries' path relative to the repository root, or
+                     None for the root trees.
+        """
+        old_mode, old_sha = old
+        new_mode, new_sha = new
+        old_tree = old_sha if _is_tree(old_mode) else None
+        new_tree = new_sha if _is_tree(new_mode) else None
+        for fpath, old_blob, new_blob in self._tree_changes(old_tree, 
+                                                            new_tree, path):
+            yield fpath, _change_status(old_blob, new_blob), old_blob, \
+                    new_blob
+        old_blob = old_sha if old_mode and not old_tree else None
+        new_blob = new_sha if new_mode and not new_tree else None
+        if old_blob != new_blob:
+            yield path, _change_status(old_blob, new_blob), old_blob, \
+                    new_blob
+
+    def _tree_entry(self, sha, path):
+        """
+        Return the ``(mode, sha)`` tuple of the entry at the path within a
+        tree, or ``(None, None)`` if there isn't one. Only the trees along
+        the path are read.
 
-        for entry in tree.iteritems():
-            # these are dulwich.objects.TreeEntry objects
-            if entry.path == head:
-                # get the Tree or Blob.
-                obj = self.repo[entry.sha]
-                # return if we're at the right path
-                if head == path:
-                    return obj
-                # otherwise recurse if it's a Tree
-                elif type(obj) is Tree:
-                    return self._obj_from_tree(obj, new_path)
-
-        # if we get here the path wasn't there.
-        return None
+        :param sha: SHA of the tree, or None.
+        :param path: a path relative to the tree, or None for the tree 
+                     itself.
+        """
+        if sha is None:
+            return None, None
+        mode, entry_sha = stat.S_IFDIR, sha
+        if not path:
+            return mode, entry_sha
+        for name in path.strip(os.sep).split(os.sep):
+            if not _is_tree(mode):
+                return None, None
+            mode, entry_sha = self._tree_entries(entry_sha).get(name, 
+                                                                (None, None))
+            if entry_sha is None:
+                return None, None
+        return mode, entry_sha
+
+    def _tree_entries(self, sha):
+        """
+        Return a dictionary that maps each entry name in the tree to a
+        ``(mode, sha)`` tuple, or an empty dictionary if sha is None.
+        """
+        if sha is None:
+            return {}
+        return dict((e.path, (e.mode, e.sha)) for e in 
+                    self._object(sha).iteritems())
+
+    def _update_tree(self, sha, changes):
+        """
+        Apply nested changes to a tree, writing the new blobs and trees to
+        the object store. Entries that aren't changed are reused as they 
+        are, so unchanged sub-trees are never read.
+
+        :param sha: SHA of the tree to start from, or None for an empty one.
+        :param changes: a dictionary that maps each entry name to its new 
+                        content, None to delete it, or a dictionary of the
+                        changes within a sub-tree. (See ``commit_changes``.)
+        :return: the new tree's SHA, or None if it ended up empty.
+        """
+        store = self.repo.object_store
+        entries = self._tree_entries(sha)
+        for name, change in changes.iteritems():
+            if type(change) is dict:
+                mode, entry_sha = entries.get(name, (None, None))
+                subtree = self._update_tree(
+                        entry_sha if _is_tree(mode) else None, change)
+                if subtree is None:
+                    entries.pop(name, None)
+                else:
+                    entries[name] = (stat.S_IFDIR, subtree)
+            elif change is None:
+                entries.pop(name, None)
+            else:
+                blob = Blob.from_string(change)
+                store.add_object(blob)
+                entries[name] = (FILE_MODE, blob.id)
+        if not entries:
+            return None
+        tree = Tree()
+        for name, (mode, entry_sha) in entries.iteritems():
+            tree[name] = (mode, entry_sha)
+        store.add_object(tree)
+        return tree.id
 
     def _write_tree_to_wt(self, tree, basepath):
         """
@@ -683,6 +1346,154 @@ class Repo(object):
         return '\n'.join(diff)
 
 
+class CatFile(object):
+    """
+    A long-lived ``git cat-file --batch`` process for reading a 
+    repository's objects. Each request is a SHA written to its stdin; the
+    object's type, size and content come back on its stdout. The process
+    is started on the first read and restarted (once per read) if it dies.
+
+    It's shared by every ``Repo`` in the process (see ``_cat_file``), so 
+    reads are serialized by a lock.
+
+    :param path: the repository's git directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.process = None
+        self.lock = threading.Lock()
+
+    def read(self, sha):
+        """
+        Return the ``(type_name, data)`` tuple of the object, or None if 
+        there's no such object.
+
+        :param sha: the object's SHA.
+        :raises OSError: if git can't be run.
+        :raises IOError: if the process keeps failing.
+        """
+        with self.lock:
+            for attempt in range(2):
+                if self.process is None or self.process.poll() is not None:
+                    self._start()
+                try:
+                    self.process.stdin.write(sha + '\n')
+                    self.process.stdin.flush()
+                    header = self.process.stdout.readline().split()
+                    if len(header) == 2 and header[1] == 'missing':
+                        return None
+                    if len(header) == 3:
+                        data = self.process.stdout.read(int(header[2]))
+                        # (and the trailing newline)
+                        self.process.stdout.read(1)
+                        return header[1], data
+                except IOError:
+                    pass
+                # it's gone wrong, so start over.
+                self.close()
+            raise IOError('git cat-file failed')
+
+    def close(self):
+        """Stop the process, if it's running."""
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.wait()
+            except (OSError, IOError):
+                pass
+            self.process = None
+
+    def _start(self):
+        """Start the process."""
+        with open(os.devnull, 'w') as devnull:
+            self.process = subprocess.Popen(
+                    ['git', '--git-dir', self.path, 'cat-file', '--batch'],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, 
+                    stderr=devnull, close_fds=True)
+
+
+class StatCache(object):
+    """
+    Remembers the SHA of each file in the working tree along with its 
+    mtime, size and inode. If a file's stat still matches, it hasn't 
+    changed, so we know its SHA without reading and hashing it. This 
+    makes checking the status of a clean working tree a stat-only pass.
+
+    :param path: the file the cache is read from and saved to.
+
+    Files modified within ``RACY_SECONDS`` of being hashed aren't 
+    cached, as a second change within the filesystem's timestamp 
+    resolution could go unnoticed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.changed = False
+        self.loaded = None
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """
+        (Re)read the cache file, if it's been written since we did and we
+        have no unsaved changes.
+        """
+        if self.changed:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime == self.loaded:
+            return
+        try:
+            with open(self.path, 'r') as fp:
+                self.entries = from_json(fp.read())
+        except ValueError:
+            # corrupt, so start over.
+            self.entries = {}
+        self.loaded = mtime
+
+    def save(self):
+        """Write the cache file, if any entries have changed."""
+        with self.lock:
+            if not self.changed:
+                return
+            tmp = '%s.%d' % (self.path, os.getpid())
+            with open(tmp, 'w') as fp:
+                fp.write(to_json(self.entries, indent=None))
+            os.rename(tmp, self.path)
+            self.loaded = os.stat(self.path).st_mtime
+            self.changed = False
+
+    def sha(self, root, path):
+        """
+        Return the blob SHA of the file, hashing it only if its stat 
+        doesn't match the cache.
+
+        :param root: the working tree's root.
+        :param path: path to the file relative to **root**.
+        """
+        full_path = os.path.join(root, path)
+        st = os.lstat(full_path)
+        key = [st.st_mtime, st.st_size, st.st_ino]
+        entry = self.entries.get(path)
+        if entry is not None and entry[:3] == key:
+            return entry[3]
+        with open(full_path, 'rb') as fp:
+            sha = Blob.from_string(fp.read()).id
+        with self.lock:
+            if time.time() - st.st_mtime > RACY_SECONDS:
+                self.entries[path] = key + [sha]
+                self.changed = True
+            elif path in self.entries:
+                del self.entries[path]
+                self.changed = True
+        return sha
+
+
 ### Constants
 
 FILE_IS_UNCHANGED = 0
@@ -690,9 +1501,66 @@ FILE_IS_NEW       = 1
 FILE_IS_MODIFIED  = 2
 FILE_IS_DELETED   = 3
 
+RACY_SECONDS = 2
+
+# Mode of the blobs written by Repo.commit_changes.
+FILE_MODE = 0100644
+
+COMMIT_RETRIES = 5
+
+TREE_CACHE_SIZE = 16
+
+JSON_CACHE_SIZE = 10000
+
+# Flattened trees, keyed by tree SHA. (See Repo._tree_paths.)
+_tree_path_cache = LRUCache(TREE_CACHE_SIZE)
+
+# Parsed JSON blobs, keyed by blob SHA. (See Repo.read_json.)
+_json_cache = LRUCache(JSON_CACHE_SIZE)
+
+# CatFile objects, keyed by git directory. (See Repo._object.)
+_cat_files = {}
+_cat_files_lock = threading.Lock()
+
+# Whether the git binary can be run. (See git_available.)
+_git_available = []
+
+# StatCache objects, keyed by path. (See Repo.stat_cache.)
+_stat_caches = {}
+_stat_caches_lock = threading.Lock()
+
 
 ### Utilities
 
+def git_available():
+    """Return True if the git binary is installed. Checked once."""
+    if not _git_available:
+        try:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.call(['git', '--version'], stdout=devnull, 
+                                stderr=devnull)
+            _git_available.append(True)
+        except OSError:
+            _git_available.append(False)
+    return _git_available[0]
+
+
+def _cat_file(path):
+    """Return the shared ``CatFile`` for the git directory at the path."""
+    with _cat_files_lock:
+        if path not in _cat_files:
+            _cat_files[path] = CatFile(path)
+        return _cat_files[path]
+
+
+def _close_cat_files():
+    """Stop every ``CatFile`` process, at exit."""
+    for cat_file in _cat_files.values():
+        cat_file.close()
+
+atexit.register(_close_cat_files)
+
+
 def _expand_branch_name(shortname):
     """Expand branch name"""
     return _expand_ref('heads', shortname)
@@ -703,6 +1571,56 @@ def _expand_tag_name(shortname):
     return _expand_ref('tags', shortname)
 
 
+def _walk(path, root):
+    """
+    Yield the path of each file under the directory, relative to root,
+    skipping any ``.git`` directories.
+    """
+    for directory, dirnames, filenames in os.walk(path):
+        if '.git' in dirnames:
+            dirnames.remove('.git')
+        for f in filenames:
+            yield os.path.relpath(os.path.join(directory, f), root)
+
+
+def _remove_loose(path):
+    """
+    Remove a loose object file, and its fan-out directory if that's left
+    empty.
+    """
+    os.remove(path)
+    try:
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        # not empty
+        pass
+
+
+def _change_status(old_sha, new_sha):
+    """Return the status of a file, given its old and new SHAs."""
+    if old_sha is None:
+        return FILE_IS_NEW
+    if new_sha is None:
+        return FILE_IS_DELETED
+    return FILE_IS_MODIFIED
+
+
+def _remove_empty_dirs(path, root):
+    """Remove the directory, and then its parents, while they're empty."""
+    while path != root and path.startswith(root):
+        try:
+            os.rmdir(path)
+        except OSError:
+            # not empty (or already gone)
+            return
+        path = os.path.dirname(path)
+
+
+def _is_tree(mode):
+    """Return True if the tree entry mode is that of a sub-tree."""
+    return mode is not None and stat.S_ISDIR(mode)
+
+
 def _expand_ref(ref_type, shortname):
     """Expand ref shorthand into full name"""
     if shortname.startswith('refs/'):
@@ -720,3 +1638,7 @@ class NoHeadSet(Exception):
 
 class NothingToCommit(Exception):
     """No changes to the tree."""
+
+
+class RefChanged(Exception):
+    """A ref changed before it could be updated."""
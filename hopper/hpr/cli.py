@@ -61,12 +61,37 @@ def main(args=sys.argv[1:]):
             help='use the given editor')
     commentp.set_defaults(func=comment)
 
+    # `commit` subcommand
+    commitp = subparsers.add_parser('commit', 
+            help='Commit changes to the tracker')
+    commitp.add_argument('-m', '--message', action='store',
+            help='use the given commit message')
+    commitp.add_argument('--scan', action='store_true',
+            help='look for changes in every file, not just the ones \
+                  Hopper wrote')
+    commitp.set_defaults(func=commit)
+
     # `edit` subcommand
     editp = subparsers.add_parser('edit', help='Edit an existing issue')
     editp.add_argument('issue', help='an issue id (the first 4 chars is usually enough)')
     editp.add_argument('-e', '--editor', action='store', help='use the given editor')
     editp.set_defaults(func=edit)
 
+    # `gc` subcommand
+    gcp = subparsers.add_parser('gc', 
+            help='Pack the tracker repository\'s loose objects')
+    gcp.add_argument('-a', '--all', action='store_true',
+            help='repack everything into a single pack')
+    gcp.set_defaults(func=gc)
+
+    # `layout` subcommand
+    layoutp = subparsers.add_parser('layout', 
+            help='Move the issues into the flat or sharded layout')
+    layoutp.add_argument('layout', choices=['flat', 'sharded'],
+            help='sharded keeps issues in issues/ab/cdef..., for large \
+                  trackers')
+    layoutp.set_defaults(func=layout)
+
     # `list` subcommand
     listp = subparsers.add_parser('list', 
             help='List the (filtered) set of issues')
@@ -185,6 +210,33 @@ def comment(args):
         print 'Posted comment %s on issue %s' % (c.id[:3], i.id[:6])
 
 
+def commit(args):
+    """Commit changes to the tracker."""
+    t = args['tracker']
+    config = UserConfig()
+    message = args['message'] or 'Updated the tracker'
+    c = t.autocommit(message=message, author=config.user, scan=args['scan'])
+    print 'Committed %s' % c.id[:7]
+
+
+def gc(args):
+    """Pack the tracker repository's loose objects."""
+    t = args['tracker']
+    n = t.repo.pack(all=args['all'])
+    print 'Packed %d objects' % n
+
+
+def layout(args):
+    """Move the issues into the flat or sharded layout."""
+    t = args['tracker']
+    config = UserConfig()
+    n = t.set_layout(sharded=args['layout'] == 'sharded')
+    if config.core['autocommit']:
+        t.autocommit(message='Moved %d issues to the %s layout' % \
+                             (n, args['layout']), author=config.user)
+    print 'Moved %d issues' % n
+
+
 def reopen(args):
     """Reopen a closed issue."""
     t = args['tracker']
@@ -256,6 +308,7 @@ def list_(args):
             print '%s %s' % (c.decorate('red', i.id[:6]), i.title)
     # normal mode
     else:
+        comment_counts = query.comment_counts([i.id for i in issues])
         for i in issues:
             print '%s %s' % (c.decorate('red', 'issue'), i.id)
             print '%s  %s <%s>' % (c.decorate('yellow', 'Author:'), 
@@ -268,7 +321,7 @@ def list_(args):
                                  relative_time(i.updated))
             print '%s  %s' % (c.decorate('yellow', 'Status:'), i.status)
             
-            num_comments = len(i.comments())
+            num_comments = comment_counts.get(i.id, 0)
             if num_comments:
                 print '%d Comments' % num_comments
             print
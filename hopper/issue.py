@@ -1,12 +1,13 @@
 from __future__ import with_statement
 import time
 import os
+import copy
 import shutil
-import glob
 
+from hopper import journal
 from hopper.files import BaseFile, JSONFile
 from hopper.comment import Comment
-from hopper.utils import to_json, get_hash
+from hopper.utils import to_json, from_json, get_hash
 from hopper.errors import BadReference, AmbiguousReference
 
 class Issue(JSONFile):
@@ -45,6 +46,8 @@ class Issue(JSONFile):
                     }
                 }
         self.tracker = tracker
+        # the commit a revision was read from (see revision).
+        self.commit = None
         if id is not None:
             self.id = self._resolve_id(id)
             self._set_paths()
@@ -61,7 +64,10 @@ class Issue(JSONFile):
         return '<Issue %s>' % self.id[:6]
 
     def comments(self, n=None):
-        comments = [Comment(self, sha) for sha in self._get_comments()]
+        if self.commit is not None:
+            comments = self._revision_comments()
+        else:
+            comments = [Comment(self, sha) for sha in self._get_comments()]
         comments.sort(key=lambda x: x.timestamp)
         if n:
             return comments[:n]
@@ -86,9 +92,9 @@ class Issue(JSONFile):
             # set the paths now that we have an id
             self._set_paths()
         
-        # Make the parent directory if it doesn't exist.
+        # Make the parent directory (and its shard) if it doesn't exist.
         if not os.path.isdir(self.paths['root']):
-            os.mkdir(self.paths['root'])
+            os.makedirs(self.paths['root'])
         # Make the comments dir if it doesn't exist.
         if not os.path.isdir(self.paths['comments']):
             os.mkdir(self.paths['comments'])
@@ -109,34 +115,91 @@ class Issue(JSONFile):
         if not hasattr(self, 'id'):
             raise BadReference('No matching issue on disk')
         shutil.rmtree(self.paths['root'])
+        journal.record(self.paths['root'])
 
-    @classmethod
-    def revision(cls, ref=None):
+    def history(self, n=None):
         """
-        Return an Issue object, representing the issue as it was in the 
-        commit referenced by the given ref. The implementation will read 
-        the file from its blob in the commit's tree. 
+        Return the commits that changed the issue, newest first, from the
+        tracker's activity index (see ``Activity.history``).
 
-        It would be better to do a checkout, but this could be used to 
-        rollback the issue, just by calling save and committing.
+        :param n: the number of commits to return. Defaults to all.
+        """
+        if not hasattr(self, 'id'):
+            raise BadReference('No matching issue on disk')
+        return self.tracker.activity().history(self.id, n)
+
+    def revision(self, ref=None):
+        """
+        Return an Issue object, representing the issue as it was in the 
+        commit referenced by the given ref. The issue and its comments are
+        read from their blobs in the commit's tree, without a checkout; 
+        parsed blobs are cached by SHA (see ``Repo.read_json``), so looking
+        through an issue's history only parses the versions that changed.
 
-        NOTE that it's not doing anything with the comments. Still working
-        on how that should function. 
+        The revision's ``comments`` method returns the comments as they 
+        were in the commit. It could be used to rollback the issue, just by
+        calling save and committing, but ``revert`` brings the comments 
+        back too.
 
-        :param ref: a commit ref.
+        :param ref: a commit ref. Defaults to HEAD.
         :return: an Issue object.
+        :raises BadReference: if the issue isn't in the commit.
         """
-        # TODO
-        raise NotImplementedError
+        if not hasattr(self, 'id'):
+            raise BadReference('No matching issue on disk')
+        repo = self.tracker.repo
+        commit = repo._resolve_ref(ref or 'HEAD')
+        files = self._revision_files(commit)
+        if 'issue' not in files:
+            raise BadReference('No matching issue in %s' % commit[:7])
+        issue = Issue(self.tracker)
+        issue.fields = dict(issue.fields.items() + 
+                            copy.deepcopy(repo.read_json(files['issue']))
+                            .items())
+        issue.id = self.id
+        issue.commit = commit
+        issue._set_paths()
+        return issue
 
     def revert(self, ref=None):
         """
-        Does a checkout of the issue directory at the commit pointed to by
-        the given ref.  After that, it will update its `fields` attribute to
-        reflect any changes. Any Comment objects will need to be reinitialized. 
+        Restore the issue directory to how it was at the commit pointed to
+        by the given ref (see ``Repo.checkout``). Only the files that differ
+        are written, and comments made since are removed. After that, it 
+        will update its `fields` attribute to reflect any changes. Any 
+        Comment objects will need to be reinitialized. 
+
+        The changes are left for the next autocommit.
+
+        :param ref: a commit ref. Defaults to HEAD.
+        :return: the paths (relative to the tracker) that were changed.
+        :raises BadReference: if the issue isn't in the commit.
         """
-        # TODO
-        raise NotImplementedError
+        if not hasattr(self, 'id'):
+            raise BadReference('No matching issue on disk')
+        root = self.tracker.paths['root']
+        repo = self.tracker.repo
+        try:
+            commit = repo._resolve_ref(ref or 'HEAD')
+        except KeyError:
+            raise BadReference('No matching commit: %s' % ref)
+        path, sha = self._revision_dir(commit)
+        if sha is None:
+            raise BadReference('No matching issue in %s' % commit[:7])
+        changed = repo.checkout(commit, path)
+        current = os.path.relpath(self.paths['root'], root)
+        if current != path and os.path.isdir(self.paths['root']):
+            # it's in the other layout now (see Tracker.set_layout)
+            changed.extend(os.path.relpath(os.path.join(d, f), root) 
+                           for d, dirnames, filenames in 
+                           os.walk(self.paths['root']) for f in filenames)
+            shutil.rmtree(self.paths['root'])
+            self._set_paths()
+        if changed:
+            journal.Journal(root).record(*changed)
+            self.tracker.db.apply_paths(changed)
+        self.from_file(self.paths['issue'])
+        return changed
 
     def get_comment_path(self, sha):
         """Get the path to the comment with the given SHA."""
@@ -150,6 +213,62 @@ class Issue(JSONFile):
             raise BadReference('No matching issue on disk')
         return filter(lambda x: len(x) == 40, os.listdir(self.paths['comments']))
 
+    def _revision_comments(self):
+        """Return the comments of a revision, read from its commit."""
+        repo = self.tracker.repo
+        comments = []
+        for name, sha in self._revision_files(self.commit).iteritems():
+            parts = name.split(os.sep)
+            if parts[0] != 'comments' or len(parts) != 2 or \
+                    len(parts[1]) != 40:
+                continue
+            comment = Comment(self)
+            comment.fields = dict(comment.fields.items() + 
+                                  copy.deepcopy(repo.read_json(sha)).items())
+            comment.id = parts[1]
+            comments.append(comment)
+        return comments
+
+    def _revision_dir(self, commit):
+        """
+        Return the path of the issue's directory in the commit, relative 
+        to the tracker root, and its tree SHA. It's looked for in both 
+        layouts, as the commit may be from before a ``Tracker.set_layout``.
+        The SHA is None if the issue isn't in the commit.
+
+        :param commit: a commit SHA.
+        """
+        repo = self.tracker.repo
+        tree = repo.object(commit).tree
+        dirs = self.tracker.get_issue_dirs(self.id)
+        for path in dirs:
+            mode, sha = repo._tree_entry(tree, path)
+            if sha is not None:
+                return path, sha
+        return dirs[0], None
+
+    def _revision_files(self, commit):
+        """
+        Return a dictionary that maps the path of each file in the issue's
+        directory (e.g. ``issue`` or ``comments/<sha>``), as it was in the
+        commit, to its blob SHA. Only the trees along the way are read.
+
+        :param commit: a commit SHA.
+        """
+        repo = self.tracker.repo
+        path, sha = self._revision_dir(commit)
+        files = {}
+        if sha is None:
+            return files
+        for name, (mode, entry_sha) in repo._tree_entries(sha).iteritems():
+            if name == 'comments':
+                for cname, (cmode, csha) in \
+                        repo._tree_entries(entry_sha).iteritems():
+                    files[os.path.join(name, cname)] = csha
+            else:
+                files[name] = entry_sha
+        return files
+
     def _resolve_id(self, id):
         """Resolve partial ids and verify the issue exists."""
         if len(id) == 40:
@@ -157,8 +276,8 @@ class Issue(JSONFile):
                 return id
             else:
                 raise BadReference('No matching issue on disk: %s' % id)
-        # glob the path returned by the tracker helper method
-        matches = glob.glob(self.tracker.get_issue_path(id + '*'))
+        # glob the issue paths, in either layout
+        matches = self.tracker._match_issues(id)
         # no matches, raise bad ref:
         if not matches:
             raise BadReference('No matching issue on disk: %s' % id)
@@ -166,26 +285,73 @@ class Issue(JSONFile):
         if len(matches) > 1:
             raise AmbiguousReference('Multiple issues matched that id fragment')
         # one match, return the match
-        head = os.path.split(matches[0])[0]
-        match_id = os.path.split(head)[1]
-        return match_id
+        return matches[0]
 
     def _set_paths(self):
         """
         Set paths inside the issue.
 
         Issue data and comments are stored in a directory named after the
-        issue's SHA. 
+        issue's SHA (see ``Tracker.get_issue_path`` for the layouts).
         """
         paths = {}
-        tpaths = self.tracker.paths
-        # path to the issue directory
-        paths['root'] = os.path.join(tpaths['issues'], self.id)
         # path to the file that holds the issue itself.
         paths['issue'] = self.tracker.get_issue_path(self.id)
+        # path to the issue directory
+        paths['root'] = os.path.dirname(paths['issue'])
         # path to the issue's comments directory.
-        paths['comments'] = os.path.join(tpaths['issues'], self.id, 'comments')
+        paths['comments'] = os.path.join(paths['root'], 'comments')
         # create the comments dir if missing and the root path exists
         if not os.path.exists(paths['comments']) and os.path.exists(paths['root']):
             os.mkdir(paths['comments'])
         self.paths = paths
+
+
+class IssueRecord(BaseFile):
+    """
+    A read-only issue, built from a row in the tracker's SQLite mirror 
+    rather than from the flat-file database. Queries return IssueRecords, 
+    so listing issues never has to open a file.
+
+    Records have the same fields as Issue objects, with the same attribute 
+    access. They can't be saved; to change the issue, load the real thing 
+    with the ``issue`` method.
+
+    :param tracker: a Tracker object.
+    :param row: a row from the database's ``issues`` table.
+    """
+
+    def __init__(self, tracker, row):
+        self.fields = {
+                'title'  : row['title'],
+                'status' : row['status'],
+                'labels' : from_json(row['labels']) if row['labels'] else [],
+                'content': row['content'],
+                'created': row['created'],
+                'updated': row['updated'],
+                'author' : {
+                    'name'  : row['author_name'],
+                    'email' : row['author_email'],
+                    'avatar': row['author_avatar'],
+                    }
+                }
+        self.tracker = tracker
+        self.id = row['id']
+        super(BaseFile, self).__init__()
+
+    def __eq__(self, other):
+        return True if self.id == other.id else False
+
+    def __ne__(self, other):
+        return True if self.id != other.id else False
+
+    def __repr__(self):
+        return '<IssueRecord %s>' % self.id[:6]
+
+    def comments(self, n=None):
+        """Return the issue's comments, as CommentRecords, from the mirror."""
+        return self.tracker.query().comments(self.id, n)
+
+    def issue(self):
+        """Load and return the full Issue object, e.g. to modify it."""
+        return Issue(self.tracker, self.id)
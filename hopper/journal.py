@@ -0,0 +1,154 @@
+"""Records the files written to a tracker, so commits can skip the scan."""
+
+from __future__ import with_statement
+import os
+import threading
+
+# Held while the journal is appended to or taken, along with its lock file
+# (which keeps out other processes).
+_lock = threading.Lock()
+
+# The paths each thread has recorded, keyed by tracker root. (See 
+# ``Journal.recorded``.)
+_local = threading.local()
+
+class Journal(object):
+    """
+    A per-tracker list of the paths that have been written or deleted
+    since the last commit. It lets ``Tracker.autocommit`` stage exactly
+    those paths, instead of walking the whole tracker looking for changes.
+
+    The journal is a plain file in ``.hopper/cache``, with one path
+    (relative to the tracker root) per line, so the web app and the CLI
+    can share it. It's locked (see ``hopper.files.LockedFile``) while 
+    lines are appended or taken, so no append can land in between a take's
+    read and its truncation.
+
+    :param root: the path to the tracker.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.path = os.path.join(self.root, '.hopper', 'cache', 'JOURNAL')
+
+    def record(self, *paths):
+        """
+        Add the paths to the journal.
+
+        :param \*paths: absolute paths, or paths relative to the tracker
+                        root, of files or directories.
+        """
+        lines = [os.path.relpath(os.path.join(self.root, p), self.root)
+                 for p in paths]
+        self._append(lines)
+        _thread_paths().setdefault(self.root, []).extend(lines)
+
+    def recorded(self):
+        """
+        Return the paths that the calling thread has recorded since it last
+        asked (whether or not they've been committed since), and forget 
+        them. A grouped autocommit (see ``CommitGroup``) commits just the
+        paths of its actions, so each write is credited to the action that
+        made it.
+        """
+        return _unique(_thread_paths().pop(self.root, []))
+
+    def paths(self):
+        """Return the unique paths in the journal, in recorded order."""
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'r') as fp:
+            return _unique(fp.read().splitlines())
+
+    def take(self, only=None):
+        """
+        Empty the journal and return its paths. Paths recorded meanwhile
+        wait for the lock, and are kept for next time.
+
+        If **only** is given, just those paths are taken (and returned, 
+        whether or not they were in the journal), and the rest are put 
+        back.
+
+        If the commit the paths were taken for fails, give them back with
+        ``record``.
+        """
+        if only is not None:
+            only = _unique(only)
+        if not os.path.exists(self.path):
+            # nothing recorded
+            return only if only is not None else []
+        # (hopper.files imports this module)
+        from hopper.files import lock
+        with _lock:
+            with lock(self.path, 'r+') as fp:
+                paths = _unique(fp.read().splitlines())
+                rest = []
+                if only is not None:
+                    taken = set(only)
+                    rest = [p for p in paths if p not in taken]
+                    paths = only
+                fp.seek(0)
+                fp.truncate()
+                fp.write(''.join(l + '\n' for l in rest))
+        return paths
+
+    def _append(self, lines):
+        """Append the lines (paths relative to the root) to the journal."""
+        if not lines:
+            return
+        parent = os.path.dirname(self.path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        from hopper.files import lock
+        with _lock:
+            with lock(self.path, 'a') as fp:
+                fp.write(''.join(l + '\n' for l in lines))
+
+
+def record(path):
+    """
+    Add the path to the journal of the tracker it's in. Does nothing if
+    it's not in a tracker (e.g. the user config).
+
+    :param path: the path to a file or directory, absolute or relative
+                 to the current directory.
+    """
+    root = find_root(path)
+    if root is not None:
+        Journal(root).record(os.path.abspath(path))
+
+
+def find_root(path):
+    """
+    Return the root of the tracker (the nearest directory up with a
+    ``.hopper`` directory) that the path is in, or None.
+
+    :param path: the path to a file or directory.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    while True:
+        if os.path.isdir(os.path.join(directory, '.hopper')):
+            return directory
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+def _thread_paths():
+    """Return the calling thread's recorded paths, by tracker root."""
+    paths = getattr(_local, 'paths', None)
+    if paths is None:
+        paths = _local.paths = {}
+    return paths
+
+
+def _unique(paths):
+    """Return the non-empty paths without duplicates, in order."""
+    seen = set()
+    unique = []
+    for path in paths:
+        if path and path not in seen:
+            seen.add(path)
+            unique.append(path)
+    return unique
@@ -1,8 +1,13 @@
 """Run queries on an issue database"""
 
+import base64
+
 from hopper.database import Database
-from hopper.issue import Issue
-from sqlalchemy.sql import asc, desc
+from hopper.issue import Issue, IssueRecord
+from hopper.comment import CommentRecord
+from hopper.utils import to_json, from_json
+from hopper.errors import BadCursor
+from sqlalchemy.sql import asc, desc, select, func, and_, or_
 
 class Query(object):
     """
@@ -10,6 +15,10 @@ class Query(object):
     Queries are performed against either the SQLite db or the JSON file db,
     depending on availability and performance. 
 
+    Results from the SQLite db are returned as read-only IssueRecord objects,
+    built straight from the rows. Use their ``issue`` method to load the 
+    full Issue when it needs to be modified.
+
     :param tracker: Tracker object to perform queries on.
     """
     def __init__(self, tracker):
@@ -20,32 +29,70 @@ class Query(object):
             self.table = self.db.issues
 
     def select(self, order_by='updated', status=None, label=None, limit=None, 
-               offset=None, reverse=True):
+               offset=None, reverse=True, labels=None, match='all', 
+               cursor=None):
         """
         Return issues, with options to limit, offset, sort, and filter the result set.
 
         :param order_by: order the results by this column.
         :param status: return results with this status.
+        :param label: return results with this label.
         :param limit: maximum number of results to return.
         :param offset: skip the first n-results. 
         :param reverse: results are returned in ascending order if True, 
                         descending if False.
+        :param labels: return results with these labels (a list). Combined 
+                       with **label**, if both are given.
+        :param match: ``'all'`` to return results that have every one of the
+                      labels, ``'any'`` for results with at least one.
+        :param cursor: return the results that come after the issue this 
+                       cursor was made from (see the ``cursor`` method).
+                       Unlike an offset, the rows before it don't have to
+                       be walked, so deep pages cost the same as the first.
+        :raises BadCursor: if the cursor wasn't made for this ordering and
+                           direction.
         """ 
+        labels = _label_list(label, labels)
+        if cursor is not None:
+            value, id = _decode_cursor(cursor, order_by, reverse)
         if order_by == 'updated' or order_by == 'created':
             # Time is stored as float, so they sort in reverse of what we want.
             reverse = not reverse
         if self.has_db:
             order = asc if reverse else desc
-            query = self.db.select(order_by=order(order_by), limit=limit, offset=offset)
-            if status:
-                query = query.where(self.table.c.status == status)
-            if label:
-                query = query.where(self.table.c.labels.like('%' + label + '%'))
+            column = self._order_column(order_by)
+            # ties are broken by id, so every issue has a unique position.
+            query = self.db.select(order_by=[order(column), 
+                                             order(self.table.c.id)], 
+                                   limit=limit, offset=offset)
+            query = self._filter(query, status, labels, match)
+            if cursor is not None:
+                if reverse:
+                    after = or_(column > value, 
+                                and_(column == value, self.table.c.id > id))
+                else:
+                    after = or_(column < value, 
+                                and_(column == value, self.table.c.id < id))
+                query = query.where(after)
             rows = query.execute()
-            issues = [Issue(self.tracker, r['id']) for r in rows]
+            issues = [IssueRecord(self.tracker, r) for r in rows]
         else:
             issues = [Issue(self.tracker, sha) for sha in self.tracker._get_issue_shas()]
-            issues.sort(key=lambda x: getattr(x, order_by), reverse=reverse)
+            if status:
+                issues = [i for i in issues if i.status == status]
+            if labels:
+                test = all if match == 'all' else any
+                issues = [i for i in issues if 
+                          test(l in [il.strip() for il in i.labels] 
+                               for l in labels)]
+            # (in the same order as the database, ties broken by id)
+            key = lambda x: (_sort_value(x, order_by), x.id)
+            issues.sort(key=key, reverse=not reverse)
+            if cursor is not None:
+                if reverse:
+                    issues = [i for i in issues if key(i) > (value, id)]
+                else:
+                    issues = [i for i in issues if key(i) < (value, id)]
             offset = 0 if offset is None else offset
             if limit is not None:
                 issues = issues[offset:(offset + limit)]
@@ -53,36 +100,259 @@ class Query(object):
                 issues = issues[offset:]
         return issues
 
+    def cursor(self, issue, order_by='updated', reverse=True):
+        """
+        Return an opaque cursor for the position of an issue in results 
+        ordered by **order_by**, in the direction given by **reverse**. 
+        Pass it to ``select``, with the same ordering and direction, to get
+        the page of results that follows the issue.
+
+        :param issue: an Issue or IssueRecord, usually the last result of
+                      the current page.
+        :param order_by: the ordering used for the current page.
+        :param reverse: the direction used for the current page (see 
+                        ``select``).
+        """
+        return _encode_cursor(order_by, reverse, _sort_value(issue, order_by),
+                              issue.id)
+
     def search(self, sstr, status=None, n=20):
         """
         Return issues whose title, content, or comments contain the search
         string.
+
+        When the database has a full-text index, results are ranked with
+        bm25 (title matches count the most). Otherwise, we fall back to a
+        ``LIKE`` scan, which returns results in no particular order.
         
         :param sstr: search string, the string to query the database for.
         :param status: if not None, search only issues with the given status.
         :param n: the number of issues.
         """
         if self.has_db:
-            sstr = '%' + sstr + '%'
-            rows = self.db.conn.execute("""SELECT * FROM issues WHERE
-                                               title    LIKE ? OR
-                                               content  LIKE ? OR
-                                               comments LIKE ?
-                                        """, (sstr, sstr, sstr))
-            rows = rows.fetchmany(n)
-            return [Issue(self.tracker, r['id']) for r in rows][::1]
+            if self.db.has_fts:
+                match = _match_expression(sstr)
+                if match is None:
+                    return []
+                sql = """SELECT issues.* FROM issues_fts 
+                         JOIN issues ON issues.id = issues_fts.id
+                         WHERE issues_fts MATCH ?"""
+                params = [match]
+                if status is not None:
+                    sql += " AND issues.status = ?"
+                    params.append(status)
+                sql += """ ORDER BY bm25(issues_fts, 0.0, 5.0, 1.0, 1.0)
+                           LIMIT ?"""
+                params.append(n)
+            else:
+                sstr = '%' + sstr + '%'
+                sql = """SELECT * FROM issues WHERE
+                             (title    LIKE ? OR
+                              content  LIKE ? OR
+                              EXISTS (SELECT 1 FROM comments WHERE
+                                          issue_id = issues.id AND
+                                          content LIKE ?))"""
+                params = [sstr, sstr, sstr]
+                if status is not None:
+                    sql += " AND status = ?"
+                    params.append(status)
+                sql += " LIMIT ?"
+                params.append(n)
+            rows = self.db.conn.execute(sql, tuple(params))
+            return [IssueRecord(self.tracker, r) for r in rows]
         else:
             raise NotImplementedError
 
-    def count(self, status=None):
+    def comments(self, issue_id, n=None):
+        """
+        Return an issue's comments, in the order they were made, as
+        read-only CommentRecord objects.
+
+        :param issue_id: the issue's SHA1 identifier.
+        :param n: the maximum number of comments to return.
+        """
+        table = self.db.comments
+        query = table.select(table.c.issue_id == issue_id,
+                             order_by=asc(table.c.timestamp), limit=n)
+        return [CommentRecord(r) for r in self.db.conn.execute(query)]
+
+    def comment_counts(self, issue_ids):
+        """
+        Return a dictionary that maps each of the given issues to its
+        number of comments. Issues without comments are left out.
+
+        :param issue_ids: a list of issue SHA1 identifiers.
+        """
+        table = self.db.comments
+        counts = {}
+        # stay under SQLite's limit on the number of bound parameters.
+        for i in xrange(0, len(issue_ids), 500):
+            query = select([table.c.issue_id, func.count(table.c.id)],
+                           table.c.issue_id.in_(issue_ids[i:i + 500]),
+                           group_by=[table.c.issue_id])
+            counts.update((r[0], r[1]) for r in self.db.conn.execute(query))
+        return counts
+
+    def count(self, status=None, label=None, labels=None, match='all'):
         """
         Return the number of issues.
 
+        Unless labels are given, this is read from the database's counters,
+        so it doesn't depend on the number of issues.
+
         :param status: if not None, return the count of issues with this status.
+        :param label: if not None, count only issues with this label.
+        :param labels: count only issues with these labels (a list).
+        :param match: ``'all'`` or ``'any'`` of the labels, see ``select``.
         """
-        if status is None:
-            return len(self.tracker._get_issue_shas())
+        labels = _label_list(label, labels)
+        if not labels:
+            counts = self.counts('status')
+            if status is None:
+                return sum(counts.values())
+            return counts.get(status, 0)
         else:
-            query = self.db.select().where(self.table.c.status==status)
+            self._integrity_check()
+            query = self._filter(self.db.select(), status, labels, match)
             result = query.count().execute()
             return result.fetchone()[0]
+
+    def counts(self, group_by='status'):
+        """
+        Return a dictionary that maps each status, label or author (by 
+        name) to its number of issues. These are kept up to date as issues 
+        are written, so this is just a read of the counters table.
+
+        :param group_by: ``'status'``, ``'label'`` or ``'author'``.
+        """
+        self._integrity_check()
+        table = self.db.counters
+        query = select([table.c.key, table.c.n], 
+                       and_(table.c.kind == group_by, table.c.n > 0))
+        return dict((r[0], r[1]) for r in self.db.conn.execute(query))
+
+    def label_counts(self, status=None):
+        """
+        Return a dictionary that maps each label to the number of issues that
+        have it, e.g. to size the labels in a label cloud.
+
+        :param status: if not None, count only issues with this status.
+        """
+        if status is None:
+            return self.counts('label')
+        self._integrity_check()
+        lt = self.db.labels
+        query = select([lt.c.label, func.count(lt.c.issue_id)],
+                       group_by=[lt.c.label])
+        query = query.where(lt.c.issue_id == self.table.c.id)
+        query = query.where(self.table.c.status == status)
+        return dict((r[0], r[1]) for r in self.db.conn.execute(query))
+
+    def _integrity_check(self):
+        """
+        Catch the database up with the tracker (see 
+        ``Database._integrity_check``) before counting, so the counts 
+        don't go stale after a pull or reset, or an edit made by another
+        process. Our own Database doesn't check, so the tracker's does.
+        """
+        self.tracker.db._integrity_check()
+
+    def _order_column(self, order_by):
+        """Return the column (or expression) to order results by."""
+        column = self.table.c[_ORDER_COLUMNS.get(order_by, order_by)]
+        if order_by not in _NOT_NULL:
+            # NULLs would drop out of the cursor comparisons.
+            column = func.coalesce(column, '')
+        return column
+
+    def _filter(self, query, status=None, labels=None, match='all'):
+        """
+        Add status and label criteria to a select on the ``issues`` table.
+
+        Labels are matched through the ``issue_labels`` table. To match all
+        of them, we keep the issues that matched as many rows as there are 
+        labels.
+        """
+        if status:
+            query = query.where(self.table.c.status == status)
+        if labels:
+            lt = self.db.labels
+            issue_ids = select([lt.c.issue_id], lt.c.label.in_(labels))
+            if match == 'all' and len(labels) > 1:
+                issue_ids = issue_ids.group_by(lt.c.issue_id).having(
+                    func.count(lt.c.label) == len(labels))
+            query = query.where(self.table.c.id.in_(issue_ids))
+        return query
+
+# Orderings whose names don't match the column name
+_ORDER_COLUMNS = {'author': 'author_name'}
+
+# Orderings whose columns never hold NULL
+_NOT_NULL = ('id', 'created', 'updated')
+
+
+def _sort_value(issue, order_by):
+    """Return the value of an issue that results are ordered by."""
+    if order_by == 'author':
+        value = issue.author['name']
+    else:
+        value = getattr(issue, order_by)
+    if order_by not in _NOT_NULL:
+        value = value or ''
+    return value
+
+
+def _encode_cursor(order_by, reverse, value, id):
+    """
+    Pack an ordering, its direction, a column value and an issue id into a
+    cursor.
+    """
+    return base64.urlsafe_b64encode(to_json([order_by, bool(reverse), value,
+                                             id], indent=None))
+
+
+def _decode_cursor(cursor, order_by, reverse):
+    """
+    Unpack a cursor made by ``_encode_cursor``.
+
+    :return: a ``(value, id)`` tuple.
+    :raises BadCursor: if the cursor is malformed or was made for another
+                       ordering or direction.
+    """
+    try:
+        cursor_order, cursor_reverse, value, id = from_json(
+            base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise BadCursor('Malformed cursor')
+    if cursor_order != order_by:
+        raise BadCursor('Cursor was made for another ordering')
+    if cursor_reverse != bool(reverse):
+        raise BadCursor('Cursor was made for the other direction')
+    return value, id
+
+
+def _match_expression(sstr):
+    """
+    Turn a search string into an FTS5 query. Each word becomes a quoted
+    prefix query, so punctuation in the search string can't be mistaken for
+    query syntax, and partial words still match (much like ``LIKE`` did).
+    The terms are implicitly ANDed.
+
+    :param sstr: the search string.
+    :return: the query, or None if the string has no terms.
+    """
+    terms = ['"%s"*' % t.replace('"', '""') for t in sstr.split()]
+    if not terms:
+        return None
+    return ' '.join(terms)
+
+
+def _label_list(label=None, labels=None):
+    """
+    Combine the single label and list of labels accepted by the query 
+    methods into one list of unique, stripped labels.
+    """
+    labels = list(labels) if labels else []
+    if label:
+        labels.append(label)
+    return sorted(set(l.strip() for l in labels if l.strip()))
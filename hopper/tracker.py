@@ -1,6 +1,10 @@
 from __future__ import with_statement
 import os
+import sys
 import glob
+import time
+import threading
+import itertools
 
 from hopper.git import Repo
 from hopper.issue import Issue
@@ -9,6 +13,11 @@ from hopper.config import TrackerConfig
 from hopper.document import Document
 from hopper.query import Query
 from hopper.database import Database
+from hopper.journal import Journal
+from hopper.activity import Activity, _action_trailer
+from hopper.errors import BadReference
+
+COMMITTER = 'Hopper <hopper@hopperhq.com>'
 
 class Tracker(object):
     """
@@ -39,8 +48,8 @@ class Tracker(object):
         self.properties = {
                 'name': None
                 }
-        self.repo = Repo(path)
         self.config = TrackerConfig(self)
+        self.repo = Repo(path, cat_file=self.config.git.get('cat_file'))
         self.db = Database(self)
 
     @classmethod
@@ -91,36 +100,93 @@ class Tracker(object):
         config.name = os.path.basename(path).capitalize()
         config.save()
 
-        # add everything to the repo and commit
-        repo.add(all=True)
-        repo.commit(committer='Hopper <hopper@hopperhq.com>',
+        # add everything (but the cache) to the repo and commit
+        repo.stage(['config', 'issues', 'docs', 
+                    os.path.join('.hopper', 'empty')])
+        repo.commit(committer=COMMITTER,
                     message='Created the %s tracker' % config.name)
+        # (that's all been committed)
+        Journal(path).take()
 
         # instantiate and return our new Tracker.
         return tracker
 
-    def autocommit(self, message, author=None):
+    def autocommit(self, message, author=None, scan=False, group=False):
         """
         Commit any changes to the repo. In most scenarios, the user
         responsible for the change(s) would be listed as the commit 
         author, and Hopper would be the committer.
 
+        Only the files that Hopper has written or deleted since the last
+        commit (as recorded in the tracker's ``Journal``) are committed, so
+        the cost doesn't grow with the size of the tracker. Changes made 
+        by hand need **scan**. The commit is built in memory with
+        ``Repo.commit_changes``, which then updates the index to match.
+
         :param msg: the commit message to use.
         :param author: the commit's author in string or dictionary
             format. For example: ``'Full Name <your.email@domain.tld>'``
             **or** ``{'name': 'Full Name', 'email': 'your.email@domain.tld'}``
+        :param scan: if True, walk the whole tracker and commit every file
+            that's new, modified or deleted.
+        :param group: if True and the tracker config sets a 
+            ``group_window`` (in ms) in its ``commit`` section, share a 
+            commit with the other autocommits made within the window (see
+            ``CommitGroup``). Meant for the web app's writes.
         :return: the Commit object.
         """
-        committer = 'Hopper <hopper@hopperhq.com>'
-
         if type(author) is dict:
             author = '%s <%s>' % (author['name'], author['email'])
         if type(author) is not str:
-            author = committer
+            author = COMMITTER
 
-        self.repo.add(all=True)
-        return self.repo.commit(message=message, committer=committer,
-                                author=author)
+        # (the paths this thread wrote for the action)
+        paths = Journal(self.path).recorded()
+        window = self.config.commit.get('group_window')
+        if group and not scan and window:
+            return _commit_group(self, window).commit(self, message, author,
+                                                      paths)
+        return self._commit(message, author, scan)
+
+    def _commit(self, message, author, scan=False, paths=None):
+        """
+        Commit the journaled changes (see ``autocommit``).
+
+        :param message: the commit message.
+        :param author: the commit author, as a string.
+        :param scan: look for changes in every file.
+        :param paths: if given, commit only these paths, and leave the rest
+                      of the journal for later.
+        """
+        journal = Journal(self.path)
+        paths = journal.take(paths)
+        try:
+            changes = self._changes(paths)
+            if scan:
+                new, modified, deleted = self.repo.status()
+                cache = os.path.join('.hopper', 'cache') + os.sep
+                changes.update(self._changes(p for p in new + modified + 
+                                             deleted 
+                                             if not p.startswith(cache)))
+            commit = self.repo.commit_changes(changes, message=message, 
+                                              committer=COMMITTER, 
+                                              author=author)
+        except:
+            # try again next time.
+            journal.record(*paths)
+            raise
+        self._auto_pack()
+        return commit
+
+    def _auto_pack(self):
+        """
+        Pack the repository's loose objects if there are (about) more than
+        the ``auto_pack`` setting in the ``gc`` section of the tracker 
+        config. See ``Repo.pack``.
+        """
+        threshold = self.config.gc.get('auto_pack')
+        if threshold and self.repo.loose_objects(estimate=True) > threshold:
+            self.repo.pack()
 
     def doc(self, path):
         """
@@ -174,31 +240,105 @@ class Tracker(object):
         query = Query(self)
         return query.select(**kwargs)
 
-    def history(self, n=10, offset=0, all=False):
+    def history(self, n=10, offset=0, all=False, after=None):
         """
-        Return a list of dictionaries containing the action and the actor.
-        These are assembled from the Git repository's commit log.
-
-        :param n: the maximum number of history items to return.
-        :param all: ignore n and return everything.
+        Return a list of the commits that make up the tracker's history, 
+        newest first. The walk stops after the last one returned.
+
+        :param n: the index (counting the offset) to stop at, so up to 
+                  ``n - offset`` commits are returned.
+        :param offset: skip this many commits.
+        :param all: ignore n and return everything (up to 1000 commits).
+        :param after: a continuation token: the SHA of the last commit of
+                      the previous page. Resumes the walk there, rather
+                      than skipping **offset** commits from HEAD.
+        :raises BadReference: if **after** isn't a commit.
         """
         if all:
-            commits = self.repo.commits(n=1000)
-        else:
-            commits = self.repo.commits(n=n)
-        if len(commits) > offset:
-            return commits[offset:]
-        else:
-            return []
+            n = 1000
+        walk = self.repo.walk(after=after)
+        try:
+            return list(itertools.islice(walk, offset, max(n, offset)))
+        except KeyError:
+            if after is None:
+                raise
+            raise BadReference('No matching commit: %s' % after)
+
+    def activity(self):
+        """
+        Returns a hopper.activity.Activity object, the index of the
+        tracker's history used by the activity feed.
+        """
+        return Activity(self)
 
     def get_issue_path(self, sha):
         """
         Returns the absolute path to the issue. It doesn't check if the issue
         exists; this should be done afterwards if necessary.
 
+        Issues are either kept flat, in ``issues/<sha>``, or sharded by the
+        first two characters of the SHA, in ``issues/<ab>/<cdef...>`` (see
+        ``set_layout``). New issues follow the ``sharded`` setting in the 
+        ``layout`` section of the tracker config, but an issue that already
+        exists is found in either layout.
+
         :param sha: the issue's unique identifier.
         """
-        return os.path.join(self.paths['issues'], sha, 'issue')
+        dirs = self.get_issue_dirs(sha)
+        for directory in dirs:
+            path = os.path.join(self.path, directory, 'issue')
+            if os.path.exists(path):
+                return path
+        return os.path.join(self.path, dirs[0], 'issue')
+
+    def get_issue_dirs(self, sha):
+        """
+        Returns the possible paths of the issue's directory, relative to 
+        the tracker root: the one in the configured layout first, then the 
+        other.
+
+        :param sha: the issue's unique identifier.
+        """
+        flat = os.path.join('issues', sha)
+        sharded = os.path.join('issues', sha[:2], sha[2:])
+        if self.config.layout.get('sharded'):
+            return [sharded, flat]
+        return [flat, sharded]
+
+    def set_layout(self, sharded=True):
+        """
+        Move every issue into the sharded (or the flat) layout, and save
+        the choice in the tracker config, so that new issues follow it. 
+        Sharding keeps the ``issues`` directory small for large trackers,
+        the way git shards its objects. Each issue directory is renamed, 
+        and the moves are left for the next autocommit.
+
+        :param sharded: if False, go back to the flat layout.
+        :return: the number of issues moved.
+        """
+        self.config.layout['sharded'] = sharded
+        self.config.save()
+        journal = Journal(self.path)
+        moved = 0
+        for sha in self._get_issue_shas():
+            target, other = self.get_issue_dirs(sha)
+            if not os.path.isdir(os.path.join(self.path, other)):
+                continue
+            target_path = os.path.join(self.path, target)
+            parent = os.path.dirname(target_path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            os.rename(os.path.join(self.path, other), target_path)
+            if not sharded:
+                # remove the shard if that was its last issue.
+                try:
+                    os.rmdir(os.path.dirname(os.path.join(self.path, other)))
+                except OSError:
+                    pass
+            journal.record(other, target)
+            moved += 1
+        journal.record('config')
+        return moved
 
     def query(self):
         """
@@ -207,12 +347,189 @@ class Tracker(object):
         """
         return Query(self)
 
+    def _changes(self, paths):
+        """
+        Return the changes to commit for the given paths, as taken by
+        ``Repo.commit_changes``: the content of each file (or of each file
+        under a directory), or None for paths that no longer exist.
+
+        :param paths: paths relative to the tracker root.
+        """
+        changes = {}
+        for path in paths:
+            full_path = os.path.join(self.path, path)
+            if os.path.isfile(full_path):
+                changes[path] = self.read(path, 'rb')
+            elif os.path.isdir(full_path):
+                for directory, dirnames, filenames in os.walk(full_path):
+                    for f in filenames:
+                        fpath = os.path.relpath(os.path.join(directory, f),
+                                                self.path)
+                        changes[fpath] = self.read(fpath, 'rb')
+            else:
+                changes[path] = None
+        return changes
+
     def _get_issues(self):
         """Returns a list of all issue objects."""
         return [Issue(self, sha) for sha in self._get_issue_shas()]
 
     def _get_issue_shas(self):
         """Return a list of the SHA1s of all issues in the tracker."""
-        # we'll just return any paths in tracker/issues/ with 40 chars.
+        # we'll just return any paths in tracker/issues/ with 40 chars, and
+        # any with 38 chars in its 2-char shards (see get_issue_path).
         # since we're not verifying, this may not be 100% accurate.
-        return filter(lambda x: len(x) == 40, os.listdir(self.paths['issues']))
+        shas = []
+        for name in os.listdir(self.paths['issues']):
+            if len(name) == 40:
+                shas.append(name)
+            elif _is_shard(name):
+                shard = os.path.join(self.paths['issues'], name)
+                if os.path.isdir(shard):
+                    shas.extend(name + x for x in os.listdir(shard) 
+                                if len(x) == 38)
+        return shas
+
+    def _match_issues(self, prefix):
+        """
+        Return the SHAs of the issues that start with the prefix, in either
+        layout (see ``get_issue_path``).
+
+        :param prefix: the start of an issue's SHA.
+        """
+        issues = self.paths['issues']
+        matches = glob.glob(os.path.join(issues, prefix + '*', 'issue'))
+        if len(prefix) >= 2:
+            matches += glob.glob(os.path.join(issues, prefix[:2], 
+                                              prefix[2:] + '*', 'issue'))
+        else:
+            matches += glob.glob(os.path.join(issues, prefix + '*', '*', 
+                                              'issue'))
+        shas = set(_issue_sha(m) for m in matches)
+        return sorted(sha for sha in shas if len(sha) == 40)
+
+
+class CommitGroup(object):
+    """
+    Coalesces the autocommits made within a window of time into a single 
+    commit, so that bursts of web writes don't each wait their turn to 
+    move HEAD.
+
+    The first autocommit to arrive opens a group and waits out the window;
+    any that arrive meanwhile join it. Then it commits the paths that the
+    group's members wrote (see ``Journal.recorded``), leaving any others 
+    for later, with a message that lists each action and its author, and 
+    every autocommit in the group returns the shared commit (or raises its
+    error).
+
+    This only helps when writes are handled by concurrent threads.
+
+    :param window: the window, in milliseconds.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.cond = threading.Condition()
+        # (message, author, paths) of each autocommit in the open group
+        self.pending = []
+        # the open group's number
+        self.group = 0
+        # group number -> [commit, exc_info, members still to return]
+        self.results = {}
+
+    def commit(self, tracker, message, author, paths):
+        """
+        Join the open group (or open one), and return the group's commit
+        once it has landed.
+
+        :param tracker: the Tracker to commit to.
+        :param message: the commit message for this action.
+        :param author: the author of this action, as a string.
+        :param paths: the paths written for this action, relative to the
+                      tracker.
+        """
+        with self.cond:
+            group = self.group
+            self.pending.append((message, author, paths))
+            leader = len(self.pending) == 1
+        if leader:
+            time.sleep(float(self.window) / 1000)
+            with self.cond:
+                actions = self.pending
+                self.pending = []
+                self.group += 1
+            # (the next group can open while we commit)
+            message, author = _group_message([(m, a) for m, a, p in actions])
+            paths = [p for m, a, action_paths in actions 
+                     for p in action_paths]
+            try:
+                result = [tracker._commit(message, author, paths=paths), 
+                          None]
+            except:
+                result = [None, sys.exc_info()]
+            with self.cond:
+                result.append(len(actions))
+                self.results[group] = result
+                self.cond.notify_all()
+        with self.cond:
+            while group not in self.results:
+                self.cond.wait()
+            commit, exc_info, members = self.results[group]
+            if members == 1:
+                del self.results[group]
+            else:
+                self.results[group][2] -= 1
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return commit
+
+
+# CommitGroups, keyed by tracker path.
+_commit_groups = {}
+_commit_groups_lock = threading.Lock()
+
+def _commit_group(tracker, window):
+    """Return the CommitGroup for the tracker."""
+    path = os.path.realpath(tracker.path)
+    with _commit_groups_lock:
+        group = _commit_groups.get(path)
+        if group is None or group.window != window:
+            group = _commit_groups[path] = CommitGroup(window)
+        return group
+
+
+def _is_shard(name):
+    """Return True if the name is that of an issue shard directory."""
+    return len(name) == 2 and all(c in '0123456789abcdef' for c in name)
+
+
+def _issue_sha(path):
+    """Return the SHA of the issue at the path, in either layout."""
+    directory = os.path.dirname(path)
+    name = os.path.basename(directory)
+    if len(name) == 38:
+        return os.path.basename(os.path.dirname(directory)) + name
+    return name
+
+
+def _group_message(actions):
+    """
+    Return the message and author for a commit of the given actions. 
+
+    A single action's commit is just like an ordinary autocommit. Otherwise
+    the message lists each action, one per line, as ``author: message``, 
+    followed by a trailer line for each that records it as JSON (see 
+    ``hopper.activity._actions``), and the author is Hopper unless it's 
+    the same for every action.
+
+    :param actions: a list of ``(message, author)`` tuples.
+    """
+    if len(actions) == 1:
+        return actions[0]
+    authors = set(author for message, author in actions)
+    author = authors.pop() if len(authors) == 1 else COMMITTER
+    lines = ['%s: %s' % (a, m.split('\n')[0]) for m, a in actions]
+    trailers = [_action_trailer(m, a) for m, a in actions]
+    return 'Grouped %d actions\n\n%s\n\n%s' % (len(actions), 
+                                               '\n'.join(lines),
+                                               '\n'.join(trailers)), author
@@ -7,6 +7,8 @@ import glob
 import os
 import time
 import random
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from markdown import markdown
 from docutils import core
@@ -208,3 +210,49 @@ def strip_email(author):
         return author[:first_bracket - 1]
     # didn't contain the email address, return untouched.
     return author
+
+
+class LRUCache(object):
+    """
+    A dictionary-like cache that holds at most **size** items, evicting 
+    the least recently used first. Safe to share between threads.
+
+    It's meant for things that never change under a key, like git objects 
+    (or what we parse from them) keyed by their SHA.
+
+    :param size: the maximum number of items.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """Return the item at key, or default, marking it recently used."""
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        """Store the item at key, evicting the oldest if we're full."""
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        """Remove every item."""
+        with self._lock:
+            self._items.clear()
@@ -1,8 +1,8 @@
 $(function() {
-  var offset;
-  offset = 20;
+  var after;
+  after = $('#load-stories').data('after');
   return $('#load-stories').click(function() {
-    return $.getJSON("?offset=" + offset, function(data) {
+    return $.getJSON("?after=" + after, function(data) {
       var html, s, stories, _i, _len;
       stories = data;
       for (_i = 0, _len = stories.length; _i < _len; _i++) {
@@ -28,7 +28,9 @@ $(function() {
       if (stories.length < 20) {
         $('#load-stories').remove();
       }
-      return offset += 20;
+      if (stories.length) {
+        return after = stories[stories.length - 1].position;
+      }
     });
   });
 });
\ No newline at end of file
@@ -1,7 +1,8 @@
 """Handles all the API calls. Each function returns JSON."""
 
-from flask import Blueprint, request
+from flask import Blueprint, request, abort
 from hopper.web.utils import setup, to_json
+from hopper.errors import BadCursor
 import hopper.web.views.issues as issue_view
 
 
@@ -14,16 +15,14 @@ api = Blueprint('api', __name__)
 def open_issues():
     """Returns open issues."""
     tracker, config = setup()
-    issues = [i.fields for i in tracker.issues(status='open')]
-    return to_json(issues)
+    return _issues(tracker, status='open')
 
 
 @api.route('/issues/closed')
 def closed_issues():
     """Returns closed issues."""
     tracker, config = setup()
-    issues = [i.fields for i in tracker.issues(status='closed')]
-    return to_json(issues)
+    return _issues(tracker, status='closed')
 
 
 @api.route('/issues/label/<label>')
@@ -32,12 +31,27 @@ def label(label, status=None):
     """
     Returns issues that have a given label.
 
-    :param label: label to filter by.
+    :param label: label to filter by. Several can be given, separated by
+                  commas. By default, issues must have all of them; pass 
+                  ``?match=any`` to return issues with any of them.
     :param status: status to filter by, in addition to the label.
     """
     tracker, config = setup()
-    issues = [i.fields for i in tracker.issues(label=label, status=status)]
-    return to_json(issues)
+    match = 'any' if request.args.get('match') == 'any' else 'all'
+    return _issues(tracker, labels=label.split(','), status=status, 
+                   match=match)
+
+
+@api.route('/labels')
+@api.route('/labels/<status>')
+def labels(status=None):
+    """
+    Returns the number of issues with each label.
+
+    :param status: count only issues with this status.
+    """
+    tracker, config = setup()
+    return to_json(tracker.query().label_counts(status))
 
 
 @api.route('/issues/search/<query>')
@@ -68,6 +82,23 @@ def issue(id):
     return to_json(tracker.issue(id).fields)
 
 
+@api.route('/issue/<id>/history')
+def issue_history(id):
+    """
+    Return the commits that changed the issue with the given id, newest
+    first.
+
+    :param id: id of the issue.
+    """
+    tracker, config = setup()
+    history = [{'commit': h.commit_id,
+                'time': h.time,
+                'author': {'name': h.author_name, 'email': h.author_email},
+                'action': h.action}
+               for h in tracker.issue(id).history()]
+    return to_json(history)
+
+
 @api.route('/issue/<id>/close')
 def close_issue(id):
     """
@@ -96,6 +127,29 @@ def open_issue(id):
     return to_json({'success': success})
 
 
+def _issues(tracker, **kwargs):
+    """
+    Returns the issues that match the given filters (see ``Query.select``).
+
+    Results can be paged with the ``limit`` and ``cursor`` request args. If
+    a full page is returned, the ``X-Next-Cursor`` response header holds the
+    cursor for the next page.
+    """
+    limit = request.args.get('limit', None, type=int)
+    cursor = request.args.get('cursor', None)
+    query = tracker.query()
+    try:
+        issues = query.select(limit=limit, cursor=cursor, **kwargs)
+    except BadCursor:
+        abort(400)
+    response = to_json([i.fields for i in issues])
+    if limit and len(issues) == limit:
+        response.headers['X-Next-Cursor'] = query.cursor(
+                issues[-1], kwargs.get('order_by', 'updated'), 
+                kwargs.get('reverse', True))
+    return response
+
+
 ### /docs/* 
 
 @api.route('/docs/<doc>')
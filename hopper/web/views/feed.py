@@ -1,58 +1,77 @@
-from flask import Blueprint, render_template, url_for, request
+from flask import Blueprint, render_template, url_for, request, abort
 
-from hopper.web.utils import setup, looks_hashy, to_json
-from hopper.utils import relative_time, cut, strip_email
-from hopper.errors import BadReference
-from hopper.comment import Comment
-from hopper.issue import Issue
+from hopper.web.utils import setup, to_json
+from hopper.utils import relative_time
 
 feed = Blueprint('feed', __name__)
 
 @feed.route('/')
 def main():
+    return stories()
+
+@feed.route('/members')
+def members():
     tracker, config = setup()
+    header = "Everyone who's altered the %s time continuum." % tracker.config.name
+    # (name, email) tuples, from the activity index.
+    users = tracker.activity().authors()
+    return render_template('members.html', header=header,
+                           tracker=tracker, users=users)
 
-    # get the offset param (intended for javascript requests)
-    offset = int(request.args.get('offset', 0))
+@feed.route('/members/<email>')
+def member(email):
+    return stories(author=email)
 
-    # Get up to 20 commits starting at whatever offset.
-    raw_history = tracker.history(n=offset+20, offset=offset)
+def stories(author=None):
+    """
+    Render the activity feed, or a page of it as JSON for javascript
+    requests.
 
-    # Don't want the performance hit of checking how many commits there are.
-    # Instead, we're guessing that there's more if we get a full 20 in the 
-    # first batch. 
-    more_history = False if len(raw_history) < 20 else True
+    :param author: only show the activity of the author with this email.
+    """
+    tracker, config = setup()
+
+    # the position of the last story of the previous page (intended for
+    # javascript requests)
+    after = request.args.get('after') or None
+    if after is not None:
+        try:
+            after = int(after)
+        except ValueError:
+            abort(400)
+
+    # Get up to 20 stories from the activity index (see hopper.activity).
+    rows = tracker.activity().select(n=20, after=after, author=author)
+
+    # Don't want the performance hit of checking how many stories there
+    # are. Instead, we're guessing that there's more if we get a full 20
+    # in the first batch.
+    more_history = False if len(rows) < 20 else True
 
     # get the unique set of authors (in this history segment)
-    users = set(strip_email(c.author) for c in raw_history)
+    users = sorted(set((r.author_name, r.author_email) for r in rows))
     docs = tracker.docs()
     history = []
-    for c in raw_history:
-        split = c.author.index('<')
-        name = c.author[:split]
-        email = c.author[(split + 1):-1]
-        time = relative_time(c.commit_time)
-        message, obj = interpret(c.message, tracker)
-
-        snippet = title = link = button = None
+    for r in rows:
+        link = button = None
+        if r.comment_id:
+            link = url_for('issues.view', id=r.issue_id[:6]) + \
+                    '#comment-' + r.comment_id[:6]
+            button = r.issue_id[:6]
+        elif r.issue_id:
+            link = url_for('issues.view', id=r.issue_id[:6])
+            button = r.issue_id[:6]
 
-        if type(obj) is Comment:
-            snippet = cut(obj.content, 190)
-            link = url_for('issues.view', id=obj.issue.id[:6]) + '#comment-' + obj.id[:6]
-            button = obj.issue.id[:6]
-        if type(obj) is Issue:
-            title = obj.title
-            snippet = cut(obj.content, 190)
-            link = url_for('issues.view', id=obj.id[:6])
-            button = obj.id[:6]
-
-        history.append({'user': {'name': name, 'email': email},
-                        'message': message.strip(),
-                        'time': time,
+        history.append({'commit': r.commit_id,
+                        'position': r.position,
+                        'user': {'name': r.author_name,
+                                 'email': r.author_email},
+                        'message': r.action,
+                        'time': relative_time(r.time),
                         'link': link,
                         'button': button,
-                        'title': title,
-                        'snippet': snippet
+                        'title': r.title,
+                        'snippet': r.snippet
                         }
                        )
     # If the request is async, we're all set.
@@ -61,10 +80,15 @@ def main():
 
     # Otherwise, we have to get some more info.
 
-    header = 'Recent Activity for %s' % tracker.config.name
+    if author is not None:
+        name = rows[0].author_name if rows else author
+        header = 'Recent Activity by %s' % name
+    else:
+        header = 'Recent Activity for %s' % tracker.config.name
     # Issue counts
-    n_open = tracker.query().count('open')
-    n_closed = tracker.query().count('closed')
+    counts = tracker.query().counts('status')
+    n_open = counts.get('open', 0)
+    n_closed = counts.get('closed', 0)
     n_total = n_open + n_closed
     # Graph percentages
     # the subtraction is spacing for the CSS.
@@ -74,45 +98,9 @@ def main():
     g_closed = 1 if g_closed < 1 else g_closed
 
     return render_template('feed.html', history=history,
-                           selected='feed', header=header, 
+                           selected='feed', header=header,
                            tracker=tracker, users=users,
-                           docs=docs, n_open=n_open, 
+                           docs=docs, n_open=n_open,
                            n_closed=n_closed, n_total=n_total,
                            g_open=g_open, g_closed=g_closed,
                            more_history=more_history)
-
-@feed.route('/members')
-def members():
-    tracker, config = setup()
-    header = "Everyone who's altered the %s time continuum." % tracker.config.name
-    raw_history = tracker.history(all=True)
-    # get the unique set of authors (in this history segment)
-    users = set(strip_email(c.author) for c in raw_history)
-    return render_template('members.html', header=header, 
-                           tracker=tracker, users=users)
-
-def interpret(message, tracker):
-    """
-    Look for an issue and/or comment id in the commit message
-    and return the appropriate object.
-    """
-    message = message[0].lower() + message[1:]
-    last13 = message[-13:]
-    last6 = message[-6:]
-    if looks_hashy(last13[:6]) and looks_hashy(last13[7:]):
-        issue_id = last13[:6]
-        comment_id = last13[7:]
-        try:
-            issue = Issue(tracker, issue_id)
-            redacted = message[:-13]
-            return redacted, Comment(issue, comment_id)
-        except BadReference:
-            pass
-    elif looks_hashy(last6):
-        try:
-            issue = Issue(tracker, last6)
-            redacted = message[:-6]
-            return redacted, Issue(tracker, last6)
-        except BadReference:
-            pass
-    return message, None
@@ -1,7 +1,8 @@
 from flask import Blueprint, request, redirect, url_for, render_template, \
-                  flash
+                  flash, abort
 from hopper.issue import Issue
 from hopper.comment import Comment
+from hopper.errors import BadCursor
 from hopper.utils import relative_time, markdown_to_html, map_attr
 from hopper.web.utils import setup, to_json, pager, highlight
 
@@ -22,24 +23,38 @@ def index(status='open'):
     order = request.args.get('order', 'updated')
     direc = request.args.get('dir', 'asc')
     page = int(request.args.get('page', 1))
+    cursor = request.args.get('cursor', None)
     label = request.args.get('label', None)
+    match = request.args.get('match', 'all')
 
     # verify the params
     order = order if order in ['id', 'title', 'author'] else 'updated'
     reverse = True if direc == 'asc' else False
+    match = match if match == 'any' else 'all'
+    labels = label.split(',') if label else None
     per_page = 15 
     offset = (page - 1) * per_page if page > 1 else 0
+    # a cursor (from the 'Next' link) saves walking the earlier pages.
+    if cursor:
+        offset = None
 
     # run our query
-    issues_ = tracker.query().select(limit=per_page, offset=offset, 
-                                     status=status, order_by=order, 
-                                     reverse=reverse, label=label)
+    try:
+        issues_ = tracker.query().select(limit=per_page, offset=offset, 
+                                         status=status, order_by=order, 
+                                         reverse=reverse, labels=labels,
+                                         match=match, cursor=cursor)
+    except BadCursor:
+        abort(400)
+    next_cursor = None
+    if len(issues_) == per_page:
+        next_cursor = tracker.query().cursor(issues_[-1], order, reverse)
     # humanize the timestamps
     map_attr(issues_, 'updated', relative_time)
     map_attr(issues_, 'created', relative_time)
 
     # get the number of issues by status
-    n = tracker.query().count(status)
+    n = tracker.query().count(status, labels=labels, match=match)
 
     # get the number of pages
     n_pages = n / per_page
@@ -62,7 +77,9 @@ def index(status='open'):
                                selected='issues', status=status, 
                                order=order, page=page, pages=pages,
                                num_pages=n_pages, asc=reverse,
-                               header=header, n=n, tracker=tracker)
+                               header=header, n=n, tracker=tracker,
+                               next_cursor=next_cursor, label=label,
+                               match=match)
 
 
 @issues.route('/search')
@@ -74,10 +91,11 @@ def search(query=None):
     header = "Search results for '%s'" % query
     issues_ = tracker.query().search(query)
     for i in issues_:
-        blurb = i.content
-        if i.comments():
-            blurb += ' ... ' + ' ... '.join(c.content for c in i.comments() if 
-                                            type(c.content) is str)
+        blurb = i.content or ''
+        comments = i.comments()
+        if comments:
+            blurb += ' ... ' + ' ... '.join(c.content for c in comments if 
+                                            type(c.content) in [str, unicode])
         blurb = highlight(blurb, query)
         i.content = blurb
         i.title = highlight(i.title, query, False)
@@ -104,7 +122,7 @@ def new():
         issue.author['email'] = config.user['email']
         if issue.save():
             tracker.autocommit(message='Created a new issue %s' % issue.id[:6], 
-                               author=config.user)
+                               author=config.user, group=True)
             return redirect(url_for('issues.view', id=issue.id)) 
         else:
             flash('There was an error saving your issue.')
@@ -133,7 +151,7 @@ def view(id):
         if issue.save(): # ping the issue (updated = now)
             tracker.autocommit(message='Commented on issue %s/%s' % \
                                         (issue.id[:6], comment.id[:6]),
-                               author=config.user)
+                               author=config.user, group=True)
         else:
             flash('There was an error saving your comment.')
         return redirect(url_for('issues.view', id=issue.id))
@@ -141,15 +159,22 @@ def view(id):
         issue.updated = relative_time(issue.updated)
         issue.created = relative_time(issue.created)
         issue.content = markdown_to_html(issue.content)
-        comments = issue.comments()
+        comments = tracker.query().comments(issue.id)
         header = 'Viewing Issue &nbsp;<span class="fancy-monospace">%s</span>' \
                 % issue.id[:6]
         if comments:
             map_attr(comments, 'timestamp', relative_time)
             map_attr(comments, 'content', markdown_to_html)
+        # the commits that changed the issue, from the activity index.
+        history = [{'commit': h.commit_id,
+                    'name': h.author_name,
+                    'action': h.action,
+                    'time': relative_time(h.time)} 
+                   for h in issue.history()]
         return render_template('issue.html', issue=issue,
                                comments=comments, selected='issues',
-                               config=config, header=header, tracker=tracker)
+                               config=config, header=header, tracker=tracker,
+                               history=history)
 
 
 @issues.route('/settings')
@@ -179,7 +204,7 @@ def close(id, redirect_after=True):
         comment.save()
         issue.save()
         tracker.autocommit('Closed issue %s/%s' % (issue.id[:6], comment.id[:6]),
-                           config.user)
+                           config.user, group=True)
         if redirect_after:
             return redirect(url_for('issues.view', id=issue.id))
         else:
@@ -207,7 +232,7 @@ def open(id, redirect_after=True):
         comment.save()
         issue.save()
         tracker.autocommit('Re-opened issue %s/%s' % (issue.id[:6], comment.id[:6]),
-                           config.user)
+                           config.user, group=True)
         if redirect_after:
             return redirect(url_for('issues.view', id=issue.id))
         else:
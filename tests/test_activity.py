@@ -0,0 +1,143 @@
+import unittest
+
+from env import TestEnv
+from hopper.activity import Activity, _actions
+from hopper.issue import Issue
+from hopper.comment import Comment
+from hopper.tracker import Tracker, _group_message
+
+class ActivityTest(unittest.TestCase):
+    '''Tests the `Activity` class.'''
+
+    def setUp(self):
+        self.env = TestEnv()
+        self.tracker = self.env.tracker
+
+    def tearDown(self):
+        self.env.cleanup()
+
+    def test_select(self):
+        '''Tests the `select` method'''
+        t = self.tracker
+        issue = Issue(t)
+        issue.title = 'A bug'
+        issue.content = 'It is broken.'
+        issue.save()
+        t.autocommit('Created a new issue %s' % issue.id[:6],
+                     'Jane Doe <jane@x.com>')
+        comment = Comment(issue)
+        comment.content = 'Still broken.'
+        comment.save()
+        t.autocommit('Commented on issue %s/%s' % (issue.id[:6],
+                                                   comment.id[:6]))
+
+        rows = Activity(t).select()
+        # (plus the tracker's creation)
+        assert len(rows) == 3
+        assert rows[0].action == 'commented on issue'
+        assert rows[0].issue_id == issue.id
+        assert rows[0].comment_id == comment.id
+        assert rows[0].snippet == 'Still broken.'
+        assert rows[1].title == 'A bug'
+        assert rows[1].author_email == 'jane@x.com'
+        assert rows[1].author_name == 'Jane Doe'
+
+        # paging and filtering
+        assert Activity(t).select(n=1, after=rows[0].position) == [rows[1]]
+        assert Activity(t).select(author='jane@x.com') == [rows[1]]
+
+    def test_titles(self):
+        '''Titles are those of the commit each action was recorded by'''
+        t = self.tracker
+        issue = Issue(t)
+        issue.title = 'Before'
+        issue.save()
+        t.autocommit('Created a new issue %s' % issue.id[:6])
+        issue.title = 'After'
+        issue.save()
+        t.autocommit('Edited issue %s' % issue.id[:6])
+        gone = Issue(t)
+        gone.title = 'Gone'
+        gone.save()
+        t.autocommit('Created a new issue %s' % gone.id[:6])
+        gone.delete()
+        t.autocommit('Deleted an issue')
+
+        # (indexed only now, after the edit and the delete)
+        rows = Activity(t).select()
+        titles = dict((r.action + ' ' + r.title, r.issue_id) 
+                      for r in rows if r.title)
+        assert titles == {'created a new issue Before': issue.id,
+                          'edited issue After': issue.id,
+                          'created a new issue Gone': gone.id}
+
+    def test_update(self):
+        '''Tests the `update` method'''
+        t = self.tracker
+        activity = Activity(t)
+        activity.update()
+        assert len(activity.select()) == 1
+        Issue(t).save()
+        t.autocommit('Created issue 1')
+        rows = activity.select()
+        assert len(rows) == 2
+        assert rows[0].position > rows[1].position
+        # nothing new to index
+        activity.update()
+        assert activity.select() == rows
+
+    def test_update_without_cat_file(self):
+        '''Tests updating an existing index through dulwich'''
+        t = self.tracker
+        t.config.git['cat_file'] = False
+        t.config.save()
+        t = Tracker(t.paths['root'])
+        assert t.repo.cat_file is None
+        assert len(Activity(t).select()) == 1
+        Issue(t).save()
+        t.autocommit('Created issue 1')
+        assert len(Activity(t).select()) == 2
+
+    def test_authors(self):
+        '''Tests the `authors` method'''
+        t = self.tracker
+        Issue(t).save()
+        t.autocommit('Created issue 1', 'Jane Doe <jane@x.com>')
+        authors = Activity(t).authors()
+        assert authors == [('Jane Doe', 'jane@x.com'),
+                           ('Hopper', 'hopper@hopperhq.com')]
+
+    def test__actions(self):
+        '''Tests the `_actions` function'''
+        t = self.tracker
+        Issue(t).save()
+        actions = [('Created issue 1', 'A <a@x.com>'),
+                   ('Created issue 2\nwith two lines', 'B'),
+                   ('Grouped nothing', 'C <c@x.com>')]
+        commit = t.autocommit(*_group_message(actions))
+        assert _actions(commit) == actions
+        # an ordinary commit is one action, whatever its message.
+        commit = t.autocommit('Grouped 2 actions\n\n'
+                              'A <a@x.com>: Created issue 1')
+        assert _actions(commit) == [(commit.message.strip(), commit.author)]
+
+    def test_history(self):
+        '''Tests the `history` method'''
+        t = self.tracker
+        issue = Issue(t)
+        issue.save()
+        first = t.autocommit('Created a new issue %s' % issue.id[:6],
+                             'Jane Doe <jane@x.com>')
+        other = Issue(t)
+        other.save()
+        t.autocommit('Created a new issue %s' % other.id[:6])
+        issue.title = 'Edited'
+        issue.save()
+        last = t.autocommit('Edited the issue', scan=True)
+
+        history = Activity(t).history(issue.id)
+        assert [h.commit_id for h in history] == [last.id, first.id]
+        assert history[0].action == 'Edited the issue'
+        assert history[1].action == 'created a new issue'
+        assert history[1].author_email == 'jane@x.com'
+        assert [h.commit_id for h in issue.history(n=1)] == [last.id]
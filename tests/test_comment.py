@@ -1,4 +1,6 @@
 import unittest
+import os
+
 from env import TestEnv
 from hopper.comment import Comment
 from hopper.issue import Issue
@@ -13,13 +15,26 @@ class CommentTest(unittest.TestCase):
         self.env.cleanup()
 
     def test_save(self):
-        pass
+        self.issue.save()
+        comment = Comment(self.issue)
+        comment.content = 'Me too'
+        comment.save()
+        # the comment is written to disk and mirrored in the database.
+        assert os.path.exists(self.issue.get_comment_path(comment.id))
+        records = self.tracker.query().comments(self.issue.id)
+        assert [c.id for c in records] == [comment.id]
+        assert records[0].content == 'Me too'
 
     def test_save_issue(self):
         pass
 
     def test_delete(self):
-        pass
+        self.issue.save()
+        comment = Comment(self.issue)
+        comment.save()
+        comment.delete()
+        assert not os.path.exists(self.issue.get_comment_path(comment.id))
+        assert self.tracker.query().comments(self.issue.id) == []
 
     def test_rm(self):
         pass
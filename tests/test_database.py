@@ -1,9 +1,12 @@
 import unittest
 import os
+import threading
 
 from env import TestEnv
+from hopper import database
 from hopper.database import Database
 from hopper.issue import Issue
+from hopper.comment import Comment
 from sqlalchemy.sql import Select
 
 class DatabaseTest(unittest.TestCase):
@@ -30,6 +33,28 @@ class DatabaseTest(unittest.TestCase):
         assert os.path.exists(path)
         assert db2.conn
 
+        # Both share the same engine:
+        assert db1.conn.engine is db2.conn.engine
+        assert db1.issues is db2.issues
+
+    def test_conn(self):
+        '''Test that each thread has one connection, shared.'''
+        db1 = Database(self.env.tracker)
+        db2 = Database(self.env.tracker)
+        assert db1.conn is db2.conn
+        other = []
+        thread = threading.Thread(target=lambda: other.append(db1.conn))
+        thread.start()
+        thread.join()
+        assert other[0] is not db1.conn
+
+    def test_pragmas(self):
+        '''Test the connection setup.'''
+        db = Database(self.env.tracker)
+        mode = db.conn.execute('PRAGMA journal_mode').scalar()
+        assert mode == 'wal'
+        assert db.conn.execute('PRAGMA busy_timeout').scalar() == 5000
+
     def test__apply_working_tree(self):
         '''Tests the `_apply_working_tree` method'''
         pass
@@ -44,7 +69,130 @@ class DatabaseTest(unittest.TestCase):
 
     def test__replicate(self):
         '''Tests the `_replicate` method'''
-        pass
+        tracker = self.env.tracker
+        db = Database(tracker)
+        other = Database(tracker, check=False)
+        issue = Issue(tracker)
+        issue.title = 'Replicated'
+        issue.labels = ['bug']
+        issue.save()
+        # forget it, as if the mirror were stale.
+        db.delete(issue.id)
+        inode = os.stat(db.path).st_ino
+        db._replicate()
+
+        # the temporary file was copied in (not renamed over the mirror):
+        assert not [f for f in os.listdir(os.path.dirname(db.path))
+                    if f.endswith('.rebuild')]
+        assert os.stat(db.path).st_ino == inode
+        # and both databases see the new one:
+        for d in [db, other]:
+            rows = d.conn.execute(d.issues.select()).fetchall()
+            assert [r['id'] for r in rows] == [issue.id]
+            counts = dict(((r['kind'], r['key']), r['n']) for r in
+                          d.conn.execute(d.counters.select()))
+            assert counts[('status', 'open')] == 1
+            assert counts[('label', 'bug')] == 1
+        # the counter triggers are in place:
+        db.delete(issue.id)
+        n = db.conn.execute("""SELECT n FROM counters WHERE kind = 'status'
+                               AND key = 'open'""").scalar()
+        assert n == 0
+
+    def test__load(self):
+        '''Tests the `_load` method'''
+        tracker = self.env.tracker
+        db = Database(tracker)
+        issues = []
+        for i in range(5):
+            issue = Issue(tracker)
+            issue.title = 'Issue %d' % i
+            issue.save()
+            issues.append(issue)
+        comment = Comment(issues[0])
+        comment.content = 'Loaded'
+        comment.save()
+        shas = [i.id for i in issues]
+
+        def load():
+            rows, comment_rows = [], []
+            for r, c in db._load(shas, n=2):
+                rows.extend(r)
+                comment_rows.extend(c)
+            return sorted(rows), comment_rows
+
+        serial = load()
+        assert sorted(r['id'] for r in serial[0]) == sorted(shas)
+        assert serial[0] == sorted(db._row(i) for i in issues)
+        assert serial[1] == [db._comment_row(comment)]
+
+        # and again, in worker processes:
+        threshold = database.PARALLEL_THRESHOLD
+        database.PARALLEL_THRESHOLD = 0
+        tracker.config.database['workers'] = 2
+        try:
+            assert db._workers(len(shas)) == 2
+            assert load() == serial
+        finally:
+            database.PARALLEL_THRESHOLD = threshold
+
+    def test__load_commit(self):
+        '''Tests the `_load_commit` method'''
+        tracker = self.env.tracker
+        db = Database(tracker)
+        issue = Issue(tracker)
+        issue.title = 'Committed'
+        issue.save()
+        comment = Comment(issue)
+        comment.content = 'Also committed'
+        comment.save()
+        tracker.autocommit('Created an issue')
+        # not committed, so not loaded:
+        Issue(tracker).save()
+
+        chunks = list(db._load_commit('HEAD'))
+        assert chunks == list(db._load([issue.id]))
+        assert chunks[0][0][0]['title'] == 'Committed'
+        assert chunks[0][1][0]['content'] == 'Also committed'
+        assert list(db._load_commit('HEAD', ['f' * 40])) == []
+
+    def test__replicate_ref(self):
+        '''Tests the `_replicate` method with a ref'''
+        tracker = self.env.tracker
+        db = Database(tracker)
+        issue1 = Issue(tracker)
+        issue1.save()
+        tracker.autocommit('Created issue 1')
+        issue2 = Issue(tracker)
+        issue2.save()
+        db._replicate('HEAD')
+        ids = [r['id'] for r in db.conn.execute(db.issues.select())]
+        assert ids == [issue1.id]
+        path = os.path.join(tracker.paths['admin'], 'cache', 'LAST_UPDATE')
+        assert open(path).read() == tracker.repo.head().id
+
+    def test__sync(self):
+        '''Tests the `_sync` method'''
+        tracker = self.env.tracker
+        db = Database(tracker)
+        issue1 = Issue(tracker)
+        issue1.save()
+        tracker.autocommit('Created issue 1')
+        db._replicate()
+        last_update = tracker.repo.head().id
+
+        issue2 = Issue(tracker)
+        issue2.title = 'Pulled in'
+        issue2.save()
+        tracker.autocommit('Created issue 2')
+        # pretend issue 2 arrived with a pull, bypassing the database.
+        db.delete(issue2.id)
+        db.delete(issue1.id)
+
+        db._sync(last_update)
+        ids = [r['id'] for r in db.select().execute()]
+        # only the issue that changed between the commits is re-read.
+        assert ids == [issue2.id]
 
     def test__set_update(self):
         '''Tests the `_set_update` method'''
@@ -78,6 +226,36 @@ class DatabaseTest(unittest.TestCase):
         # quick check to make sure they're all there.
         assert len(db_issues) == len(issues)
 
+    def test_delete(self):
+        '''Tests the `delete` method'''
+        db = Database(self.env.tracker)
+        issue = Issue(self.env.tracker)
+        issue.title = 'Delete me'
+        issue.save()
+        db.delete(issue.id)
+        # (not through select, whose integrity check would re-sync the
+        # issue that's still on disk)
+        rows = db.conn.execute(db.issues.select()).fetchall()
+        assert len(rows) == 0
+        if db.has_fts:
+            rows = db.conn.execute('SELECT * FROM issues_fts').fetchall()
+            assert len(rows) == 0
+
+    def test_search_index(self):
+        '''The search index is kept in sync with the `issues` table.'''
+        db = Database(self.env.tracker)
+        if not db.has_fts:
+            return
+        issue = Issue(self.env.tracker)
+        issue.title = 'Original title'
+        issue.save()
+        issue.title = 'Replaced title'
+        issue.save()
+        rows = db.conn.execute('SELECT id, title FROM issues_fts').fetchall()
+        # replacing the issue replaced its row in the index.
+        assert len(rows) == 1
+        assert rows[0]['title'] == 'Replaced title'
+
     def test_select(self):
         '''Tests the `select` method'''
         db = Database(self.env.tracker)
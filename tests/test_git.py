@@ -58,6 +58,35 @@ class RepoTest(unittest.TestCase):
         assert r._file_status('spam-2') == FILE_IS_UNCHANGED
         assert r._file_status('spam-x') == FILE_IS_NEW
 
+    def test_stat_cache(self):
+        """Tests the `stat_cache` method and `StatCache` class"""
+        r = self._repo_with_commits()
+        # back-date the files, so they aren't too new to be cached.
+        for i in range(4):
+            path = os.path.join(r.root, 'spam-%d' % i)
+            os.utime(path, (1000000000, 1000000000))
+        assert not r.is_dirty()
+        cache = r.stat_cache()
+        assert cache is r.stat_cache()
+        assert os.path.exists(cache.path)
+        assert cache.entries['spam-0'][3] == r._blob_sha('spam-0')
+
+        # cached files aren't read: a bogus SHA shows as a modification.
+        cache.entries['spam-2'][3] = '0' * 40
+        assert r.status() == ([], ['spam-2'], [])
+        cache.entries['spam-2'][3] = r._blob_sha('spam-2')
+
+        # but a changed stat means the file is hashed again.
+        path = os.path.join(r.root, 'spam-1')
+        with open(path, 'w') as fp:
+            fp.write('something else')
+        os.utime(path, (1000000001, 1000000001))
+        assert r.status() == ([], ['spam-1'], [])
+
+        # and deleted files are noticed.
+        os.remove(path)
+        assert r.status() == ([], [], ['spam-1'])
+
     def test__file_is_modified(self):
         """Tests the `_file_is_modified` method"""
         pass
@@ -85,7 +114,46 @@ class RepoTest(unittest.TestCase):
         r = self._repo_with_commits(4)
         tree = r.object(r.head().tree)
         assert type(r._obj_from_tree(tree, 'spam-0')) is Blob
-        # TODO: test subtree retrieval
+        assert r._obj_from_tree(tree, 'spam-x') is None
+        # sub-trees:
+        os.mkdir(os.path.join(r.root, 'eggs'))
+        self._rand_file(os.path.join('eggs', 'ham'))
+        r.add(all=True)
+        r.commit(committer='Joe Sixpack', message='Eggs')
+        tree = r.object(r.head().tree)
+        assert type(r._obj_from_tree(tree, 'eggs')) is Tree
+        assert type(r._obj_from_tree(tree, 'eggs/')) is Tree
+        assert type(r._obj_from_tree(tree, os.path.join('eggs', 'ham'))) \
+                is Blob
+
+    def test__tree_paths(self):
+        """Tests the `_tree_paths` method"""
+        r = self._repo_with_commits()
+        tree = r.head().tree
+        paths = r._tree_paths(tree)
+        assert sorted(paths) == ['spam-%d' % i for i in range(4)]
+        assert paths['spam-0'][1] == r._obj_from_tree(r.tree(), 'spam-0').id
+        # built once per tree:
+        assert r._tree_paths(tree) is paths
+
+    def test__tree_changes(self):
+        """Tests the `_tree_changes` method"""
+        r = self._repo_with_commits(1)
+        old = r.head().tree
+        os.mkdir(os.path.join(self.path, 'sub'))
+        self._rand_file(os.path.join('sub', 'eggs'))
+        self._rand_file('spam-1')
+        r.add(all=True)
+        r.commit(committer='Joe Sixpack', message='Commit 1')
+        new = r.head().tree
+
+        changes = list(r._tree_changes(old, new))
+        paths = [c[0] for c in changes]
+        assert paths == ['spam-1', os.path.join('sub', 'eggs')]
+        # the added blob has no old SHA.
+        assert changes[1][1] is None
+        # identical trees have no changes.
+        assert list(r._tree_changes(new, new)) == []
 
     def test__write_tree_to_wt(self):
         """Tests the `_write_tree_to_wt` method"""
@@ -172,6 +240,24 @@ class RepoTest(unittest.TestCase):
         parent = r.object(r.head().parents[0])
         assert type(parent) is Commit
 
+        # with a new file and a local change.
+        r.commit_changes({os.path.join('eggs', 'ham'): 'spam'}, 
+                         message='Eggs', committer='Joe Sixpack')
+        r.checkout('HEAD', 'eggs')
+        self._rand_file('spam-3')
+        old = r.tree(parent.tree)
+        touched = r.checkout(parent.id)
+        assert sorted(touched) == [os.path.join('eggs', 'ham'), 'spam-0', 
+                                   'spam-1', 'spam-2', 'spam-3']
+        assert not os.path.exists(os.path.join(self.path, 'eggs'))
+        with open(os.path.join(self.path, 'spam-3'), 'rb') as fp:
+            assert fp.read() == r._obj_from_tree(old, 'spam-3').data
+
+        # nothing left to do.
+        assert r.checkout(parent.id) == []
+        # and just a path.
+        assert r.checkout('HEAD', 'spam-0') == ['spam-0']
+
     def test_cmd(self):
         """Tests the `cmd` method"""
         r = self._repo_with_commits()
@@ -195,6 +281,108 @@ class RepoTest(unittest.TestCase):
         # the commit should be the same as the Repo.head
         assert c == r.head()
 
+    def test_commit_changes(self):
+        """Tests the `commit_changes` method"""
+        r = self._repo_with_commits()
+        parent = r.head()
+        eggs = os.path.join('eggs', 'ham')
+        c = r.commit_changes({eggs: 'spam and eggs', 'spam-0': None,
+                              'spam-1': 'changed'},
+                             message='Changes', committer='Joe Sixpack')
+        assert r.head() == c
+        assert c.parents == [parent.id]
+        assert c.message == 'Changes'
+        tree = r.tree()
+        assert r._obj_from_tree(tree, eggs).data == 'spam and eggs'
+        assert r._obj_from_tree(tree, 'spam-0') is None
+        assert r._obj_from_tree(tree, 'spam-1').data == 'changed'
+        # unchanged entries are carried over.
+        assert r._obj_from_tree(tree, 'spam-2') == \
+                r._obj_from_tree(r.tree(parent.tree), 'spam-2')
+
+        # deleting the last entry of a directory removes it.
+        r.commit_changes([('eggs', None)], message='No eggs', 
+                         committer='Joe Sixpack')
+        assert r._obj_from_tree(r.tree(), 'eggs') is None
+
+        # the index is kept in step with HEAD.
+        index = r.repo.open_index()
+        assert index['spam-1'][8] == r._obj_from_tree(r.tree(), 'spam-1').id
+        assert 'spam-0' not in index
+        assert eggs not in index
+
+    def test_pack(self):
+        """Tests the `pack` method"""
+        r = self._repo_with_commits()
+        head = r.head()
+        n = r.loose_objects()
+        assert n > 0
+        assert r.pack() == n
+        assert r.loose_objects() == 0
+        assert r.head() == head
+        assert r._obj_from_tree(r.tree(), 'spam-1') is not None
+        assert r.pack() == 0
+
+        # repack everything into one pack.
+        r.commit_changes({'eggs': 'ham'}, message='Eggs', 
+                         committer='Joe Sixpack')
+        assert r.pack(all=True) > n
+        assert len(r.repo.object_store.packs) == 1
+        assert r._obj_from_tree(r.tree(), 'eggs').data == 'ham'
+
+    def test_changes(self):
+        """Tests the `changes` method"""
+        r = self._repo_with_commits()
+        first = r.head()
+        eggs = os.path.join('eggs', 'ham')
+        r.commit_changes({eggs: 'spam', 'spam-0': None, 'spam-1': 'new'},
+                         message='Changes', committer='Joe Sixpack')
+        changes = list(r.changes(first.id, 'HEAD'))
+        assert [c[:2] for c in changes] == [(eggs, FILE_IS_NEW),
+                                            ('spam-0', FILE_IS_DELETED),
+                                            ('spam-1', FILE_IS_MODIFIED)]
+        assert changes[0][2] is None
+        assert changes[1][3] is None
+        # just a directory, or a file.
+        assert [c[0] for c in r.changes(first.id, 'HEAD', 'eggs')] == [eggs]
+        assert [c[0] for c in r.changes(first.id, 'HEAD', 'spam-1')] == \
+                ['spam-1']
+
+        # against the working tree (still at the first commit).
+        self._rand_file('spam-2')
+        changes = list(r.changes('HEAD'))
+        assert [c[:2] for c in changes] == [(eggs, FILE_IS_DELETED),
+                                            ('spam-0', FILE_IS_NEW),
+                                            ('spam-1', FILE_IS_MODIFIED),
+                                            ('spam-2', FILE_IS_MODIFIED)]
+        assert list(r.changes(first.id, path='spam-3')) == []
+
+    def test_patch(self):
+        """Tests the `patch` method"""
+        r = self._repo_with_commits()
+        first = r.head()
+        r.commit_changes({'spam-1': 'new'}, message='Changes', 
+                         committer='Joe Sixpack')
+        change = list(r.changes(first.id, 'HEAD'))[0]
+        lines = r.patch(change).splitlines()
+        assert lines[:2] == ['--- a/spam-1', '+++ b/spam-1']
+        assert lines[-1] == '+new'
+        assert r.diff(first.id, 'HEAD', '.') == r.patch(change)
+
+    def test__object(self):
+        """Tests the `_object` method"""
+        r = self._repo_with_commits(2)
+        c = Repo(self.path, cat_file=True)
+        head = r.head()
+        # the same objects, whichever way they're read.
+        assert c._object(head.id) == head
+        assert c._object(head.id).parents == head.parents
+        tree = c._object(head.tree)
+        assert type(tree) is Tree
+        assert c._tree_entries(tree.id) == r._tree_entries(tree.id)
+        assert [x.id for x in c.walk()] == [x.id for x in r.walk()]
+        self.assertRaises(KeyError, c._object, '0' * 40)
+
     def test_commits(self):
         """Tests the `commits` method"""
         r = self._repo_with_commits(20)
@@ -216,6 +404,22 @@ class RepoTest(unittest.TestCase):
         assert r.commits('v1.0')
         assert r.commits()[0] == r.head()
 
+    def test_walk(self):
+        """Tests the `walk` method"""
+        r = self._repo_with_commits(10)
+        walk = r.walk()
+        assert inspect.isgenerator(walk)
+        assert walk.next() == r.head()
+        history = list(r.walk())
+        assert len(history) == 10
+        assert [c.message for c in history] == \
+                ['Commit %d' % i for i in reversed(range(10))]
+
+        # continue where we left off:
+        page = r.commits(n=4)
+        assert r.commits(n=4, after=page[-1].id) == history[4:8]
+        assert list(r.walk(after=history[-1].id)) == []
+
     def test_constructor(self):
         r1 = Repo.init(self.path, mkdir=True)
 
@@ -288,6 +492,17 @@ class RepoTest(unittest.TestCase):
         # make sure it returns a Repo object.
         assert type(r) is Repo
 
+    def test_is_ancestor(self):
+        """Tests the `is_ancestor` method"""
+        r = self._repo_with_commits(3)
+        first = r.commits(n=3)[-1]
+        assert r.is_ancestor(first.id)
+        assert r.is_ancestor(r.head().id)
+        # the relationship is one-way.
+        assert not r.is_ancestor(r.head().id, first.id)
+        # unknown SHAs are never ancestors.
+        assert not r.is_ancestor(get_uuid())
+
     def test_object(self):
         """Tests the `object` method"""
         r = self._repo_with_commits()
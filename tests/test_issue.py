@@ -77,6 +77,56 @@ class TestIssue(unittest.TestCase):
         issue.title = 'test title'
         issue.save()
         assert issue.created == issue.updated
-        
+
+    def test_revision(self):
+        t = self.tracker
+        issue = Issue(t)
+        issue.title = 'Original'
+        issue.save()
+        comment = Comment(issue)
+        comment.content = 'First'
+        comment.save()
+        first = t.autocommit('Created issue')
+        issue.title = 'Spam'
+        issue.save()
+        spam = Comment(issue)
+        spam.content = 'Spam'
+        spam.save()
+        t.autocommit('Spammed issue')
+
+        old = issue.revision(first.id)
+        assert old.id == issue.id
+        assert old.title == 'Original'
+        assert [c.id for c in old.comments()] == [comment.id]
+        assert old.comments()[0].content == 'First'
+        assert issue.revision().title == 'Spam'
+        assert len(issue.revision().comments()) == 2
+
+    def test_revert(self):
+        t = self.tracker
+        issue = Issue(t)
+        issue.title = 'Original'
+        issue.save()
+        comment = Comment(issue)
+        comment.content = 'First'
+        comment.save()
+        first = t.autocommit('Created issue')
+        issue.title = 'Spam'
+        issue.save()
+        spam = Comment(issue)
+        spam.content = 'Spam'
+        spam.save()
+        t.autocommit('Spammed issue')
+
+        changed = issue.revert(first.id)
+        assert sorted(changed) == sorted(
+                [os.path.relpath(issue.paths['issue'], t.path),
+                 os.path.relpath(issue.get_comment_path(spam.id), t.path)])
+        assert issue.title == 'Original'
+        assert [c.id for c in issue.comments()] == [comment.id]
+        assert t.query().select()[0].title == 'Original'
+        # nothing left to change.
+        assert issue.revert(first.id) == []
+
 if __name__ == '__main__':
     unittest.main()
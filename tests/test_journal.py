@@ -0,0 +1,97 @@
+import unittest
+import os
+import threading
+
+from env import TestEnv
+from hopper.journal import Journal, record, find_root
+from hopper.issue import Issue
+from hopper.tracker import Tracker
+
+class JournalTest(unittest.TestCase):
+    '''Tests the `Journal` class.'''
+
+    def setUp(self):
+        self.env = TestEnv()
+        self.tracker = self.env.tracker
+        self.journal = Journal(self.tracker.paths['root'])
+
+    def tearDown(self):
+        self.env.cleanup()
+
+    def test_record(self):
+        '''Tests the `record` method'''
+        root = self.tracker.paths['root']
+        self.journal.record(os.path.join(root, 'config'), 'docs')
+        self.journal.record('config')
+        assert self.journal.paths() == ['config', 'docs']
+
+    def test_take(self):
+        '''Tests the `take` method'''
+        self.journal.record('config')
+        assert self.journal.take() == ['config']
+        assert self.journal.paths() == []
+        assert self.journal.take() == []
+        # taking some of the paths leaves the rest.
+        self.journal.record('config', 'docs')
+        assert self.journal.take(['docs']) == ['docs']
+        assert self.journal.paths() == ['config']
+
+    def test_recorded(self):
+        '''Tests the `recorded` method'''
+        # (forget what creating the tracker recorded)
+        self.journal.recorded()
+        self.journal.record('config')
+        thread = threading.Thread(
+                target=lambda: self.journal.record('docs'))
+        thread.start()
+        thread.join()
+        assert self.journal.recorded() == ['config']
+        assert self.journal.recorded() == []
+        assert self.journal.paths() == ['config', 'docs']
+
+    def test_writes(self):
+        '''Test that writing files records them.'''
+        issue = Issue(self.tracker)
+        issue.save()
+        path = os.path.relpath(issue.paths['issue'], 
+                               self.tracker.paths['root'])
+        assert path in self.journal.paths()
+        self.tracker.autocommit('Created an issue')
+        assert self.journal.paths() == []
+
+        issue.delete()
+        path = os.path.relpath(issue.paths['root'], 
+                               self.tracker.paths['root'])
+        assert self.journal.paths() == [path]
+
+    def test_relative_root(self):
+        '''Test a tracker opened with a path relative to the cwd.'''
+        root = self.tracker.paths['root']
+        cwd = os.getcwd()
+        os.chdir(os.path.dirname(os.path.abspath(root)))
+        try:
+            t = Tracker(os.path.basename(root))
+            issue = Issue(t)
+            issue.save()
+            path = os.path.relpath(issue.paths['issue'], t.paths['root'])
+            assert Journal(t.paths['root']).paths() == [path]
+            t.autocommit('Created an issue')
+            assert t.repo.status('issues') == ([], [], [])
+        finally:
+            os.chdir(cwd)
+
+
+def test_find_root():
+    '''Tests the `find_root` function.'''
+    env = TestEnv()
+    root = env.tracker.paths['root']
+    try:
+        path = os.path.join(root, 'issues', 'x' * 40, 'issue')
+        assert find_root(path) == os.path.abspath(root)
+        assert find_root('/') is None
+    finally:
+        env.cleanup()
+
+
+if __name__ == '__main__':
+    unittest.main()
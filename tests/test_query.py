@@ -1,26 +1,182 @@
 import unittest
 
+from env import TestEnv
+from hopper.issue import Issue, IssueRecord
+from hopper.comment import Comment, CommentRecord
+from hopper.query import Query, _match_expression
+from hopper.errors import BadCursor
+
 class QueryTest(unittest.TestCase):
     '''Tests the `Query` class.'''
 
     def setUp(self):
-        pass
+        self.env = TestEnv()
+        self.tracker = self.env.tracker
 
     def tearDown(self):
-        pass
+        self.env.cleanup()
+
+    def test_comments(self):
+        '''Tests the `comments` and `comment_counts` methods'''
+        issue = Issue(self.tracker)
+        issue.save()
+        comments = [Comment(issue) for i in range(3)]
+        for c in comments:
+            c.save()
+        query = Query(self.tracker)
+        records = query.comments(issue.id)
+        assert type(records[0]) is CommentRecord
+        # returned in the order they were made.
+        assert [r.id for r in records] == [c.id for c in comments]
+        assert len(query.comments(issue.id, n=2)) == 2
+        assert query.comment_counts([issue.id]) == {issue.id: 3}
+
+    def test_select_cursor(self):
+        '''Tests paging the `select` method with cursors'''
+        issues = []
+        for i in range(7):
+            issue = Issue(self.tracker)
+            issue.save()
+            issues.append(issue)
+        query = Query(self.tracker)
+        expected = [i.id for i in query.select()]
+        # walk the results 3 at a time.
+        seen = []
+        cursor = None
+        while True:
+            page = query.select(limit=3, cursor=cursor)
+            seen.extend(i.id for i in page)
+            if len(page) < 3:
+                break
+            cursor = query.cursor(page[-1])
+        assert seen == expected
+        # cursors are tied to an ordering and a direction.
+        try:
+            query.select(order_by='created', cursor=cursor)
+            assert False
+        except BadCursor:
+            pass
+        try:
+            query.select(reverse=False, cursor=cursor)
+            assert False
+        except BadCursor:
+            pass
+        # the other direction pages the same way.
+        cursor = query.cursor(query.select(reverse=False)[2], reverse=False)
+        page = query.select(reverse=False, limit=3, cursor=cursor)
+        assert [i.id for i in page] == list(reversed(expected))[3:6]
+
+    def test_select_labels(self):
+        '''Tests filtering the `select` method by labels'''
+        ui = self._issue_with_labels(['ui'])
+        gui = self._issue_with_labels(['gui'])
+        both = self._issue_with_labels(['ui', 'bug'])
+        query = Query(self.tracker)
+
+        def ids(issues):
+            return sorted(i.id for i in issues)
+
+        # no more substring matches: 'ui' doesn't match 'gui'.
+        assert ids(query.select(label='ui')) == sorted([ui.id, both.id])
+        assert ids(query.select(labels=['ui', 'bug'])) == [both.id]
+        assert ids(query.select(labels=['gui', 'bug'], match='any')) == \
+                sorted([gui.id, both.id])
+        assert query.count(labels=['ui', 'bug']) == 1
+
+    def test_label_counts(self):
+        '''Tests the `label_counts` method'''
+        self._issue_with_labels(['ui'])
+        self._issue_with_labels(['ui', 'bug'])
+        closed = self._issue_with_labels(['bug'])
+        closed.status = 'closed'
+        closed.save()
+        query = Query(self.tracker)
+        assert query.label_counts() == {'ui': 2, 'bug': 2}
+        assert query.label_counts('open') == {'ui': 2, 'bug': 1}
 
     def test_count(self):
-        '''Tests the `count` method'''
-        pass
+        '''Tests the `count` and `counts` methods'''
+        issues = [Issue(self.tracker) for i in range(3)]
+        for i in issues:
+            i.author['name'] = 'Tobias'
+            i.save()
+        # closing an issue (replacing its row) moves it between statuses.
+        issues[0].status = 'closed'
+        issues[0].save()
+        query = Query(self.tracker)
+        assert query.count() == 3
+        assert query.count('open') == 2
+        assert query.count('closed') == 1
+        assert query.counts('status') == {'open': 2, 'closed': 1}
+        assert query.counts('author') == {'Tobias': 3}
+        # deletes are counted too.
+        issues[1].delete()
+        self.tracker.db.delete(issues[1].id)
+        assert query.count('open') == 1
+        # and changes the mirror missed (e.g. made by another process) are
+        # caught up on first.
+        self.tracker.db.delete(issues[2].id)
+        assert query.count('open') == 1
+        assert query.counts('author') == {'Tobias': 2}
 
     def test_search(self):
         '''Tests the `search` method'''
-        pass
+        issue1 = Issue(self.tracker)
+        issue1.title = 'Segfault on startup'
+        issue1.content = 'It crashes.'
+        issue1.save()
+        issue2 = Issue(self.tracker)
+        issue2.title = 'Typo'
+        issue2.content = 'The segfault docs are misspelled.'
+        issue2.status = 'closed'
+        issue2.save()
+
+        query = Query(self.tracker)
+        # both match, but the title match should rank first.
+        results = query.search('segfault')
+        assert [i.id for i in results] == [issue1.id, issue2.id]
+        # partial words match, like they did with LIKE.
+        assert len(query.search('segf')) == 2
+        # the status argument is honored.
+        results = query.search('segfault', status='closed')
+        assert [i.id for i in results] == [issue2.id]
+        # query syntax in the search string is treated as text.
+        assert query.search('"segfault') 
+        assert query.search('') == []
+        # comments are searchable too.
+        comment = Comment(issue2)
+        comment.content = 'Reproduced with a zebra'
+        comment.save()
+        results = query.search('zebra')
+        assert [i.id for i in results] == [issue2.id]
 
     def test_select(self):
         '''Tests the `select` method'''
-        pass
+        issue = Issue(self.tracker)
+        issue.title = 'Test'
+        issue.labels = ['ui', 'bug']
+        issue.save()
+        results = Query(self.tracker).select()
+        # results come straight from the mirror.
+        assert type(results[0]) is IssueRecord
+        assert results[0] == issue
+        assert results[0].fields == issue.fields
+        # the full issue can still be loaded when needed.
+        assert results[0].issue().fields == issue.fields
+
+    def _issue_with_labels(self, labels):
+        issue = Issue(self.tracker)
+        issue.labels = labels
+        issue.save()
+        return issue
+
+
+def test__match_expression():
+    '''Tests the `_match_expression` function.'''
+    assert _match_expression('foo bar') == '"foo"* "bar"*'
+    assert _match_expression('say "hi"') == '"say"* """hi"""*'
+    assert _match_expression('   ') is None
 
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -1,11 +1,15 @@
 import unittest
 import os
+import threading
 
 from env import TestEnv
 from hopper.tracker import Tracker
 from hopper.issue import Issue
 from hopper.utils import get_uuid
 from hopper.errors import BadReference
+from hopper.git import git_available
+from hopper.journal import Journal
+from hopper.activity import _actions
 
 class TrackerTest(unittest.TestCase):
     def setUp(self):
@@ -68,8 +72,129 @@ class TrackerTest(unittest.TestCase):
         # make a bunch of issues
         issues = [Issue(t) for i in range(50)]
 
+    def test_autocommit(self):
+        t = Tracker.new(self.path)
+        i = Issue(t)
+        i.save()
+        c = t.autocommit('Created an issue')
+        assert c.message == 'Created an issue'
+        assert not t.repo.status('issues')[0]
+
+        # files written by hand need a scan.
+        path = os.path.join(t.paths['docs'], 'By-hand.md')
+        with open(path, 'w') as fp:
+            fp.write('Hello')
+        t.autocommit('Nothing new')
+        assert t.repo.status('docs')[0] == [os.path.join('docs', 
+                                                         'By-hand.md')]
+        t.autocommit('Found it', scan=True)
+        assert t.repo.status('docs')[0] == []
+        # but the cache (the mirror, the journal) is never committed.
+        assert t.repo._obj_from_tree(t.repo.tree(), 
+                                     os.path.join('.hopper', 'cache')) is None
+
+        # deletions are staged too.
+        i.delete()
+        t.autocommit('Deleted an issue')
+        tree = t.repo.tree()
+        assert t.repo._obj_from_tree(tree, os.path.join('issues', i.id)) \
+                is None
+
+        # and git agrees (the index was updated along with HEAD).
+        if git_available():
+            assert t.repo.cmd(['status', '--porcelain', 
+                               '--untracked-files=no']) == ''
+
+    def test_autocommit_group(self):
+        t = Tracker.new(self.path)
+        # written, but not by any of the group's actions.
+        other = Issue(t)
+        other.save()
+        commits = []
+
+        def write(n):
+            t = Tracker(self.path)
+            t.config.commit['group_window'] = 500
+            i = Issue(t)
+            i.save()
+            commits.append(t.autocommit('Created issue %d' % n, 
+                                        'User %d <u@x.com>' % n, 
+                                        group=True))
+
+        threads = [threading.Thread(target=write, args=(n,)) 
+                   for n in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(commits) == 3
+        assert len(set(c.id for c in commits)) == 1
+        lines = commits[0].message.splitlines()
+        assert lines[0] == 'Grouped 3 actions'
+        assert sorted(lines[2:5]) == ['User %d <u@x.com>: Created issue %d' 
+                                      % (n, n) for n in range(3)]
+        assert sorted(_actions(commits[0])) == \
+                [('Created issue %d' % n, 'User %d <u@x.com>' % n) 
+                 for n in range(3)]
+        assert commits[0].author == 'Hopper <hopper@hopperhq.com>'
+        # only the other issue is left uncommitted (and journaled).
+        t = Tracker(self.path)
+        path = os.path.relpath(other.paths['issue'], t.paths['root'])
+        assert t.repo.status('issues')[0] == [path]
+        assert path in Journal(t.paths['root']).paths()
+
+    def test_history(self):
+        t = Tracker.new(self.path)
+        for n in range(5):
+            Issue(t).save()
+            t.autocommit('Created issue %d' % n)
+        history = t.history(n=6)
+        assert len(history) == 6
+        assert history[0].message == 'Created issue 4'
+        assert t.history(n=4, offset=2) == history[2:4]
+        assert t.history(n=2, after=history[1].id) == history[2:4]
+        for bad in ['f' * 40, 'spam', history[0].tree]:
+            try:
+                t.history(after=bad)
+                assert False
+            except BadReference:
+                pass
+
     def test_get_issue_path(self):
-        pass
+        t = Tracker.new(self.path)
+        sha = 'ab' + 'c' * 38
+        assert t.get_issue_path(sha) == \
+                os.path.join(t.paths['issues'], sha, 'issue')
+        t.config.layout['sharded'] = True
+        assert t.get_issue_path(sha) == \
+                os.path.join(t.paths['issues'], 'ab', 'c' * 38, 'issue')
+
+    def test_set_layout(self):
+        t = Tracker.new(self.path)
+        issue = Issue(t)
+        issue.save()
+        t.autocommit('Created issue')
+        assert t.set_layout() == 1
+        t.autocommit('Sharded')
+        t = Tracker(self.path)
+        assert t.config.layout['sharded']
+        assert os.path.isdir(os.path.join(t.paths['issues'], issue.id[:2],
+                                          issue.id[2:]))
+        assert t._get_issue_shas() == [issue.id]
+        assert Issue(t, issue.id[:6]).id == issue.id
+        new = Issue(t)
+        new.save()
+        assert new.paths['root'] == os.path.join(t.paths['issues'], 
+                                                 new.id[:2], new.id[2:])
+        assert sorted(i.id for i in t.query().select()) == \
+                sorted([issue.id, new.id])
+        # and back.
+        assert t.set_layout(sharded=False) == 2
+        assert sorted(t._get_issue_shas()) == sorted([issue.id, new.id])
+        if new.id[:2] != issue.id[:2]:
+            # the emptied shards are removed.
+            assert not os.path.exists(os.path.join(t.paths['issues'], 
+                                                   issue.id[:2]))
 
     def test_get_issues(self):
         pass